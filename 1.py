@@ -1,15 +1,63 @@
 import os
+import time
+# Начало запуска: от него считается длительность импорта и время до готовности
+STARTED_AT = time.monotonic()
 import discord
 from discord.ext import commands
 from discord import app_commands
-import google.generativeai as genai
 from dotenv import load_dotenv
-import requests
+import aiohttp
+from aiohttp import web
 import asyncio
-import base64
 import datetime
-from typing import Dict, List, Optional, Any, Union, Deque
-from collections import defaultdict, deque
+import hashlib
+import importlib
+import io
+import json
+import random
+import re
+import sqlite3
+import subprocess
+import sys
+import threading
+from array import array
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Any, Union, Deque, Collection, Iterator
+from collections import defaultdict, deque, OrderedDict
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+# Тяжелые SDK импортируются при первом обращении, а не при запуске
+class LazyModule:
+    def __init__(self, name: str):
+        self._name = name
+        self._module = None
+
+    def load(self):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return self._module
+
+    def available(self) -> bool:
+        try:
+            self.load()
+        except ImportError:
+            return False
+        return True
+
+    def __getattr__(self, attr: str):
+        return getattr(self.load(), attr)
+
+genai = LazyModule("google.generativeai")
+protos = LazyModule("google.generativeai.protos")
+google_exceptions = LazyModule("google.api_core.exceptions")
+# redis нужен только для STORAGE_BACKEND=redis или SHARED_STATE=redis
+redis = LazyModule("redis")
+aioredis = LazyModule("redis.asyncio")
 
 # Загрузка переменных окружения
 load_dotenv()
@@ -22,6 +70,122 @@ class Config:
     VISION_MODEL = "models/gemini-1.5-flash"
     MAX_MESSAGE_LENGTH = 2000
     CONTEXT_LIMIT = 1000
+    # Сколько запросов к Gemini может выполняться одновременно
+    MAX_CONCURRENT_REQUESTS = int(os.getenv("GEMINI_MAX_CONCURRENCY", "8"))
+    # Таймаут одного запроса к Gemini в секундах
+    REQUEST_TIMEOUT = float(os.getenv("GEMINI_REQUEST_TIMEOUT", "60"))
+    # Ограничения на загрузку вложений-изображений
+    MAX_IMAGE_BYTES = int(os.getenv("MAX_IMAGE_BYTES", str(20 * 1024 * 1024)))
+    IMAGE_DOWNLOAD_TIMEOUT = float(os.getenv("IMAGE_DOWNLOAD_TIMEOUT", "15"))
+    # Изображения больше этого размера пережимаются перед отправкой (нужен Pillow)
+    IMAGE_REENCODE_BYTES = int(os.getenv("IMAGE_REENCODE_BYTES", str(4 * 1024 * 1024)))
+    IMAGE_MAX_SIDE = int(os.getenv("IMAGE_MAX_SIDE", "2048"))
+    # Бюджет истории в токенах (оценочно, ~4 символа на токен)
+    HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", "32000"))
+    MODEL_TOKEN_BUDGETS = {
+        "models/gemini-1.5-pro": 64000,
+        "models/gemini-2.0-flash-lite": 16000
+    }
+    CHARS_PER_TOKEN = 4
+    # Для стольких недавно запрошенных каналов собранная история (protos.Content) хранится между запросами
+    HISTORY_WINDOW_CACHE = int(os.getenv("HISTORY_WINDOW_CACHE", "64"))
+    # Автоматический выбор модели ("auto"): простые запросы -> быстрая, сложные -> мощная
+    AUTO_MODEL = "auto"
+    FAST_MODEL = os.getenv("FAST_MODEL", "models/gemini-2.0-flash-lite")
+    STRONG_MODEL = os.getenv("STRONG_MODEL", "models/gemini-1.5-pro")
+    AUTO_SHORT_PROMPT = int(os.getenv("AUTO_SHORT_PROMPT", "200"))
+    AUTO_LONG_PROMPT = int(os.getenv("AUTO_LONG_PROMPT", "2000"))
+    # Более быстрая замена для модели, которая упирается в лимиты или отвечает медленно
+    MODEL_FALLBACKS = {
+        "models/gemini-1.5-pro": "models/gemini-2.0-flash",
+        "models/gemini-2.0-flash": "models/gemini-2.0-flash-lite",
+        "models/gemini-1.5-flash": "models/gemini-2.0-flash-lite"
+    }
+    SLOW_MODEL_SECONDS = float(os.getenv("SLOW_MODEL_SECONDS", "20"))
+    # Предохранитель модели: после BREAKER_FAILURES сбоев подряд (таймауты и ошибки 5xx) запросы к ней
+    # не отправляются MODEL_COOLDOWN секунд, затем пропускается один пробный; при новом сбое пауза удваивается.
+    # Ошибки квоты (429) предохранитель не учитывает: на них планировщик снижает темп и повторяет запрос
+    BREAKER_FAILURES = int(os.getenv("BREAKER_FAILURES", "3"))
+    MODEL_COOLDOWN = float(os.getenv("MODEL_COOLDOWN", "30"))
+    MAX_MODEL_COOLDOWN = float(os.getenv("MAX_MODEL_COOLDOWN", "300"))
+    # Фоновое сжатие старой истории канала в краткое содержание
+    SUMMARY_MODEL = os.getenv("SUMMARY_MODEL", "models/gemini-2.0-flash-lite")
+    COMPACTION_THRESHOLD_TOKENS = int(os.getenv("COMPACTION_THRESHOLD_TOKENS", "8000"))
+    COMPACTION_KEEP_RECENT = int(os.getenv("COMPACTION_KEEP_RECENT", "20"))
+    COMPACTION_INTERVAL = float(os.getenv("COMPACTION_INTERVAL", "60"))
+    COMPACTION_IDLE_SECONDS = float(os.getenv("COMPACTION_IDLE_SECONDS", "30"))
+    COMPACTION_BATCH = int(os.getenv("COMPACTION_BATCH", "4"))
+    # Хранилище истории и промптов: "sqlite", "redis" или "memory"
+    STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "sqlite")
+    DATABASE_PATH = os.getenv("DATABASE_PATH", "bot.db")
+    REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+    # Общее состояние процессов бота (лимиты запросов, кэш ответов): "local" или "redis"
+    SHARED_STATE = os.getenv("SHARED_STATE", "local")
+    # Как часто перечитывать промпты серверов и выбор моделей, измененные другими процессами
+    SHARED_REFRESH_INTERVAL = float(os.getenv("SHARED_REFRESH_INTERVAL", "10"))
+    # Шардинг: общее число шардов (0 - определяет Discord), шарды этого процесса через запятую
+    # (пусто - все) и сколько процессов запускать на этой машине
+    SHARD_COUNT = int(os.getenv("SHARD_COUNT", "0"))
+    SHARD_IDS = [int(shard) for shard in os.getenv("SHARD_IDS", "").split(",") if shard.strip()]
+    SHARD_PROCESSES = int(os.getenv("SHARD_PROCESSES", "1"))
+    # Сколько каналов держать в памяти, остальные подгружаются с диска по требованию
+    HOT_CHANNEL_LIMIT = int(os.getenv("HOT_CHANNEL_LIMIT", "1000"))
+    STORAGE_FLUSH_INTERVAL = float(os.getenv("STORAGE_FLUSH_INTERVAL", "2"))
+    STORAGE_FLUSH_BATCH = int(os.getenv("STORAGE_FLUSH_BATCH", "500"))
+    # Какие каналы записывать в историю: "lazy" - только те, где бот участвует в беседе, "all" - все
+    CAPTURE_POLICY = os.getenv("CAPTURE_POLICY", "lazy")
+    # Сколько последних сообщений держать для неактивных каналов (0 - не держать)
+    IDLE_RING_SIZE = int(os.getenv("IDLE_RING_SIZE", "10"))
+    CAPTURE_RING_CHANNELS = int(os.getenv("CAPTURE_RING_CHANNELS", "5000"))
+    # Через сколько секунд без обращений к боту канал перестает записываться
+    CAPTURE_IDLE_SECONDS = float(os.getenv("CAPTURE_IDLE_SECONDS", "3600"))
+    # Сколько сообщений подгружать из Discord при начале беседы
+    BACKFILL_LIMIT = int(os.getenv("BACKFILL_LIMIT", "50"))
+    # Объединение одновременных упоминаний в одном канале в один запрос к Gemini.
+    # Упоминания, пришедшие пока бот отвечает в канале, и в течение BATCH_WINDOW секунд, обрабатываются вместе
+    MENTION_BATCHING = os.getenv("MENTION_BATCHING", "1") == "1"
+    BATCH_WINDOW = float(os.getenv("BATCH_WINDOW", "0"))
+    BATCH_MAX = int(os.getenv("BATCH_MAX", "5"))
+    # Потоковые ответы: сообщение появляется сразу и дополняется по мере генерации
+    STREAM_RESPONSES = os.getenv("STREAM_RESPONSES", "1") == "1"
+    # Минимальный интервал между редактированиями сообщения (лимиты Discord)
+    STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "1.2"))
+    # Длинные ответы: "split" - несколько сообщений, "file" - ответы длиннее порога уходят файлом с превью
+    LONG_RESPONSE_MODE = os.getenv("LONG_RESPONSE_MODE", "split")
+    LONG_RESPONSE_FILE_THRESHOLD = int(os.getenv("LONG_RESPONSE_FILE_THRESHOLD", "6000"))
+    # Лимиты запросов (в минуту) и размер всплеска для пользователя, сервера и всего бота
+    USER_RATE_PER_MINUTE = float(os.getenv("USER_RATE_PER_MINUTE", "6"))
+    USER_BURST = int(os.getenv("USER_BURST", "3"))
+    GUILD_RATE_PER_MINUTE = float(os.getenv("GUILD_RATE_PER_MINUTE", "30"))
+    GUILD_BURST = int(os.getenv("GUILD_BURST", "10"))
+    GLOBAL_RATE_PER_MINUTE = float(os.getenv("GLOBAL_RATE_PER_MINUTE", "60"))
+    GLOBAL_BURST = int(os.getenv("GLOBAL_BURST", "10"))
+    # Очередь ожидающих запросов; PRIORITY_WORKERS обработчиков берут только ЛС и команды
+    PRIORITY_WORKERS = int(os.getenv("PRIORITY_WORKERS", "2"))
+    QUEUE_LIMIT = int(os.getenv("QUEUE_LIMIT", "100"))
+    QUEUE_LIMIT_PER_GUILD = int(os.getenv("QUEUE_LIMIT_PER_GUILD", "20"))
+    # Повторы при ошибках квоты Gemini (429 / 503)
+    MAX_RETRIES = int(os.getenv("GEMINI_MAX_RETRIES", "3"))
+    RETRY_BASE_DELAY = float(os.getenv("GEMINI_RETRY_BASE_DELAY", "2"))
+    RETRY_MAX_DELAY = float(os.getenv("GEMINI_RETRY_MAX_DELAY", "60"))
+    # Кэш ответов на запросы без истории (выключен по умолчанию)
+    RESPONSE_CACHE = os.getenv("RESPONSE_CACHE", "0") == "1"
+    RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "1000"))
+    RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", "3600"))
+    # Файл для сохранения кэша между перезапусками, пустое значение отключает сохранение
+    RESPONSE_CACHE_PATH = os.getenv("RESPONSE_CACHE_PATH", "")
+    # Метрики в формате Prometheus на localhost, 0 отключает HTTP-эндпоинт
+    METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+    METRICS_PORT = int(os.getenv("METRICS_PORT", "9108"))
+    # Прогрев моделей и соединения с Gemini сразу после запуска
+    WARMUP = os.getenv("WARMUP", "1") == "1"
+    # Хэш последнего синхронизированного дерева слеш-команд, пустое значение - синхронизировать всегда
+    COMMAND_HASH_PATH = os.getenv("COMMAND_HASH_PATH", "command_tree.sha256")
+
+    @staticmethod
+    def get_token_budget(model_name: str) -> int:
+        """Возвращает бюджет токенов истории для модели"""
+        return Config.MODEL_TOKEN_BUDGETS.get(model_name, Config.HISTORY_TOKEN_BUDGET)
 
 # Доступные модели
 AVAILABLE_MODELS = {
@@ -32,9 +196,15 @@ AVAILABLE_MODELS = {
     "GEMINI 2.0": [
         {"name": "Gemini 2.0 Flash", "id": "models/gemini-2.0-flash", "description": "Новая улучшенная модель"},
         {"name": "Gemini 2.0 Flash-Lite", "id": "models/gemini-2.0-flash-lite", "description": "Экономичный вариант с ограничениями"}
+    ],
+    "АВТО": [
+        {"name": "Автовыбор", "id": Config.AUTO_MODEL, "description": "Быстрая модель для простых запросов, мощная для сложных"}
     ]
 }
 
+# Области, для которых можно выбрать модель (от более частной к более общей)
+MODEL_SCOPES = {"user": "для вас", "channel": "для этого канала", "guild": "для этого сервера"}
+
 # Настройки безопасности для Gemini API
 SAFETY_SETTINGS = [
     {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_NONE"},
@@ -43,106 +213,2350 @@ SAFETY_SETTINGS = [
     {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_NONE"}
 ]
 
-# Инициализация Gemini API
-genai.configure(api_key=Config.GEMINI_API_KEY)
+# Метрики: счетчики, гистограммы задержек и текущие значения
+class Metrics:
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+    def __init__(self):
+        self.counters: Dict[tuple, float] = defaultdict(float)
+        self.gauges: Dict[tuple, float] = defaultdict(float)
+        # (имя, метки) -> [счетчики по корзинам..., сумма, количество]
+        self.histograms: Dict[tuple, List[float]] = {}
+        self.callbacks: Dict[str, Any] = {}
+
+    @staticmethod
+    def _key(name: str, labels: Dict[str, Any]) -> tuple:
+        return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+    def inc(self, name: str, value: float = 1, **labels):
+        self.counters[self._key(name, labels)] += value
+
+    def add_gauge(self, name: str, value: float, **labels):
+        self.gauges[self._key(name, labels)] += value
+
+    def set_gauge(self, name: str, value: float, **labels):
+        self.gauges[self._key(name, labels)] = value
+
+    def register_gauge(self, name: str, callback):
+        """Значение вычисляется в момент выгрузки метрик"""
+        self.callbacks[name] = callback
+
+    def observe(self, name: str, value: float, **labels):
+        key = self._key(name, labels)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = [0] * len(self.BUCKETS) + [0.0, 0]
+        index = bisect_left(self.BUCKETS, value)
+        if index < len(self.BUCKETS):
+            histogram[index] += 1
+        histogram[-2] += value
+        histogram[-1] += 1
+
+    @contextmanager
+    def timer(self, name: str, **labels):
+        """Замеряет длительность блока и считает выполняющиеся в нем операции"""
+        started = time.perf_counter()
+        self.add_gauge(f"{name}_in_flight", 1, **labels)
+        try:
+            yield
+        finally:
+            self.add_gauge(f"{name}_in_flight", -1, **labels)
+            self.observe(f"{name}_seconds", time.perf_counter() - started, **labels)
+
+    def record_error(self, stage: str, error: BaseException):
+        self.inc("errors_total", stage=stage, error=type(error).__name__)
+
+    def record_usage(self, usage, model: str):
+        """Учитывает токены из usage_metadata ответа Gemini"""
+        if usage is None:
+            return
+        self.inc("gemini_prompt_tokens_total", usage.prompt_token_count, model=model)
+        self.inc("gemini_output_tokens_total", usage.candidates_token_count, model=model)
+
+    def quantile(self, name: str, q: float) -> Optional[float]:
+        """Грубая оценка квантиля по границам корзин (по всем меткам)"""
+        buckets = [0] * len(self.BUCKETS)
+        total = 0
+        for (metric, _), histogram in self.histograms.items():
+            if metric == name:
+                for i in range(len(self.BUCKETS)):
+                    buckets[i] += histogram[i]
+                total += histogram[-1]
+        if not total:
+            return None
+        seen = 0
+        for bound, count in zip(self.BUCKETS, buckets):
+            seen += count
+            if seen >= q * total:
+                return bound
+        return float("inf")
+
+    @staticmethod
+    def _labels(labels: tuple, extra: str = "") -> str:
+        parts = [f'{k}="{v}"' for k, v in labels]
+        if extra:
+            parts.append(extra)
+        return "{" + ",".join(parts) + "}" if parts else ""
+
+    def render(self) -> str:
+        """Выгружает метрики в текстовом формате Prometheus"""
+        lines = []
+        for (name, labels), value in sorted(self.counters.items()):
+            lines.append(f"gemini_bot_{name}{self._labels(labels)} {value}")
+        for (name, labels), value in sorted(self.gauges.items()):
+            lines.append(f"gemini_bot_{name}{self._labels(labels)} {value}")
+        for name, callback in sorted(self.callbacks.items()):
+            lines.append(f"gemini_bot_{name} {callback()}")
+        for (name, labels), histogram in sorted(self.histograms.items()):
+            cumulative = 0
+            for bound, count in zip(self.BUCKETS, histogram):
+                cumulative += count
+                bucket_labels = self._labels(labels, f'le="{bound}"')
+                lines.append(f"gemini_bot_{name}_bucket{bucket_labels} {cumulative}")
+            bucket_labels = self._labels(labels, 'le="+Inf"')
+            lines.append(f"gemini_bot_{name}_bucket{bucket_labels} {histogram[-1]}")
+            lines.append(f"gemini_bot_{name}_sum{self._labels(labels)} {histogram[-2]}")
+            lines.append(f"gemini_bot_{name}_count{self._labels(labels)} {histogram[-1]}")
+        return "\n".join(lines) + "\n"
+
+    async def start_server(self, host: str, port: int) -> web.AppRunner:
+        async def handle(request):
+            return web.Response(text=self.render(), content_type="text/plain")
+
+        app = web.Application()
+        app.router.add_get("/metrics", handle)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+        return runner
+
+metrics = Metrics()
+
+# Длительность этапов запуска; этапы загрузки и прогрева идут параллельно, поэтому могут перекрываться
+class StartupTimings:
+    def __init__(self):
+        self.phases: Dict[str, float] = {}
+
+    def record(self, phase: str, seconds: float):
+        self.phases[phase] = seconds
+        metrics.set_gauge("startup_phase_seconds", seconds, phase=phase)
+
+    @contextmanager
+    def phase(self, name: str):
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.record(name, time.monotonic() - started)
+
+    def summary(self) -> str:
+        return ", ".join(f"{phase} {seconds:.2f}с" for phase, seconds in self.phases.items()) or "нет данных"
+
+startup = StartupTimings()
+
+# Импорт Gemini SDK занимает больше секунды, поэтому он выполняется в потоке в начале запуска.
+# Запросы ждут его окончания, а не блокируют цикл событий синхронным импортом
+class GeminiSDK:
+    _task: Optional[asyncio.Task] = None
+
+    @staticmethod
+    def load() -> asyncio.Task:
+        task = GeminiSDK._task
+        # Неудавшийся импорт повторяется при следующем запросе
+        if task is None or (task.done() and (task.cancelled() or task.exception() is not None)):
+            GeminiSDK._task = asyncio.create_task(GeminiSDK._load())
+        return GeminiSDK._task
+
+    @staticmethod
+    async def ready():
+        # Отмена одного ожидающего запроса не должна прерывать общий импорт
+        await asyncio.shield(GeminiSDK.load())
+
+    @staticmethod
+    async def _load():
+        with startup.phase("sdk"):
+            await asyncio.to_thread(lambda: (genai.load(), protos.load(), google_exceptions.load()))
+            genai.configure(api_key=Config.GEMINI_API_KEY)
+
+# Переиспользуемые экземпляры моделей, чтобы не создавать их на каждый запрос
+class ModelRegistry:
+    MAX_MODELS = 256
+    _models: "OrderedDict[tuple, genai.GenerativeModel]" = OrderedDict()
+
+    @staticmethod
+    def get(model_name: str, system_instruction: Optional[str] = None) -> "genai.GenerativeModel":
+        key = (model_name, system_instruction)
+        model = ModelRegistry._models.get(key)
+        if model is None:
+            model = genai.GenerativeModel(
+                model_name, safety_settings=SAFETY_SETTINGS, system_instruction=system_instruction or None
+            )
+            model.registry_key = key
+            ModelRegistry._models[key] = model
+            while len(ModelRegistry._models) > ModelRegistry.MAX_MODELS:
+                ModelRegistry._models.popitem(last=False)
+        else:
+            ModelRegistry._models.move_to_end(key)
+        return model
+
+    @staticmethod
+    def invalidate(model_name: Optional[str] = None, system_instruction: Optional[str] = None):
+        """Сбрасывает закэшированные модели: все, одной модели или с одной системной инструкцией"""
+        if model_name is None and system_instruction is None:
+            ModelRegistry._models.clear()
+            return
+        for key in [
+            key for key in ModelRegistry._models
+            if (model_name is None or key[0] == model_name) and (system_instruction is None or key[1] == system_instruction)
+        ]:
+            del ModelRegistry._models[key]
+
+    @staticmethod
+    def release(prompts: Collection[str] = (), model_ids: Collection[str] = ()):
+        """Сбрасывает модели с промптами и выбранными моделями, которые больше нигде не используются.
+        Вызывается после изменения server_prompts и model_choices"""
+        used_prompts = set(server_prompts.values())
+        used_models = set(model_choices.values()) | {
+            Config.DEFAULT_MODEL, Config.FAST_MODEL, Config.STRONG_MODEL, Config.SUMMARY_MODEL
+        }
+        for prompt in prompts:
+            if prompt and prompt not in used_prompts:
+                ModelRegistry.invalidate(system_instruction=prompt)
+        for model_id in model_ids:
+            if model_id and model_id not in used_models:
+                ModelRegistry.invalidate(model_id)
+
+# Одно сообщение истории канала. Хранится компактно (__slots__), protos.Content для API
+# в записи не сохраняется: он занимал бы ~1 КБ на сообщение. Собранные protos.Content хранит окно
+# ConversationContext, и только у HISTORY_WINDOW_CACHE последних запрошенных каналов
+class HistoryRecord:
+    __slots__ = ("role", "content", "author", "timestamp")
+
+    def __init__(self, role: str, content: str, author: Optional[str] = None, timestamp: Optional[float] = None):
+        # role - "user" или "model"
+        self.role = role
+        self.content = content
+        self.author = author
+        self.timestamp = timestamp if timestamp is not None else time.time()
+
+    @property
+    def text(self) -> str:
+        """Текст для модели; сообщения пользователей подписываются автором"""
+        if self.author and self.role == "user":
+            return f"{self.author}: {self.content}"
+        return self.content
+
+    @property
+    def key(self) -> tuple:
+        """Запись, перезагруженная из хранилища, - другой объект, но с тем же ключом"""
+        return self.role, self.content, self.author, self.timestamp
+
+    def to_content(self) -> "protos.Content":
+        # Сообщение protobuf создается напрямую: конструктор proto-plus в несколько раз медленнее
+        return protos.Content.wrap(protos.Content.pb()(role=self.role, parts=[protos.Part.pb()(text=self.text)]))
+
+# Контекст канала: записи истории, бюджет токенов и краткое содержание старых сообщений
+class ConversationContext:
+    # Контексты с собранным окном истории, от давно запрошенных к недавним
+    _windows: "OrderedDict[int, ConversationContext]" = OrderedDict()
+
+    def __init__(self, max_messages: int = Config.CONTEXT_LIMIT, max_tokens: Optional[int] = None):
+        self.max_messages = max_messages
+        self.max_tokens = max_tokens or max(Config.HISTORY_TOKEN_BUDGET, *Config.MODEL_TOKEN_BUDGETS.values())
+        self._records: List[HistoryRecord] = []
+        # Накопленная сумма токенов по сообщениям, включая текущее
+        self._cumulative = array("q")
+        self._start = 0
+        # Абсолютный номер сообщения self._records[0]
+        self._offset = 0
+        self.summary = ""
+        self.summary_tokens = 0
+        self._summary_content: Optional[protos.Content] = None
+        self.last_activity = time.monotonic()
+        # Номер очистки: краткое содержание, начатое до /clear, после нее не применяется
+        self.epoch = 0
+        # Окно: protos.Content для записей, начиная с абсолютного номера _window_start.
+        # Следующий запрос достраивает только новые сообщения
+        self._window: Optional[List["protos.Content"]] = None
+        self._window_start = 0
+
+    @staticmethod
+    def estimate_tokens(text: str) -> int:
+        return len(text) // Config.CHARS_PER_TOKEN + 1
+
+    def _base(self, index: int) -> int:
+        return self._cumulative[index - 1] if index > 0 else 0
+
+    @property
+    def token_count(self) -> int:
+        if not self._cumulative:
+            return 0
+        return self._cumulative[-1] - self._base(self._start)
+
+    def __len__(self) -> int:
+        return len(self._records) - self._start
+
+    @property
+    def last_timestamp(self) -> Optional[float]:
+        return self._records[-1].timestamp if len(self) else None
+
+    def append(self, record: HistoryRecord):
+        """Добавляет сообщение и отбрасывает самые старые, если превышен лимит"""
+        if not record.content:
+            return
+        total = self._cumulative[-1] if self._cumulative else 0
+        self._records.append(record)
+        self._cumulative.append(total + self.estimate_tokens(record.text))
+        self.last_activity = time.monotonic()
+
+        while len(self) > 1 and (len(self) > self.max_messages or self.token_count > self.max_tokens):
+            self._start += 1
+
+        # Периодически освобождаем отброшенные элементы
+        if self._start > 256 and self._start * 2 > len(self._records):
+            del self._records[:self._start]
+            del self._cumulative[:self._start]
+            self._offset += self._start
+            self._start = 0
+
+    def history(self, token_budget: Optional[int] = None, exclude: Collection[HistoryRecord] = ()) -> List["protos.Content"]:
+        """Возвращает краткое содержание и последние сообщения, укладывающиеся в бюджет токенов.
+        exclude - записи текущего запроса, которые отправляются отдельно; сравниваются по ключу,
+        так как канал мог быть загружен из хранилища уже после того, как запись была добавлена"""
+        start = self._start
+        if token_budget is not None:
+            token_budget = max(token_budget - self.summary_tokens, 0)
+            if self.token_count > token_budget:
+                threshold = self._cumulative[-1] - token_budget
+                start = bisect_left(self._cumulative, threshold, lo=start) + 1
+        history = [self._summary_content] if self._summary_content is not None else []
+        contents = self._window_from(start)
+        if exclude:
+            excluded = {record.key for record in exclude}
+            history.extend(
+                content for record, content in zip(self._records[start:], contents) if record.key not in excluded
+            )
+        else:
+            history.extend(contents)
+        return history
+
+    def _window_from(self, start: int) -> List["protos.Content"]:
+        """protos.Content для self._records[start:]; собранные прошлыми запросами переиспользуются"""
+        first = self._offset + start
+        window = self._window
+        if window is None or self._window_start > first:
+            window = []
+        else:
+            del window[:first - self._window_start]
+        self._window, self._window_start = window, first
+        window.extend(record.to_content() for record in self._records[start + len(window):])
+
+        windows = ConversationContext._windows
+        windows[id(self)] = self
+        windows.move_to_end(id(self))
+        while len(windows) > Config.HISTORY_WINDOW_CACHE:
+            windows.popitem(last=False)[1]._window = None
+        return window
+
+    def drop_window(self):
+        """Освобождает собранное окно, например когда контекст вытеснен из памяти"""
+        self._window = None
+        ConversationContext._windows.pop(id(self), None)
+
+    def pending_compaction(self, keep_recent: int) -> tuple:
+        """Возвращает номер очистки, абсолютный номер конца диапазона и сообщения, которые можно свернуть"""
+        end = len(self._records) - keep_recent
+        if end <= self._start:
+            return self.epoch, None, []
+        return self.epoch, self._offset + end, self._records[self._start:end]
+
+    def apply_summary(self, summary: str, end: int, epoch: Optional[int] = None) -> bool:
+        """Заменяет свернутые сообщения кратким содержанием.
+        Возвращает False, если после начала сжатия история была очищена"""
+        if epoch is not None and epoch != self.epoch:
+            return False
+        self.summary = summary
+        self.summary_tokens = self.estimate_tokens(summary)
+        self._summary_content = protos.Content(
+            role="user", parts=[protos.Part(text=f"Краткое содержание предыдущего разговора:\n{summary}")]
+        )
+        # Пока шло сжатие, часть сообщений могла быть уже отброшена
+        self._start = min(max(self._start, end - self._offset), len(self._records))
+        return True
+
+    def clear(self):
+        self.drop_window()
+        self.epoch += 1
+        self._offset += len(self._records)
+        self._records.clear()
+        del self._cumulative[:]
+        self._start = 0
+        self.summary = ""
+        self.summary_tokens = 0
+        self._summary_content = None
+
+# Базовый интерфейс постоянного хранилища.
+# Все изменения передаются пачками операций:
+#   ("append", channel_id, HistoryRecord)
+#   ("clear", channel_id)
+#   ("summary", channel_id, summary, keep_last)
+#   ("prompt", server_id, prompt или None)
+#   ("model", scope, scope_id, model_id или None)
+class StorageBackend:
+    def load_channel(self, channel_id: int, limit: int) -> tuple:
+        """Возвращает (краткое содержание, последние сообщения) канала"""
+        raise NotImplementedError
+
+    def load_server_prompts(self) -> Dict[int, str]:
+        raise NotImplementedError
+
+    def load_model_choices(self) -> Dict[tuple, str]:
+        """Возвращает выбранные модели: (scope, scope_id) -> model_id"""
+        raise NotImplementedError
+
+    def apply(self, operations: List[tuple]):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+class MemoryStorage(StorageBackend):
+    def __init__(self):
+        self.messages: Dict[int, List[HistoryRecord]] = defaultdict(list)
+        self.summaries: Dict[int, str] = {}
+        self.prompts: Dict[int, str] = {}
+        self.models: Dict[tuple, str] = {}
+
+    def load_channel(self, channel_id: int, limit: int) -> tuple:
+        return self.summaries.get(channel_id, ""), list(self.messages.get(channel_id, [])[-limit:])
+
+    def load_server_prompts(self) -> Dict[int, str]:
+        return dict(self.prompts)
+
+    def load_model_choices(self) -> Dict[tuple, str]:
+        return dict(self.models)
+
+    def apply(self, operations: List[tuple]):
+        for op in operations:
+            if op[0] == "append":
+                _, channel_id, record = op
+                self.messages[channel_id].append(record)
+                del self.messages[channel_id][:-Config.CONTEXT_LIMIT]
+            elif op[0] == "clear":
+                self.messages.pop(op[1], None)
+                self.summaries.pop(op[1], None)
+            elif op[0] == "summary":
+                _, channel_id, summary, keep_last = op
+                self.summaries[channel_id] = summary
+                messages = self.messages[channel_id]
+                del messages[:max(len(messages) - keep_last, 0)]
+            elif op[0] == "prompt":
+                _, server_id, prompt = op
+                if prompt:
+                    self.prompts[server_id] = prompt
+                else:
+                    self.prompts.pop(server_id, None)
+            elif op[0] == "model":
+                _, scope, scope_id, model_id = op
+                if model_id:
+                    self.models[(scope, scope_id)] = model_id
+                else:
+                    self.models.pop((scope, scope_id), None)
+
+class SQLiteStorage(StorageBackend):
+    def __init__(self, path: str):
+        self._lock = threading.Lock()
+        # Файл базы может быть общим для нескольких процессов-шардов на одной машине
+        self._db = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._db.executescript("""
+            PRAGMA journal_mode=WAL;
+            PRAGMA synchronous=NORMAL;
+            CREATE TABLE IF NOT EXISTS messages (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                channel_id INTEGER NOT NULL,
+                role TEXT NOT NULL,
+                content TEXT NOT NULL,
+                author TEXT,
+                created_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS messages_channel ON messages (channel_id, id);
+            CREATE TABLE IF NOT EXISTS summaries (
+                channel_id INTEGER PRIMARY KEY,
+                summary TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS server_prompts (
+                server_id INTEGER PRIMARY KEY,
+                prompt TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS model_choices (
+                scope TEXT NOT NULL,
+                scope_id INTEGER NOT NULL,
+                model TEXT NOT NULL,
+                PRIMARY KEY (scope, scope_id)
+            );
+        """)
+        # Базы, созданные до появления авторов сообщений
+        columns = {row[1] for row in self._db.execute("PRAGMA table_info(messages)")}
+        if "author" not in columns:
+            self._db.execute("ALTER TABLE messages ADD COLUMN author TEXT")
+
+    def load_channel(self, channel_id: int, limit: int) -> tuple:
+        with self._lock:
+            row = self._db.execute("SELECT summary FROM summaries WHERE channel_id = ?", (channel_id,)).fetchone()
+            rows = self._db.execute(
+                "SELECT role, content, author, created_at FROM messages WHERE channel_id = ? ORDER BY id DESC LIMIT ?",
+                (channel_id, limit)
+            ).fetchall()
+        messages = [
+            HistoryRecord("user" if role == "user" else "model", content, author, created_at)
+            for role, content, author, created_at in reversed(rows)
+        ]
+        return (row[0] if row else ""), messages
+
+    def load_server_prompts(self) -> Dict[int, str]:
+        with self._lock:
+            return dict(self._db.execute("SELECT server_id, prompt FROM server_prompts").fetchall())
+
+    def load_model_choices(self) -> Dict[tuple, str]:
+        with self._lock:
+            rows = self._db.execute("SELECT scope, scope_id, model FROM model_choices").fetchall()
+        return {(scope, scope_id): model for scope, scope_id, model in rows}
+
+    def _keep_last(self, channel_id: int, keep_last: int):
+        self._db.execute(
+            "DELETE FROM messages WHERE channel_id = ? AND id <= "
+            "(SELECT id FROM messages WHERE channel_id = ? ORDER BY id DESC LIMIT 1 OFFSET ?)",
+            (channel_id, channel_id, keep_last)
+        )
+
+    def apply(self, operations: List[tuple]):
+        touched = set()
+        with self._lock, self._db:
+            for op in operations:
+                if op[0] == "append":
+                    _, channel_id, record = op
+                    self._db.execute(
+                        "INSERT INTO messages (channel_id, role, content, author, created_at) VALUES (?, ?, ?, ?, ?)",
+                        (channel_id, record.role, record.content, record.author, record.timestamp)
+                    )
+                    touched.add(channel_id)
+                elif op[0] == "clear":
+                    self._db.execute("DELETE FROM messages WHERE channel_id = ?", (op[1],))
+                    self._db.execute("DELETE FROM summaries WHERE channel_id = ?", (op[1],))
+                elif op[0] == "summary":
+                    _, channel_id, summary, keep_last = op
+                    self._db.execute(
+                        "INSERT OR REPLACE INTO summaries (channel_id, summary) VALUES (?, ?)",
+                        (channel_id, summary)
+                    )
+                    self._keep_last(channel_id, keep_last)
+                elif op[0] == "prompt":
+                    _, server_id, prompt = op
+                    if prompt:
+                        self._db.execute(
+                            "INSERT OR REPLACE INTO server_prompts (server_id, prompt) VALUES (?, ?)",
+                            (server_id, prompt)
+                        )
+                    else:
+                        self._db.execute("DELETE FROM server_prompts WHERE server_id = ?", (server_id,))
+                elif op[0] == "model":
+                    _, scope, scope_id, model_id = op
+                    if model_id:
+                        self._db.execute(
+                            "INSERT OR REPLACE INTO model_choices (scope, scope_id, model) VALUES (?, ?, ?)",
+                            (scope, scope_id, model_id)
+                        )
+                    else:
+                        self._db.execute(
+                            "DELETE FROM model_choices WHERE scope = ? AND scope_id = ?", (scope, scope_id)
+                        )
+            # Храним на диске не больше CONTEXT_LIMIT сообщений на канал
+            for channel_id in touched:
+                self._keep_last(channel_id, Config.CONTEXT_LIMIT)
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+# Хранилище в Redis: общее для процессов бота на разных машинах
+class RedisStorage(StorageBackend):
+    def __init__(self, url: str, prefix: str = "gemini:"):
+        if not redis.available():
+            raise RuntimeError("Для STORAGE_BACKEND=redis нужен пакет redis (pip install redis)")
+        self._db = redis.Redis.from_url(url, decode_responses=True)
+        self.prefix = prefix
+
+    def _key(self, *parts) -> str:
+        return self.prefix + ":".join(str(part) for part in parts)
+
+    def load_channel(self, channel_id: int, limit: int) -> tuple:
+        pipe = self._db.pipeline(transaction=False)
+        pipe.get(self._key("summary", channel_id))
+        pipe.lrange(self._key("messages", channel_id), -limit, -1)
+        summary, rows = pipe.execute()
+        # Сообщение хранится как JSON-список [role, content, author, timestamp]
+        return summary or "", [HistoryRecord(*json.loads(row)) for row in rows]
+
+    def load_server_prompts(self) -> Dict[int, str]:
+        return {int(server_id): prompt for server_id, prompt in self._db.hgetall(self._key("prompts")).items()}
+
+    def load_model_choices(self) -> Dict[tuple, str]:
+        choices = {}
+        for field, model in self._db.hgetall(self._key("models")).items():
+            scope, scope_id = field.split(":", 1)
+            choices[(scope, int(scope_id))] = model
+        return choices
+
+    def apply(self, operations: List[tuple]):
+        touched = set()
+        pipe = self._db.pipeline(transaction=True)
+        for op in operations:
+            if op[0] == "append":
+                _, channel_id, record = op
+                pipe.rpush(
+                    self._key("messages", channel_id),
+                    json.dumps([record.role, record.content, record.author, record.timestamp], ensure_ascii=False)
+                )
+                touched.add(channel_id)
+            elif op[0] == "clear":
+                pipe.delete(self._key("messages", op[1]), self._key("summary", op[1]))
+            elif op[0] == "summary":
+                _, channel_id, summary, keep_last = op
+                pipe.set(self._key("summary", channel_id), summary)
+                if keep_last:
+                    pipe.ltrim(self._key("messages", channel_id), -keep_last, -1)
+                else:
+                    pipe.delete(self._key("messages", channel_id))
+            elif op[0] == "prompt":
+                _, server_id, prompt = op
+                if prompt:
+                    pipe.hset(self._key("prompts"), server_id, prompt)
+                else:
+                    pipe.hdel(self._key("prompts"), server_id)
+            elif op[0] == "model":
+                _, scope, scope_id, model_id = op
+                if model_id:
+                    pipe.hset(self._key("models"), f"{scope}:{scope_id}", model_id)
+                else:
+                    pipe.hdel(self._key("models"), f"{scope}:{scope_id}")
+        for channel_id in touched:
+            pipe.ltrim(self._key("messages", channel_id), -Config.CONTEXT_LIMIT, -1)
+        pipe.execute()
+
+    def close(self):
+        self._db.close()
+
+def create_storage_backend() -> StorageBackend:
+    if Config.STORAGE_BACKEND == "memory":
+        return MemoryStorage()
+    if Config.STORAGE_BACKEND == "sqlite":
+        return SQLiteStorage(Config.DATABASE_PATH)
+    if Config.STORAGE_BACKEND == "redis":
+        return RedisStorage(Config.REDIS_URL)
+    raise ValueError(f"Неизвестное хранилище: {Config.STORAGE_BACKEND}")
+
+# Контексты каналов: горячие каналы в памяти (LRU), изменения пишутся на диск пачками в фоне
+class ConversationStore:
+    def __init__(self, backend_factory, hot_limit: int = Config.HOT_CHANNEL_LIMIT):
+        # Хранилище открывается при первом обращении, а не при импорте модуля
+        self._backend_factory = backend_factory
+        self._backend: Optional[StorageBackend] = None
+        self.hot_limit = hot_limit
+        self._hot: "OrderedDict[int, ConversationContext]" = OrderedDict()
+        # Каналы, которые сейчас подгружаются, и изменения, пришедшие во время загрузки
+        self._loading: Dict[int, tuple] = {}
+        self._pending: List[tuple] = []
+        self._flush_lock = asyncio.Lock()
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        # Растет при каждом локальном изменении промптов и выбора моделей
+        self.settings_version = 0
+
+    @property
+    def backend(self) -> StorageBackend:
+        if self._backend is None:
+            self._backend = self._backend_factory()
+        return self._backend
+
+    @backend.setter
+    def backend(self, backend: StorageBackend):
+        self._backend = backend
+
+    def peek(self, channel_id: int) -> Optional[ConversationContext]:
+        """Возвращает контекст канала, только если он уже в памяти"""
+        return self._hot.get(channel_id)
+
+    def items(self):
+        return list(self._hot.items())
+
+    def _remember(self, channel_id: int, context: ConversationContext):
+        self._hot[channel_id] = context
+        self._hot.move_to_end(channel_id)
+        while len(self._hot) > self.hot_limit:
+            self._hot.popitem(last=False)[1].drop_window()
+
+    async def get(self, channel_id: int) -> ConversationContext:
+        """Возвращает контекст канала, при необходимости загружая его с диска"""
+        context = self._hot.get(channel_id)
+        if context is not None:
+            self._hot.move_to_end(channel_id)
+            return context
+        if channel_id in self._loading:
+            return await asyncio.shield(self._loading[channel_id][0])
+
+        future = asyncio.get_running_loop().create_future()
+        buffered: List[Optional[HistoryRecord]] = []
+        self._loading[channel_id] = (future, buffered)
+        try:
+            # Запись в фоне ждет окончания загрузки: иначе сообщение из buffered, записанное во время
+            # загрузки, вернулось бы и из хранилища, и из buffered
+            async with self._flush_lock:
+                await self._write_pending()
+                summary, messages = await asyncio.to_thread(
+                    self.backend.load_channel, channel_id, Config.CONTEXT_LIMIT
+                )
+            context = ConversationContext()
+            for record in messages:
+                context.append(record)
+            if summary:
+                context.apply_summary(summary, 0)
+            # Применяем изменения, пришедшие во время загрузки (None означает очистку)
+            for record in buffered:
+                if record is None:
+                    context.clear()
+                else:
+                    context.append(record)
+            self._remember(channel_id, context)
+            future.set_result(context)
+            return context
+        except BaseException as e:
+            future.set_exception(e)
+            future.exception()
+            raise
+        finally:
+            del self._loading[channel_id]
+
+    def _queue(self, operation: tuple):
+        self._pending.append(operation)
+        if len(self._pending) >= Config.STORAGE_FLUSH_BATCH:
+            self._wakeup.set()
+
+    def append(self, channel_id: int, record: HistoryRecord):
+        """Добавляет сообщение без ожидания записи на диск"""
+        if not record.content:
+            return
+        context = self._hot.get(channel_id)
+        if context is not None:
+            context.append(record)
+        elif channel_id in self._loading:
+            self._loading[channel_id][1].append(record)
+        self._queue(("append", channel_id, record))
+
+    def clear(self, channel_id: int):
+        context = self._hot.get(channel_id)
+        if context is not None:
+            context.clear()
+        elif channel_id in self._loading:
+            self._loading[channel_id][1].append(None)
+        self._queue(("clear", channel_id))
+
+    def save_summary(self, channel_id: int, context: ConversationContext, epoch: int):
+        # Контекст мог быть вытеснен из памяти или очищен, пока шло сжатие
+        if self._hot.get(channel_id) is context and context.epoch == epoch:
+            self._queue(("summary", channel_id, context.summary, len(context)))
+
+    def set_server_prompt(self, server_id: int, prompt: Optional[str]):
+        self.settings_version += 1
+        self._queue(("prompt", server_id, prompt))
+
+    def set_model_choice(self, scope: str, scope_id: int, model_id: Optional[str]):
+        self.settings_version += 1
+        self._queue(("model", scope, scope_id, model_id))
+
+    async def flush(self):
+        """Записывает накопленные изменения на диск одной транзакцией"""
+        async with self._flush_lock:
+            await self._write_pending()
+
+    async def _write_pending(self):
+        # Вызывается под _flush_lock
+        if not self._pending:
+            return
+        operations, self._pending = self._pending, []
+        await asyncio.to_thread(self.backend.apply, operations)
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=Config.STORAGE_FLUSH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                print(f"Ошибка записи в хранилище: {e}")
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        if self._backend is None and not self._pending:
+            return
+        await self.flush()
+        await asyncio.to_thread(self._backend.close)
+        self._backend = None
 
 # Хранилище контекста сообщений для каждого канала
-channel_conversations = defaultdict(lambda: deque(maxlen=Config.CONTEXT_LIMIT))
+storage = ConversationStore(create_storage_backend)
 
-# Хранилище пользовательских промптов для серверов
+# Хранилище пользовательских промптов для серверов (загружается из storage при запуске)
 server_prompts = defaultdict(lambda: "")
 
+# Выбранные модели: (scope, scope_id) -> model_id (загружается из storage при запуске)
+model_choices: Dict[tuple, str] = {}
+
+# Синхронизация промптов и выбора моделей между процессами через общее хранилище
+class SharedSettings:
+    _task: Optional[asyncio.Task] = None
+
+    @staticmethod
+    def enabled() -> bool:
+        """Перечитывать настройки нужно, только если их могут менять другие процессы"""
+        return Config.SHARED_REFRESH_INTERVAL > 0 and (
+            Config.SHARD_COUNT > 0 or Config.SHARED_STATE != "local" or Config.STORAGE_BACKEND == "redis"
+        )
+
+    @staticmethod
+    async def refresh():
+        version = storage.settings_version
+        await storage.flush()
+        prompts = await asyncio.to_thread(storage.backend.load_server_prompts)
+        choices = await asyncio.to_thread(storage.backend.load_model_choices)
+        # Локальное изменение во время загрузки еще не записано - применим настройки в следующий раз
+        if storage.settings_version != version:
+            return
+        previous_prompts, previous_models = set(server_prompts.values()), set(model_choices.values())
+        server_prompts.clear()
+        server_prompts.update(prompts)
+        model_choices.clear()
+        model_choices.update(choices)
+        ModelRegistry.release(previous_prompts, previous_models)
+
+    @staticmethod
+    def start():
+        if SharedSettings.enabled() and (SharedSettings._task is None or SharedSettings._task.done()):
+            SharedSettings._task = asyncio.create_task(SharedSettings.run())
+
+    @staticmethod
+    async def run():
+        while True:
+            await asyncio.sleep(Config.SHARED_REFRESH_INTERVAL)
+            try:
+                await SharedSettings.refresh()
+            except Exception as e:
+                metrics.record_error("shared_settings", e)
+                print(f"Не удалось обновить общие настройки: {e}")
+
+# Политика записи истории: полностью записываются только каналы, где бот участвует в беседе
+class CapturePolicy:
+    def __init__(self):
+        # channel_id -> время последнего обращения к боту
+        self._engaged: Dict[int, float] = {}
+        # Небольшие кольцевые буферы последних сообщений неактивных каналов
+        self._rings: "OrderedDict[int, deque]" = OrderedDict()
+        # Каналы, история которых сейчас догружается: (future, сообщения, пришедшие за это время)
+        self._backfilling: Dict[int, tuple] = {}
+
+    def is_active(self, channel_id: int) -> bool:
+        if Config.CAPTURE_POLICY == "all":
+            return True
+        engaged = self._engaged.get(channel_id)
+        if engaged is None:
+            return False
+        if time.monotonic() - engaged > Config.CAPTURE_IDLE_SECONDS:
+            del self._engaged[channel_id]
+            return False
+        return True
+
+    def observe(self, channel_id: int, record: HistoryRecord):
+        """Сохраняет сообщение в историю активного канала или в кольцевой буфер неактивного"""
+        if channel_id in self._backfilling:
+            # Новые сообщения записываются после догруженных старых
+            self._backfilling[channel_id][1].append(record)
+            return
+        if self.is_active(channel_id):
+            storage.append(channel_id, record)
+            return
+        if Config.IDLE_RING_SIZE <= 0 or not record.content:
+            return
+        ring = self._rings.get(channel_id)
+        if ring is None:
+            ring = self._rings[channel_id] = deque(maxlen=Config.IDLE_RING_SIZE)
+            while len(self._rings) > Config.CAPTURE_RING_CHANNELS:
+                self._rings.popitem(last=False)
+        else:
+            self._rings.move_to_end(channel_id)
+        ring.append(record)
+
+    async def engage(self, channel: discord.abc.Messageable, before: Optional[discord.Message] = None,
+                     record: Optional[HistoryRecord] = None):
+        """Вызывается при обращении к боту: включает запись канала, при необходимости подгружает историю
+        и сохраняет record - запись самого обращения - после нее"""
+        channel_id = channel.id
+        loading = self._backfilling.get(channel_id)
+        if loading is not None:
+            # История уже догружается: обращение записывается после нее, как и другие новые сообщения
+            self._engaged[channel_id] = time.monotonic()
+            if record is not None:
+                loading[1].append(record)
+            await asyncio.shield(loading[0])
+            return
+        was_active = self.is_active(channel_id)
+        self._engaged[channel_id] = time.monotonic()
+        if was_active:
+            if record is not None:
+                storage.append(channel_id, record)
+            return
+
+        # Удаляем устаревшие отметки, чтобы словарь не рос вместе с числом каналов
+        if len(self._engaged) > Config.CAPTURE_RING_CHANNELS:
+            for stale in [cid for cid in list(self._engaged) if not self.is_active(cid)]:
+                self._engaged.pop(stale, None)
+
+        ring = self._rings.pop(channel_id, None)
+        future = asyncio.get_running_loop().create_future()
+        buffered: List[HistoryRecord] = [record] if record is not None else []
+        self._backfilling[channel_id] = (future, buffered)
+        try:
+            if Config.BACKFILL_LIMIT <= 0 or not await self.backfill(channel, before):
+                # Без доступа к истории Discord используем то, что успели запомнить
+                for old in ring or ():
+                    storage.append(channel_id, old)
+        finally:
+            del self._backfilling[channel_id]
+            for new in buffered:
+                storage.append(channel_id, new)
+            future.set_result(None)
+
+    async def backfill(self, channel: discord.abc.Messageable, before: Optional[discord.Message]) -> bool:
+        """Догружает из Discord сообщения, пропущенные, пока канал не записывался"""
+        context = await storage.get(channel.id)
+        after = None
+        if context.last_timestamp is not None:
+            after = datetime.datetime.fromtimestamp(context.last_timestamp, tz=datetime.timezone.utc)
+        records = []
+        try:
+            async for message in channel.history(limit=Config.BACKFILL_LIMIT, before=before, after=after, oldest_first=False):
+                if message.author == bot.user:
+                    records.append(HistoryRecord("model", message.content, None, message.created_at.timestamp()))
+                elif not message.author.bot and not message.content.startswith(bot.command_prefix):
+                    records.append(HistoryRecord(
+                        "user", message.clean_content, message.author.display_name, message.created_at.timestamp()
+                    ))
+        except (discord.Forbidden, discord.HTTPException) as e:
+            metrics.record_error("backfill", e)
+            print(f"Не удалось загрузить историю канала {channel.id}: {e}")
+            return False
+        for record in reversed(records):
+            storage.append(channel.id, record)
+        metrics.inc("history_backfill_messages_total", len(records))
+        return True
+
+capture = CapturePolicy()
+
 # Настройка бота
 intents = discord.Intents.default()
 intents.message_content = True
 intents.members = True
-bot = commands.Bot(command_prefix='!', intents=intents, help_command=None)
+
+# AutoShardedBot: один процесс может обслуживать несколько шардов, шарды делятся между процессами
+class GeminiBot(commands.AutoShardedBot):
+    async def setup_hook(self):
+        # Ключ API и хранилище настраиваются при запуске, импорт модуля ничего не подключает.
+        # Gemini SDK импортируется в фоне, сохраненное состояние загружается параллельно
+        GeminiSDK.load()
+        self.metrics_runner = None
+        with startup.phase("preload"):
+            await asyncio.gather(self.load_settings(), self.load_response_cache(), self.start_metrics())
+        storage.start()
+        SharedSettings.start()
+        self.connect_started = time.monotonic()
+        self.warmup_task = asyncio.create_task(warm_up())
+
+    async def load_settings(self):
+        with startup.phase("settings"):
+            await SharedSettings.refresh()
+
+    async def load_response_cache(self):
+        if Config.RESPONSE_CACHE:
+            with startup.phase("response_cache"):
+                await asyncio.to_thread(response_cache.load, Config.RESPONSE_CACHE_PATH)
+
+    async def start_metrics(self):
+        if Config.METRICS_PORT:
+            try:
+                self.metrics_runner = await metrics.start_server(Config.METRICS_HOST, Config.METRICS_PORT)
+            except OSError as e:
+                print(f"Не удалось запустить эндпоинт метрик: {e}")
+
+    async def close(self):
+        if getattr(self, "warmup_task", None) is not None:
+            self.warmup_task.cancel()
+        if Config.RESPONSE_CACHE:
+            await asyncio.to_thread(response_cache.save, Config.RESPONSE_CACHE_PATH)
+        await storage.close()
+        await shared_state.close()
+        await AttachmentFetcher.close()
+        if getattr(self, "metrics_runner", None) is not None:
+            await self.metrics_runner.cleanup()
+        await super().close()
+
+# Статус передается при подключении, отдельный запрос после готовности не нужен
+bot = GeminiBot(
+    command_prefix='!', intents=intents, help_command=None,
+    shard_count=Config.SHARD_COUNT or None, shard_ids=Config.SHARD_IDS or None,
+    activity=discord.Activity(type=discord.ActivityType.listening, name="ваши сообщения | !help")
+)
+
+# Загрузка вложений-изображений
+class AttachmentRejected(Exception):
+    """Вложение не принято; текст исключения - причина, которую можно показать пользователю"""
+
+class AttachmentFetcher:
+    CHUNK_SIZE = 64 * 1024
+    # Сигнатуры форматов, которые понимает Gemini
+    SIGNATURES = [
+        (b"\x89PNG\r\n\x1a\n", "image/png"),
+        (b"\xff\xd8\xff", "image/jpeg"),
+        (b"GIF87a", "image/gif"),
+        (b"GIF89a", "image/gif"),
+    ]
+    _session: Optional[aiohttp.ClientSession] = None
+
+    @staticmethod
+    def get_session() -> aiohttp.ClientSession:
+        """Возвращает общую HTTP-сессию с пулом соединений"""
+        if AttachmentFetcher._session is None or AttachmentFetcher._session.closed:
+            AttachmentFetcher._session = aiohttp.ClientSession(
+                timeout=aiohttp.ClientTimeout(total=Config.IMAGE_DOWNLOAD_TIMEOUT),
+                connector=aiohttp.TCPConnector(limit=32)
+            )
+        return AttachmentFetcher._session
+
+    @staticmethod
+    async def close():
+        if AttachmentFetcher._session is not None and not AttachmentFetcher._session.closed:
+            await AttachmentFetcher._session.close()
+
+    @staticmethod
+    def detect_mime_type(data: bytes, fallback: Optional[str] = None) -> Optional[str]:
+        """Определяет MIME-тип изображения по первым байтам"""
+        for signature, mime_type in AttachmentFetcher.SIGNATURES:
+            if data.startswith(signature):
+                return mime_type
+        if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+            return "image/webp"
+        if data[4:12] in (b"ftypheic", b"ftypheix", b"ftypmif1"):
+            return "image/heic"
+        if fallback and fallback.startswith("image/"):
+            return fallback.split(";")[0]
+        return None
+
+    @staticmethod
+    def shrink_image(data: bytes) -> tuple:
+        """Уменьшает и пережимает слишком большое изображение в JPEG"""
+        with Image.open(io.BytesIO(data)) as img:
+            img.thumbnail((Config.IMAGE_MAX_SIDE, Config.IMAGE_MAX_SIDE))
+            if img.mode not in ("RGB", "L"):
+                img = img.convert("RGB")
+            output = io.BytesIO()
+            img.save(output, format="JPEG", quality=85, optimize=True)
+        return output.getvalue(), "image/jpeg"
+
+    @staticmethod
+    async def fetch_one(url: str) -> Optional[Dict[str, Any]]:
+        """Скачивает одно изображение потоково с ограничением размера; бросает AttachmentRejected"""
+        too_large = f"размер больше {Config.MAX_IMAGE_BYTES / 2**20:.0f} МБ"
+        session = AttachmentFetcher.get_session()
+        async with session.get(url) as response:
+            if response.status != 200:
+                raise AttachmentRejected(f"не удалось загрузить (HTTP {response.status})")
+            if response.content_length and response.content_length > Config.MAX_IMAGE_BYTES:
+                raise AttachmentRejected(too_large)
+
+            buffer = bytearray()
+            async for chunk in response.content.iter_chunked(AttachmentFetcher.CHUNK_SIZE):
+                buffer.extend(chunk)
+                if len(buffer) > Config.MAX_IMAGE_BYTES:
+                    raise AttachmentRejected(too_large)
+            content_type = response.headers.get("Content-Type")
+
+        data = bytes(buffer)
+        metrics.inc("attachment_bytes_total", len(data))
+        mime_type = AttachmentFetcher.detect_mime_type(data, content_type)
+        if mime_type is None:
+            raise AttachmentRejected("формат не поддерживается (нужен PNG, JPEG, GIF, WEBP или HEIC)")
+
+        if Image is not None and len(data) > Config.IMAGE_REENCODE_BYTES:
+            try:
+                data, mime_type = await asyncio.to_thread(AttachmentFetcher.shrink_image, data)
+            except Exception as e:
+                print(f"Не удалось пережать изображение: {e}")
+
+        return {"inline_data": {"mime_type": mime_type, "data": data}}
+
+    @staticmethod
+    async def fetch_all(urls: List[str]) -> tuple:
+        """Параллельно скачивает все изображения сообщения.
+        Возвращает (части запроса, текст для пользователя о непринятых вложениях или "")"""
+        with metrics.timer("attachment_fetch"):
+            results = await asyncio.gather(
+                *(AttachmentFetcher.fetch_one(url) for url in urls),
+                return_exceptions=True
+            )
+        parts, rejected = [], []
+        for url, result in zip(urls, results):
+            if isinstance(result, Exception):
+                metrics.record_error("attachment", result)
+                print(f"Ошибка при загрузке изображения {url}: {result!r}")
+                reason = str(result) if isinstance(result, AttachmentRejected) else "не удалось загрузить"
+                name = url.split("?", 1)[0].rsplit("/", 1)[-1]
+                rejected.append(f"⚠️ Вложение {name} не принято: {reason}.")
+            else:
+                parts.append(result)
+        return parts, "\n".join(rejected)
+
+# Ограничение частоты запросов
+class TokenBucket:
+    def __init__(self, rate_per_minute: float, capacity: int):
+        self.rate = rate_per_minute / 60
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def set_rate(self, rate_per_minute: float):
+        if rate_per_minute / 60 != self.rate:
+            self._refill()
+            self.rate = rate_per_minute / 60
+
+    def available(self) -> bool:
+        self._refill()
+        return self.tokens >= 1
+
+    def consume(self):
+        self._refill()
+        self.tokens -= 1
+
+    def retry_after(self) -> float:
+        """Через сколько секунд появится следующий токен"""
+        self._refill()
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+    @property
+    def full(self) -> bool:
+        self._refill()
+        return self.tokens >= self.capacity
+
+# Состояние, общее для всех процессов бота: корзины лимитов запросов и кэш ответов.
+# История, промпты и выбор моделей общие через StorageBackend (sqlite на одной машине или redis)
+class SharedState:
+    async def take_tokens(self, buckets: List[tuple]) -> Optional[tuple]:
+        """buckets - [(ключ, запросов в минуту, размер всплеска)]. Забирает по токену из каждой корзины,
+        только если токены есть во всех; иначе возвращает (ключ пустой корзины, через сколько секунд повторить)"""
+        raise NotImplementedError
+
+    async def cache_get(self, key: str) -> Optional[str]:
+        return None
+
+    async def cache_set(self, key: str, text: str, ttl: float):
+        pass
+
+    async def close(self):
+        pass
+
+# Состояние внутри одного процесса; кэш ответов процесса - сам ResponseCache
+class LocalState(SharedState):
+    def __init__(self):
+        self._buckets: Dict[str, TokenBucket] = {}
+
+    def _bucket(self, key: str, rate: float, burst: int) -> TokenBucket:
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            if len(self._buckets) > 10000:
+                # Полные корзины ничем не отличаются от новых, их можно забыть
+                for stale in [k for k, b in self._buckets.items() if b.full]:
+                    del self._buckets[stale]
+            bucket = self._buckets[key] = TokenBucket(rate, burst)
+        else:
+            bucket.set_rate(rate)
+        return bucket
+
+    async def take_tokens(self, buckets: List[tuple]) -> Optional[tuple]:
+        resolved = [(key, self._bucket(key, rate, burst)) for key, rate, burst in buckets]
+        for key, bucket in resolved:
+            if not bucket.available():
+                return key, bucket.retry_after()
+        for _, bucket in resolved:
+            bucket.consume()
+        return None
+
+# Состояние в Redis, общее для процессов на разных машинах.
+# При недоступности Redis лимиты не применяются, а кэш пропускается, чтобы бот продолжал отвечать
+class RedisState(SharedState):
+    # Все корзины проверяются и списываются атомарно одним скриптом
+    TAKE_SCRIPT = """
+    local now = tonumber(ARGV[1])
+    local levels = {}
+    for i, key in ipairs(KEYS) do
+        local rate, capacity = tonumber(ARGV[i * 2]), tonumber(ARGV[i * 2 + 1])
+        local state = redis.call('HMGET', key, 'tokens', 'updated')
+        local tokens = tonumber(state[1]) or capacity
+        local updated = tonumber(state[2]) or now
+        tokens = math.min(capacity, tokens + math.max(0, now - updated) * rate)
+        if tokens < 1 then
+            return {i, tostring((1 - tokens) / rate)}
+        end
+        levels[i] = tokens
+    end
+    for i, key in ipairs(KEYS) do
+        local rate, capacity = tonumber(ARGV[i * 2]), tonumber(ARGV[i * 2 + 1])
+        redis.call('HSET', key, 'tokens', tostring(levels[i] - 1), 'updated', tostring(now))
+        redis.call('EXPIRE', key, math.ceil(capacity / rate) + 60)
+    end
+    return {0, '0'}
+    """
+
+    def __init__(self, url: str, prefix: str = "gemini:"):
+        if not aioredis.available():
+            raise RuntimeError("Для SHARED_STATE=redis нужен пакет redis (pip install redis)")
+        self._db = aioredis.from_url(url, decode_responses=True)
+        self._take = self._db.register_script(self.TAKE_SCRIPT)
+        self.prefix = prefix
+
+    async def take_tokens(self, buckets: List[tuple]) -> Optional[tuple]:
+        keys = [f"{self.prefix}bucket:{key}" for key, _, _ in buckets]
+        args = [time.time()]
+        for _, rate, burst in buckets:
+            args += [rate / 60, burst]
+        try:
+            index, retry_after = await self._take(keys=keys, args=args)
+        except redis.RedisError as e:
+            metrics.record_error("shared_state", e)
+            return None
+        if int(index) == 0:
+            return None
+        return buckets[int(index) - 1][0], float(retry_after)
+
+    async def cache_get(self, key: str) -> Optional[str]:
+        try:
+            return await self._db.get(f"{self.prefix}cache:{key}")
+        except redis.RedisError as e:
+            metrics.record_error("shared_state", e)
+            return None
+
+    async def cache_set(self, key: str, text: str, ttl: float):
+        try:
+            await self._db.set(f"{self.prefix}cache:{key}", text, ex=max(1, int(ttl)))
+        except redis.RedisError as e:
+            metrics.record_error("shared_state", e)
+
+    async def close(self):
+        await self._db.aclose()
+
+def create_shared_state() -> SharedState:
+    if Config.SHARED_STATE == "local":
+        return LocalState()
+    if Config.SHARED_STATE == "redis":
+        return RedisState(Config.REDIS_URL)
+    raise ValueError(f"Неизвестное общее состояние: {Config.SHARED_STATE}")
+
+shared_state = create_shared_state()
+
+class SchedulerRejected(Exception):
+    """Запрос отклонен планировщиком; текст исключения можно показать пользователю"""
+
+class _Job:
+    __slots__ = ("factory", "future")
+
+    def __init__(self, factory):
+        self.factory = factory
+        self.future = asyncio.get_running_loop().create_future()
+
+# Планировщик запросов к Gemini: лимиты, очередь с честной очередностью серверов и отступ при 429
+class RequestScheduler:
+    def __init__(self):
+        # Глобальный темп (запросов в минуту), снижается при ошибках квоты
+        self.global_rate = Config.GLOBAL_RATE_PER_MINUTE
+        # Очереди по серверам (ЛС группируются по пользователю), обходятся по кругу.
+        # Две полосы: приоритетная (ЛС и команды) обслуживается первой и имеет свои обработчики
+        self._lanes: Dict[bool, "OrderedDict[tuple, deque]"] = {True: OrderedDict(), False: OrderedDict()}
+        self._queued = {True: 0, False: 0}
+        # Будит все ожидающие обработчики: обработчики приоритетной полосы не берут обычные задачи
+        self._ready = asyncio.Event()
+        self._workers: List[asyncio.Task] = []
+        self._priority_workers: List[asyncio.Task] = []
+        self._busy = 0
+        self.backoff = 0.0
+        self.paused_until = 0.0
+
+    @property
+    def queue_depth(self) -> int:
+        return self._queued[True] + self._queued[False]
+
+    @staticmethod
+    def _queue_key(user_id: int, guild_id: Optional[int]) -> tuple:
+        return ("guild", guild_id) if guild_id is not None else ("user", user_id)
+
+    async def admit(self, user_id: int, guild_id: Optional[int], priority: bool = False):
+        """Проверяет лимиты очереди и забирает токены пользователя и сервера, иначе бросает SchedulerRejected"""
+        queue = self._lanes[priority].get(self._queue_key(user_id, guild_id))
+        if self.queue_depth >= Config.QUEUE_LIMIT or (queue and len(queue) >= Config.QUEUE_LIMIT_PER_GUILD):
+            raise SchedulerRejected("Бот сейчас перегружен, попробуйте позже.")
+
+        buckets = [(f"user:{user_id}", Config.USER_RATE_PER_MINUTE, Config.USER_BURST)]
+        if guild_id is not None:
+            buckets.append((f"guild:{guild_id}", Config.GUILD_RATE_PER_MINUTE, Config.GUILD_BURST))
+        limited = await shared_state.take_tokens(buckets)
+        if limited is not None:
+            bucket_key, retry_after = limited
+            if bucket_key.startswith("user:"):
+                raise SchedulerRejected(f"Слишком много запросов. Попробуйте снова через {retry_after:.0f} сек.")
+            raise SchedulerRejected(
+                f"Лимит запросов для этого сервера исчерпан. Попробуйте снова через {retry_after:.0f} сек."
+            )
+
+    async def submit(self, user_id: int, guild_id: Optional[int], factory, priority: bool = False,
+                     admitted: bool = False) -> tuple:
+        """Ставит задачу в очередь. Возвращает (future, позиция в очереди) или бросает SchedulerRejected.
+        admitted - лимиты уже проверены через admit (например, для каждого участника пачки упоминаний)"""
+        if not admitted:
+            await self.admit(user_id, guild_id, priority)
+        self._start_workers()
+        job = _Job(factory)
+        key = self._queue_key(user_id, guild_id)
+        lane = self._lanes[priority]
+        queue = lane.get(key)
+        if queue is None:
+            queue = lane[key] = deque()
+        queue.append(job)
+        self._queued[priority] += 1
+        # Сколько задач (включая эту) будут ждать свободного обработчика
+        ahead = self._queued[True] + (0 if priority else self._queued[False])
+        position = max(0, ahead - (len(self._workers) + len(self._priority_workers) - self._busy))
+        self._ready.set()
+        return job.future, position
+
+    async def run(self, user_id: int, guild_id: Optional[int], factory, priority: bool = False):
+        future, _ = await self.submit(user_id, guild_id, factory, priority)
+        return await future
+
+    def _start_workers(self):
+        reserved = min(Config.PRIORITY_WORKERS, Config.MAX_CONCURRENT_REQUESTS - 1)
+        self._workers = [worker for worker in self._workers if not worker.done()]
+        self._priority_workers = [worker for worker in self._priority_workers if not worker.done()]
+        while len(self._priority_workers) < reserved:
+            self._priority_workers.append(asyncio.create_task(self._worker(priority_only=True)))
+        while len(self._workers) < Config.MAX_CONCURRENT_REQUESTS - reserved:
+            self._workers.append(asyncio.create_task(self._worker()))
+
+    async def _next_job(self, priority_only: bool = False) -> _Job:
+        # Между проверкой очереди и взятием задачи нет await, поэтому блокировка не нужна
+        while not (self._queued[True] > 0 or (not priority_only and self._queued[False] > 0)):
+            self._ready.clear()
+            await self._ready.wait()
+        priority = self._queued[True] > 0
+        lane = self._lanes[priority]
+        key, queue = lane.popitem(last=False)
+        job = queue.popleft()
+        if queue:
+            # Сервер с оставшимися запросами встает в конец круга
+            lane[key] = queue
+        self._queued[priority] -= 1
+        self._busy += 1
+        return job
+
+    async def wait_for_capacity(self):
+        """Ждет окончания паузы после ошибок квоты и свободного глобального токена"""
+        while True:
+            delay = self.paused_until - time.monotonic()
+            if delay <= 0:
+                limited = await shared_state.take_tokens([("global", self.global_rate, Config.GLOBAL_BURST)])
+                if limited is None:
+                    return
+                delay = limited[1]
+            await asyncio.sleep(delay)
+
+    async def _worker(self, priority_only: bool = False):
+        while True:
+            job = await self._next_job(priority_only)
+            try:
+                if job.future.cancelled():
+                    continue
+                await self.wait_for_capacity()
+                result = await job.factory()
+            except asyncio.CancelledError:
+                job.future.cancel()
+                # Отмена внутри самой задачи не должна останавливать обработчик
+                if asyncio.current_task().cancelling():
+                    raise
+            except Exception as e:
+                if not job.future.done():
+                    job.future.set_exception(e)
+            else:
+                if not job.future.done():
+                    job.future.set_result(result)
+            finally:
+                self._busy -= 1
+
+    def report_overload(self) -> float:
+        """Учитывает 429/503 от Gemini: замедляет глобальный темп и ставит паузу. Возвращает паузу"""
+        self.backoff = min(max(self.backoff * 2, Config.RETRY_BASE_DELAY), Config.RETRY_MAX_DELAY)
+        delay = self.backoff * random.uniform(0.5, 1.0)
+        self.paused_until = max(self.paused_until, time.monotonic() + delay)
+        self.global_rate = max(self.global_rate / 2, Config.GLOBAL_RATE_PER_MINUTE / 16)
+        return delay
+
+    def report_success(self):
+        self.backoff = 0.0
+        self.global_rate = min(Config.GLOBAL_RATE_PER_MINUTE, self.global_rate + Config.GLOBAL_RATE_PER_MINUTE / 20)
+
+scheduler = RequestScheduler()
+metrics.register_gauge("queue_depth", lambda: scheduler.queue_depth)
+metrics.register_gauge("scheduler_busy_workers", lambda: scheduler._busy)
+
+# Кэш ответов для повторяющихся запросов без контекста
+class ResponseCache:
+    def __init__(self, max_size: int = Config.RESPONSE_CACHE_SIZE, ttl: float = Config.RESPONSE_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        # ключ -> (время истечения, текст ответа)
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(model_name: str, server_prompt: str, prompt: str, image_parts: List[Dict[str, Any]]) -> str:
+        """Ключ из модели, промпта сервера, нормализованного текста и хэшей изображений"""
+        digest = hashlib.sha256()
+        normalized = " ".join(prompt.lower().split())
+        for value in (model_name, server_prompt, normalized):
+            digest.update(value.encode("utf-8"))
+            digest.update(b"\0")
+        for part in image_parts:
+            digest.update(hashlib.sha256(part["inline_data"]["data"]).digest())
+        return digest.hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        entry = self._entries.get(key)
+        if entry is None or entry[0] < time.time():
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key: str, text: str):
+        self._entries[key] = (time.time() + self.ttl, text)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    async def fetch(self, key: str) -> Optional[str]:
+        """Ищет ответ в кэше процесса, затем в общем кэше всех процессов"""
+        text = self.get(key)
+        if text is None:
+            text = await shared_state.cache_get(key)
+            if text is not None:
+                self.misses -= 1
+                self.hits += 1
+                self.put(key, text)
+        return text
+
+    async def store(self, key: str, text: str):
+        self.put(key, text)
+        await shared_state.cache_set(key, text, self.ttl)
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0
+        }
+
+    def load(self, path: str):
+        if not path or not os.path.exists(path):
+            return
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                entries = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"Не удалось загрузить кэш ответов: {e}")
+            return
+        now = time.time()
+        for key, expires_at, text in entries:
+            if expires_at > now:
+                self._entries[key] = (expires_at, text)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def save(self, path: str):
+        if not path:
+            return
+        entries = [[key, expires_at, text] for key, (expires_at, text) in self._entries.items()]
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(entries, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+response_cache = ResponseCache()
+metrics.register_gauge("response_cache_size", lambda: response_cache.stats()["size"])
+metrics.register_gauge("response_cache_hits", lambda: response_cache.hits)
+metrics.register_gauge("response_cache_misses", lambda: response_cache.misses)
+metrics.register_gauge("hot_channels", lambda: len(storage.items()))
+
+# Предохранитель модели: закрыт - запросы идут, открыт - модель не вызывается,
+# полуоткрыт - после паузы пропускается один пробный запрос
+class CircuitBreaker:
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(self):
+        self.state = CircuitBreaker.CLOSED
+        self.failures = 0
+        self.cooldown = Config.MODEL_COOLDOWN
+        self.opened_until = 0.0
+        self.probing = False
+
+    def allow(self) -> bool:
+        if self.state == CircuitBreaker.OPEN and time.monotonic() >= self.opened_until:
+            self.state, self.probing = CircuitBreaker.HALF_OPEN, False
+        if self.state == CircuitBreaker.HALF_OPEN:
+            return not self.probing
+        return self.state == CircuitBreaker.CLOSED
+
+    def begin(self):
+        """Отмечает начало запроса; в полуоткрытом состоянии это единственная проба"""
+        if self.state == CircuitBreaker.HALF_OPEN:
+            self.probing = True
+
+    def retry_after(self) -> float:
+        return max(0.0, self.opened_until - time.monotonic())
+
+    def success(self):
+        self.state, self.failures, self.probing = CircuitBreaker.CLOSED, 0, False
+        self.cooldown = Config.MODEL_COOLDOWN
+
+    def failure(self, trip: bool = False):
+        self.failures += 1
+        if trip or self.state == CircuitBreaker.HALF_OPEN or self.failures >= Config.BREAKER_FAILURES:
+            self.open()
+
+    def open(self):
+        # Неудачная проба удваивает паузу
+        if self.state == CircuitBreaker.HALF_OPEN:
+            self.cooldown = min(self.cooldown * 2, Config.MAX_MODEL_COOLDOWN)
+        self.state, self.probing = CircuitBreaker.OPEN, False
+        self.opened_until = time.monotonic() + self.cooldown
+
+class CircuitOpenError(Exception):
+    """Все подходящие модели недоступны; retry_after - через сколько секунд будет проба"""
+    def __init__(self, model_id: str, retry_after: float):
+        super().__init__(f"{model_id} временно недоступна")
+        self.model_id = model_id
+        self.retry_after = retry_after
+
+# Выбор модели для запроса: настройки пользователя/канала/сервера, автовыбор и замена недоступных моделей
+class ModelRouter:
+    CODE_MARKERS = ("```", "def ", "class ", "function ", "import ", "#include", "код", "code", "ошибк", "traceback")
+    # model_id -> предохранитель модели
+    _breakers: Dict[str, CircuitBreaker] = {}
+    # model_id -> сглаженная задержка ответа
+    _latency: Dict[str, float] = {}
+
+    @staticmethod
+    def preferred_model(user_id: Optional[int], channel_id: int, server_id: Optional[int]) -> str:
+        for key in (("user", user_id), ("channel", channel_id), ("guild", server_id)):
+            if key[1] is not None and key in model_choices:
+                return model_choices[key]
+        return Config.DEFAULT_MODEL
+
+    @staticmethod
+    def set_choice(scope: str, scope_id: int, model_id: Optional[str]):
+        previous = model_choices.get((scope, scope_id))
+        if model_id:
+            model_choices[(scope, scope_id)] = model_id
+        else:
+            model_choices.pop((scope, scope_id), None)
+        storage.set_model_choice(scope, scope_id, model_id)
+        ModelRegistry.release(model_ids=[previous] if previous != model_id else [])
+
+    @staticmethod
+    def auto_model(prompt: str, image_count: int) -> str:
+        """Простые запросы отправляются быстрой модели, длинные, с изображениями или кодом - мощной"""
+        lowered = prompt.lower()
+        if image_count > 1 or len(prompt) > Config.AUTO_LONG_PROMPT or any(m in lowered for m in ModelRouter.CODE_MARKERS):
+            return Config.STRONG_MODEL
+        if image_count == 0 and len(prompt) <= Config.AUTO_SHORT_PROMPT:
+            return Config.FAST_MODEL
+        return Config.DEFAULT_MODEL if Config.DEFAULT_MODEL != Config.AUTO_MODEL else "models/gemini-2.0-flash"
+
+    @staticmethod
+    def breaker(model_id: str) -> CircuitBreaker:
+        breaker = ModelRouter._breakers.get(model_id)
+        if breaker is None:
+            breaker = ModelRouter._breakers[model_id] = CircuitBreaker()
+        return breaker
+
+    @staticmethod
+    def available(model_id: str) -> bool:
+        return ModelRouter.breaker(model_id).allow()
+
+    @staticmethod
+    def fallback_for(model_id: str) -> Optional[str]:
+        """Ближайшая доступная более быстрая модель"""
+        fallback = Config.MODEL_FALLBACKS.get(model_id)
+        seen = {model_id}
+        while fallback and fallback not in seen:
+            if ModelRouter.available(fallback):
+                return fallback
+            seen.add(fallback)
+            fallback = Config.MODEL_FALLBACKS.get(fallback)
+        return None
+
+    @staticmethod
+    def resolve(prompt: str, channel_id: int, server_id: Optional[int], user_id: Optional[int], image_count: int) -> str:
+        model_id = ModelRouter.preferred_model(user_id, channel_id, server_id)
+        if model_id == Config.AUTO_MODEL:
+            model_id = ModelRouter.auto_model(prompt, image_count)
+        if not ModelRouter.available(model_id):
+            model_id = ModelRouter.fallback_for(model_id) or model_id
+        return model_id
+
+    @staticmethod
+    def mark_overloaded(model_id: str):
+        ModelRouter.breaker(model_id).failure(trip=True)
+
+    @staticmethod
+    def status() -> List[str]:
+        """Состояние предохранителей моделей, к которым были запросы"""
+        lines = []
+        for model_id, breaker in sorted(ModelRouter._breakers.items()):
+            breaker.allow()
+            if breaker.state == CircuitBreaker.OPEN:
+                state = f"открыт, проба через {breaker.retry_after():.0f}с"
+            elif breaker.state == CircuitBreaker.HALF_OPEN:
+                state = "полуоткрыт, идет проба" if breaker.probing else "полуоткрыт, ждет пробу"
+            else:
+                state = f"закрыт, ошибок подряд: {breaker.failures}"
+            lines.append(f"`{model_id.removeprefix('models/')}`: {state}")
+        return lines
+
+    @staticmethod
+    def record_latency(model_id: str, seconds: float):
+        """Обновляет сглаженную задержку; слишком медленная модель временно заменяется"""
+        previous = ModelRouter._latency.get(model_id)
+        latency = seconds if previous is None else previous * 0.8 + seconds * 0.2
+        if latency > Config.SLOW_MODEL_SECONDS and Config.MODEL_FALLBACKS.get(model_id):
+            ModelRouter.mark_overloaded(model_id)
+            ModelRouter._latency.pop(model_id, None)
+        else:
+            ModelRouter._latency[model_id] = latency
 
 # Класс для работы с Gemini API
 class GeminiClient:
+    _semaphore: Optional[asyncio.Semaphore] = None
+
+    @staticmethod
+    def get_semaphore() -> asyncio.Semaphore:
+        """Возвращает семафор, ограничивающий число одновременных запросов"""
+        if GeminiClient._semaphore is None:
+            GeminiClient._semaphore = asyncio.Semaphore(Config.MAX_CONCURRENT_REQUESTS)
+        return GeminiClient._semaphore
+
+    @staticmethod
+    async def start_request(model, history: List["protos.Content"], contents, stream: bool = False):
+        """Отправляет запрос, при перегрузке переключаясь на более быструю модель или повторяя его
+        с растущей паузой. Возвращает (ответ, модель, которая его дала).
+        Бросает CircuitOpenError, если ни одна подходящая модель сейчас не принимает запросы"""
+        attempt = 0
+        while True:
+            breaker = ModelRouter.breaker(model.model_name)
+            if not breaker.allow():
+                fallback = ModelRouter.fallback_for(model.model_name)
+                if fallback is None:
+                    metrics.inc("circuit_rejected_total", model=model.model_name)
+                    raise CircuitOpenError(model.model_name, breaker.retry_after())
+                model = ModelRegistry.get(fallback, model.registry_key[1])
+                continue
+            breaker.begin()
+            if history:
+                chat = model.start_chat(history=history)
+                coro = chat.send_message_async(contents, stream=stream)
+            else:
+                coro = model.generate_content_async(contents, stream=stream)
+            started = time.monotonic()
+            try:
+                with metrics.timer("gemini_request", model=model.model_name):
+                    response = await asyncio.wait_for(coro, timeout=Config.REQUEST_TIMEOUT)
+            except (google_exceptions.ResourceExhausted, google_exceptions.ServiceUnavailable) as e:
+                metrics.record_error("gemini", e)
+                if isinstance(e, google_exceptions.ResourceExhausted):
+                    # Квота исчерпана, но модель исправна: проба (если это была она) не считается неудачной
+                    breaker.probing = False
+                else:
+                    breaker.failure()
+                # Сначала пробуем более быструю модель, общую паузу делаем, только если замены нет
+                fallback = ModelRouter.fallback_for(model.model_name)
+                if fallback:
+                    model = ModelRegistry.get(fallback, model.registry_key[1])
+                    continue
+                delay = scheduler.report_overload()
+                attempt += 1
+                if attempt > Config.MAX_RETRIES:
+                    raise
+                await asyncio.sleep(delay)
+                continue
+            except (asyncio.TimeoutError, google_exceptions.ServerError) as e:
+                metrics.record_error("gemini", e)
+                breaker.failure()
+                raise
+            except google_exceptions.GoogleAPIError:
+                # Ошибка в самом запросе: модель отвечает, предохранитель не срабатывает
+                breaker.success()
+                raise
+            except asyncio.CancelledError:
+                breaker.probing = False
+                raise
+            breaker.success()
+            ModelRouter.record_latency(model.model_name, time.monotonic() - started)
+            scheduler.report_success()
+            return response, model
+
     @staticmethod
-    def add_to_conversation(channel_id, message):
+    async def call_model(model, history: List["protos.Content"], contents):
+        """Выполняет асинхронный запрос к модели с ограничением параллельности и таймаутом"""
+        async with GeminiClient.get_semaphore():
+            response, model = await GeminiClient.start_request(model, history, contents)
+        metrics.record_usage(response.usage_metadata, model.model_name)
+        return response
+
+    @staticmethod
+    def add_to_conversation(channel_id, record: HistoryRecord):
         """Добавляет сообщение в контекст канала"""
-        channel_conversations[channel_id].append(message)
+        storage.append(channel_id, record)
     
     @staticmethod
-    def get_conversation_history(channel_id):
-        """Получает историю сообщений для канала"""
-        conversation = []
-        for msg in channel_conversations[channel_id]:
-            if msg["role"] == "user":
-                conversation.append({"role": "user", "parts": [msg["content"]]})
-            else:
-                conversation.append({"role": "model", "parts": [msg["content"]]})
-        return conversation
+    async def get_conversation_history(channel_id, model_name: str = Config.DEFAULT_MODEL,
+                                       exclude: Collection[HistoryRecord] = ()):
+        """Получает историю сообщений для канала в пределах бюджета токенов модели"""
+        with metrics.timer("history_build"):
+            context = await storage.get(channel_id)
+            return context.history(Config.get_token_budget(model_name), exclude)
     
     @staticmethod
-    async def generate_response(prompt: str, channel_id: int, server_id: Optional[int] = None, image_urls: List[str] = None) -> str:
+    async def stream_model(model, history: List["protos.Content"], contents):
+        """Потоково получает ответ модели, таймаут действует на каждый фрагмент"""
+        async with GeminiClient.get_semaphore():
+            # Дальше используется модель, которая ответила: она могла быть заменой
+            response, model = await GeminiClient.start_request(model, history, contents, stream=True)
+            iterator = response.__aiter__()
+            usage = None
+            while True:
+                try:
+                    chunk = await asyncio.wait_for(iterator.__anext__(), timeout=Config.REQUEST_TIMEOUT)
+                except StopAsyncIteration:
+                    break
+                except asyncio.TimeoutError:
+                    ModelRouter.breaker(model.model_name).failure()
+                    raise
+                # Итоговое число токенов приходит в последнем фрагменте
+                usage = chunk.usage_metadata or usage
+                try:
+                    text = chunk.text
+                except ValueError:
+                    # Фрагмент без текста (например, только причина завершения)
+                    continue
+                if text:
+                    yield text
+            metrics.record_usage(usage, model.model_name)
+
+    @staticmethod
+    async def prepare_request(prompt: str, channel_id: int, server_id: Optional[int],
+                              image_urls: Optional[List[str]], stateless: bool = False,
+                              user_id: Optional[int] = None, record: Optional[HistoryRecord] = None) -> tuple:
+        """Собирает модель, историю, содержимое запроса, ключ кэша (None, если кэшировать нельзя)
+        и текст о непринятых вложениях. Если не принято ни одно изображение, бросает AttachmentRejected.
+        record - уже сохраненная в истории запись этого запроса, в историю она не дублируется"""
+        await GeminiSDK.ready()
+        model_name = ModelRouter.resolve(prompt, channel_id, server_id, user_id, len(image_urls or []))
+        user_prompt = prompt
+        if record is not None and record.author:
+            prompt = f"{record.author}: {prompt}"
+        
+        # Получаем историю сообщений; запросы без состояния отправляются без нее
+        conversation_history = []
+        if not stateless:
+            conversation_history = await GeminiClient.get_conversation_history(
+                channel_id, model_name, (record,) if record is not None else ()
+            )
+        
+        # Промпт сервера передается модели как системная инструкция
+        server_prompt = server_prompts.get(server_id, "") if server_id else ""
+        model = ModelRegistry.get(model_name, server_prompt or None)
+        
+        # Подготовка промпта и изображений
+        image_parts, notice = [], ""
+        if image_urls:
+            # Создаем мультимодальный запрос
+            image_parts, notice = await AttachmentFetcher.fetch_all(image_urls)
+            if not image_parts:
+                # Вопрос был об изображениях: без них модель ответила бы не о том
+                raise AttachmentRejected(notice)
+            contents = [{"text": prompt}] + image_parts
+        else:
+            contents = prompt
+        
+        # Ответы, зависящие от контекста беседы, берутся из кэша только в деградированном режиме
+        cache_key = None
+        if Config.RESPONSE_CACHE:
+            cache_key = ResponseCache.make_key(model_name, server_prompt, user_prompt, image_parts)
+        
+        return model, conversation_history, contents, prompt, cache_key, notice
+
+    @staticmethod
+    def remember_exchange(channel_id: int, prompt: str, answer: str, record: Optional[HistoryRecord] = None):
+        """Добавляет ответ в историю, а также запрос, если он еще не был сохранен"""
+        if record is None:
+            GeminiClient.add_to_conversation(channel_id, HistoryRecord("user", prompt))
+        GeminiClient.add_to_conversation(channel_id, HistoryRecord("model", answer))
+
+    @staticmethod
+    async def degraded_answer(error: CircuitOpenError, channel_id: int, prompt: str,
+                              record: Optional[HistoryRecord], cache_key: Optional[str]) -> str:
+        """Ответ, пока модели недоступны: сохраненный ответ на такой же вопрос или просьба подождать"""
+        metrics.inc("degraded_responses_total")
+        cached = await response_cache.fetch(cache_key) if cache_key else None
+        if cached is not None:
+            GeminiClient.remember_exchange(channel_id, prompt, cached, record)
+            return f"{cached}\n\n-# ⚠️ Gemini сейчас недоступен, это сохраненный ответ на такой же вопрос."
+        return f"⚠️ Gemini сейчас перегружен, попробуйте через {max(error.retry_after, 1):.0f} сек."
+
+    @staticmethod
+    async def generate_response(prompt: str, channel_id: int, server_id: Optional[int] = None,
+                                image_urls: List[str] = None, stateless: bool = False,
+                                user_id: Optional[int] = None, record: Optional[HistoryRecord] = None) -> str:
         """Генерирует ответ используя Gemini API с историей сообщений и изображениями"""
+        cache_key = None
         try:
-            model_name = Config.DEFAULT_MODEL
+            model, conversation_history, contents, prompt, cache_key, notice = await GeminiClient.prepare_request(
+                prompt, channel_id, server_id, image_urls, stateless, user_id, record
+            )
             
-            # Получаем историю сообщений
-            conversation_history = GeminiClient.get_conversation_history(channel_id)
+            use_cache = cache_key is not None and not conversation_history
+            text = await response_cache.fetch(cache_key) if use_cache else None
+            if text is None:
+                # Если у нас есть история сообщений, используется chat для сохранения контекста
+                response = await GeminiClient.call_model(model, conversation_history, contents)
+                text = response.text
+                if use_cache:
+                    await response_cache.store(cache_key, text)
             
-            # Получаем пользовательский промпт для сервера, если есть
-            server_prompt = ""
-            if server_id and server_id in server_prompts:
-                server_prompt = server_prompts[server_id]
-                if server_prompt:
-                    prompt = f"{server_prompt}\n\nЗапрос пользователя: {prompt}"
+            GeminiClient.remember_exchange(channel_id, prompt, text, record)
             
-            # Подготовка промпта и изображений
-            if image_urls:
-                # Для запроса с изображениями используем модель с поддержкой изображений
-                model = genai.GenerativeModel(model_name, safety_settings=SAFETY_SETTINGS)
-                
-                # Создаем мультимодальный запрос
-                contents = [{"text": prompt}]
-                for url in image_urls:
-                    try:
-                        response = requests.get(url)
-                        if response.status_code == 200:
-                            img_data = response.content
-                            contents.append({
-                                "inline_data": {
-                                    "mime_type": "image/jpeg",
-                                    "data": base64.b64encode(img_data).decode("utf-8")
-                                }
-                            })
-                    except Exception as e:
-                        print(f"Ошибка при загрузке изображения: {e}")
-                
-                # Если у нас есть история сообщений, используем chat для сохранения контекста
-                if conversation_history:
-                    chat = model.start_chat(history=conversation_history)
-                    response = chat.send_message(contents)
-                else:
-                    response = model.generate_content(contents)
+            return f"{notice}\n\n{text}" if notice else text
+        except AttachmentRejected as e:
+            return str(e)
+        except CircuitOpenError as e:
+            return await GeminiClient.degraded_answer(e, channel_id, prompt, record, cache_key)
+        except asyncio.TimeoutError as e:
+            metrics.record_error("generate", e)
+            return f"Gemini не ответил за {Config.REQUEST_TIMEOUT:.0f} секунд, попробуйте еще раз."
+        except google_exceptions.ResourceExhausted as e:
+            metrics.record_error("generate", e)
+            return "Лимит запросов к Gemini исчерпан, попробуйте позже."
+        except Exception as e:
+            metrics.record_error("generate", e)
+            print(f"Ошибка генерации ответа: {e}")
+            return "Не удалось получить ответ от Gemini, попробуйте еще раз."
+
+    @staticmethod
+    async def stream_response(prompt: str, channel_id: int, server_id: Optional[int] = None,
+                              image_urls: List[str] = None, stateless: bool = False,
+                              user_id: Optional[int] = None, record: Optional[HistoryRecord] = None):
+        """Как generate_response, но отдает ответ по мере генерации"""
+        parts = []
+        cache_key = None
+        try:
+            model, conversation_history, contents, prompt, cache_key, notice = await GeminiClient.prepare_request(
+                prompt, channel_id, server_id, image_urls, stateless, user_id, record
+            )
+            if notice:
+                yield f"{notice}\n\n"
+            use_cache = cache_key is not None and not conversation_history
+            cached = await response_cache.fetch(cache_key) if use_cache else None
+            if cached is not None:
+                parts.append(cached)
+                yield cached
             else:
-                # Для текстового запроса используем стандартную модель
-                model = genai.GenerativeModel(model_name, safety_settings=SAFETY_SETTINGS)
-                
-                # Если у нас есть история сообщений, используем chat для сохранения контекста
-                if conversation_history:
-                    chat = model.start_chat(history=conversation_history)
-                    response = chat.send_message(prompt)
-                else:
-                    response = model.generate_content(prompt)
-            
-            # Добавляем сообщение пользователя и ответ в историю
-            GeminiClient.add_to_conversation(channel_id, {"role": "user", "content": prompt, "time": datetime.datetime.now()})
-            GeminiClient.add_to_conversation(channel_id, {"role": "assistant", "content": response.text, "time": datetime.datetime.now()})
+                async for text in GeminiClient.stream_model(model, conversation_history, contents):
+                    parts.append(text)
+                    yield text
+                if use_cache:
+                    await response_cache.store(cache_key, "".join(parts))
+            GeminiClient.remember_exchange(channel_id, prompt, "".join(parts), record)
+        except AttachmentRejected as e:
+            yield str(e)
+        except CircuitOpenError as e:
+            yield await GeminiClient.degraded_answer(e, channel_id, prompt, record, cache_key)
+        except asyncio.TimeoutError as e:
+            metrics.record_error("generate", e)
+            yield f"\n\nGemini не ответил за {Config.REQUEST_TIMEOUT:.0f} секунд, попробуйте еще раз."
+        except google_exceptions.ResourceExhausted as e:
+            metrics.record_error("generate", e)
+            yield "\n\nЛимит запросов к Gemini исчерпан, попробуйте позже."
+        except Exception as e:
+            metrics.record_error("generate", e)
+            print(f"Ошибка генерации ответа: {e}")
+            yield "\n\nНе удалось получить ответ от Gemini, попробуйте еще раз."
+
+# Разбиение длинного ответа на сообщения Discord без разрыва слов, абзацев и блоков кода
+class MessageSplitter:
+    # Строка, открывающая или закрывающая блок кода: ``` или ~~~ и, возможно, язык.
+    # Как в CommonMark, после ``` не может быть обратных кавычек: ```x = 1``` - это код в строке
+    FENCE = re.compile(r"^[ \t]*(?:(`{3,})([^`\n]*)|(~{3,})([^\n]*))$", re.MULTILINE)
+    FENCE_START = re.compile(r"[ \t]*(?:```|~~~)")
+    SEPARATORS = ("\n\n", "\n", " ")
+    FILE_NOTE = "\n\n📎 Полный ответ во вложении."
+
+    @staticmethod
+    def markers(fence: Optional[tuple], limit: int) -> tuple:
+        """Строки (открывающая, закрывающая), продолжающие блок кода через границу сообщений.
+        Вместе они занимают не больше половины limit: длинный язык отбрасывается,
+        а блок со слишком длинным маркером не продолжается"""
+        if not fence:
+            return "", ""
+        marker, info = fence
+        if 2 * len(marker) + len(info) + 2 > limit // 2:
+            info = ""
+        if 2 * len(marker) + 2 > limit // 2:
+            return "", ""
+        return f"{marker}{info}\n", f"\n{marker}"
+
+    @staticmethod
+    def opening(fence: Optional[tuple], limit: int) -> str:
+        """Строка, заново открывающая блок кода в начале следующего сообщения"""
+        return MessageSplitter.markers(fence, limit)[0]
+
+    @staticmethod
+    def fence_after(text: str, start: int, end: int, fence: Optional[tuple]) -> Optional[tuple]:
+        """Блок кода (маркер, язык), открытый в конце text[start:end], если в начале был открыт fence.
+        Сообщение начинается с новой строки, поэтому text[start:end] разбирается отдельно от предыдущего текста"""
+        for match in MessageSplitter.FENCE.finditer(text[start:end]):
+            marker, info = match.group(1) or match.group(3), (match.group(2) or match.group(4) or "").strip()
+            if fence is None:
+                fence = (marker, info)
+            elif marker[0] == fence[0][0] and len(marker) >= len(fence[0]) and not info:
+                fence = None
+        return fence
+
+    @staticmethod
+    def next_chunk(text: str, start: int, fence: Optional[tuple], limit: int) -> tuple:
+        """Следующее сообщение из text, начиная с позиции start.
+        Возвращает (текст сообщения, позиция продолжения, блок кода, открытый на границе)"""
+        opening = MessageSplitter.opening(fence, limit)
+        if len(opening) + len(text) - start <= limit:
+            return opening + text[start:], len(text), MessageSplitter.fence_after(text, start, len(text), fence)
+
+        # Запас под закрывающую строку блока кода, открытого на месте разреза; она известна после первого прохода
+        reserve = 0
+        while True:
+            end = start + max(limit - len(opening) - reserve, 1)
+            cut, separator = -1, ""
+            for separator in MessageSplitter.SEPARATORS:
+                cut = text.rfind(separator, start, end)
+                # Продолжение строки не должно начинаться с ``` - в новом сообщении это станет блоком кода
+                while separator == " " and cut > start and MessageSplitter.FENCE_START.match(text, cut + 1):
+                    cut = text.rfind(" ", start, cut)
+                if cut > start + (end - start) // 2:
+                    break
+            if cut <= start:
+                cut, separator = end, ""
+                if MessageSplitter.FENCE_START.match(text, cut):
+                    # Режем перед символом, за которым идут пробелы и ```; серия ``` длиннее сообщения
+                    # режется как есть, иначе каждое сообщение получит по символу
+                    back = start + len(text[start:cut].rstrip(" \t`~")) - 1
+                    if back > start:
+                        cut = back
+            open_fence = MessageSplitter.fence_after(text, start, cut, fence)
+            closing = MessageSplitter.markers(open_fence, limit)[1]
+            if not closing:
+                # Блок, который нельзя закрыть и переоткрыть, в следующем сообщении не продолжается
+                open_fence = None
+            if len(opening) + cut - start + len(closing) <= limit or len(closing) <= reserve:
+                break
+            reserve = len(closing)
+
+        # Разделитель не переносится в следующее сообщение; отступы кода после перевода строки сохраняются
+        resume = cut + (1 if separator == " " else 0)
+        while resume < len(text) and text[resume] == "\n":
+            resume += 1
+        return opening + text[start:cut] + closing, resume, open_fence
+
+    @staticmethod
+    def split(text: str, limit: int = Config.MAX_MESSAGE_LENGTH) -> Iterator[str]:
+        """Лениво отдает части текста не длиннее limit"""
+        start, fence = 0, None
+        while start < len(text):
+            chunk, start, fence = MessageSplitter.next_chunk(text, start, fence, limit)
+            if chunk.strip():
+                yield chunk
+
+    @staticmethod
+    def preview(text: str) -> str:
+        """Начало ответа, помещающееся в одно сообщение вместе с пометкой о вложении"""
+        first = next(MessageSplitter.split(text, Config.MAX_MESSAGE_LENGTH - len(MessageSplitter.FILE_NOTE)), "")
+        return first + MessageSplitter.FILE_NOTE
+
+    @staticmethod
+    def as_file(text: str) -> discord.File:
+        return discord.File(io.BytesIO(text.encode("utf-8")), filename="response.md")
+
+    @staticmethod
+    def use_file(text: str) -> bool:
+        threshold = max(Config.LONG_RESPONSE_FILE_THRESHOLD, Config.MAX_MESSAGE_LENGTH)
+        return Config.LONG_RESPONSE_MODE == "file" and len(text) > threshold
+
+# Отправка ответа в Discord с постепенным редактированием сообщения
+class StreamingReply:
+    def __init__(self, channel: discord.abc.Messageable):
+        self.channel = channel
+        self.message: Optional[discord.Message] = None
+        # Текст текущего сообщения и блок кода, продолжающийся из предыдущего
+        self.buffer = ""
+        self.fence: Optional[tuple] = None
+        self.sent_text = ""
+        self.last_edit = 0.0
+        self.started = time.monotonic()
+        self.first_token_latency: Optional[float] = None
+        # В режиме файла ответ не дробится на ходу: в конце он дописывается сообщениями или уходит файлом
+        self.parts: List[str] = []
+        self.overflow = False
+
+    async def _publish(self, content: Optional[str] = None, **kwargs):
+        if content is None:
+            content = MessageSplitter.opening(self.fence, Config.MAX_MESSAGE_LENGTH) + self.buffer
+        if not content.strip() or (content == self.sent_text and not kwargs):
+            return
+        with metrics.timer("discord_send"):
+            if self.message is None:
+                self.message = await self.channel.send(content, **kwargs)
+            else:
+                await self.message.edit(content=content, **kwargs)
+        self.sent_text = content
+        self.last_edit = time.monotonic()
+
+    async def feed(self, text: str):
+        """Добавляет фрагмент ответа, редактируя сообщение не чаще STREAM_EDIT_INTERVAL"""
+        if self.first_token_latency is None:
+            self.first_token_latency = time.monotonic() - self.started
+            metrics.observe("time_to_first_token_seconds", self.first_token_latency)
+        if Config.LONG_RESPONSE_MODE == "file":
+            self.parts.append(text)
+        if self.overflow:
+            return
+        self.buffer += text
+        limit = Config.MAX_MESSAGE_LENGTH
+        while len(MessageSplitter.opening(self.fence, limit)) + len(self.buffer) > limit:
+            chunk, resume, fence = MessageSplitter.next_chunk(self.buffer, 0, self.fence, limit)
+            await self._publish(chunk)
+            if Config.LONG_RESPONSE_MODE == "file":
+                self.overflow = True
+                return
+            # Остаток уходит в новое сообщение
+            self.message, self.sent_text = None, ""
+            self.buffer, self.fence = self.buffer[resume:], fence
+        if time.monotonic() - self.last_edit >= Config.STREAM_EDIT_INTERVAL:
+            await self._publish()
+
+    async def finish(self):
+        if not self.overflow:
+            await self._publish()
+            return
+        text = "".join(self.parts)
+        if MessageSplitter.use_file(text):
+            # Превью и полный ответ одним запросом к Discord
+            await self._publish(MessageSplitter.preview(text), attachments=[MessageSplitter.as_file(text)])
+            return
+        # Ответ короче порога файла: дописываем остаток обычными сообщениями
+        chunks = MessageSplitter.split(text)
+        await self._publish(next(chunks))
+        await send_chunks(self.channel.send, chunks)
+
+async def deliver_gemini_response(channel: discord.abc.Messageable, prompt: str, channel_id: int,
+                                  server_id: Optional[int] = None, image_urls: List[str] = None,
+                                  stateless: bool = False, user_id: Optional[int] = None,
+                                  record: Optional[HistoryRecord] = None):
+    """Генерирует ответ и отправляет его в канал, потоково или целиком"""
+    if Config.STREAM_RESPONSES:
+        reply = StreamingReply(channel)
+        with metrics.timer("generation", mode="stream"):
+            async with channel.typing():
+                async for text in GeminiClient.stream_response(
+                    prompt, channel_id, server_id, image_urls, stateless, user_id, record
+                ):
+                    await reply.feed(text)
+                await reply.finish()
+        return
+
+    with metrics.timer("generation", mode="full"):
+        async with channel.typing():
+            response = await GeminiClient.generate_response(
+                prompt, channel_id, server_id, image_urls, stateless, user_id, record
+            )
             
-            return response.text
+            await send_long_message(channel.send, response)
+
+async def send_chunks(send, chunks: Iterator[str]):
+    with metrics.timer("discord_send"):
+        for chunk in chunks:
+            await send(chunk)
+
+async def send_long_message(send, text: str):
+    """Отправляет текст, разбивая длинные сообщения на части или прикладывая его файлом"""
+    if MessageSplitter.use_file(text):
+        with metrics.timer("discord_send"):
+            await send(MessageSplitter.preview(text), file=MessageSplitter.as_file(text))
+        return
+    await send_chunks(send, MessageSplitter.split(text))
+
+async def send_gemini_response(channel: discord.abc.Messageable, user_id: int, prompt: str, channel_id: int,
+                               server_id: Optional[int] = None, image_urls: List[str] = None,
+                               stateless: bool = False, record: Optional[HistoryRecord] = None,
+                               priority: bool = False, admitted: bool = False):
+    """Пропускает запрос через планировщик и отправляет ответ. Личные сообщения и команды
+    идут в приоритетную очередь, чтобы не ждать за упоминаниями в загруженных каналах"""
+    try:
+        future, position = await scheduler.submit(
+            user_id, server_id,
+            lambda: deliver_gemini_response(
+                channel, prompt, channel_id, server_id, image_urls, stateless, user_id, record
+            ),
+            priority=priority, admitted=admitted
+        )
+    except SchedulerRejected as e:
+        metrics.inc("scheduler_rejected_total")
+        await channel.send(f"⏳ {e}")
+        return
+    if position > 0:
+        await channel.send(f"⏳ Запрос поставлен в очередь (позиция {position}).")
+    await future
+
+# Объединение всплеска упоминаний в одном канале в один запрос
+class MentionBatch:
+    __slots__ = ("message", "content", "record")
+
+    def __init__(self, message: discord.Message, content: str, record: Optional[HistoryRecord]):
+        self.message = message
+        self.content = content
+        self.record = record
+
+class MentionBatcher:
+    MARKER = re.compile(r"\[\[(\d+)\]\]")
+
+    def __init__(self):
+        self._pending: Dict[int, List[MentionBatch]] = {}
+        # Каналы, в которых сейчас идет обработка; новые упоминания в них ждут следующей пачки
+        self._active: set = set()
+
+    async def add(self, message: discord.Message, content: str, record: Optional[HistoryRecord]):
+        channel_id = message.channel.id
+        self._pending.setdefault(channel_id, []).append(MentionBatch(message, content, record))
+        if channel_id in self._active:
+            return
+        self._active.add(channel_id)
+        try:
+            while self._pending.get(channel_id):
+                if Config.BATCH_WINDOW:
+                    await asyncio.sleep(Config.BATCH_WINDOW)
+                items = self._pending.pop(channel_id)
+                if len(items) > Config.BATCH_MAX:
+                    self._pending[channel_id] = items[Config.BATCH_MAX:]
+                    items = items[:Config.BATCH_MAX]
+                try:
+                    await self.dispatch(items)
+                except Exception as e:
+                    # Ошибка одной пачки не должна терять упоминания, ждущие следующей
+                    metrics.record_error("batch", e)
+                    print(f"Ошибка обработки пачки упоминаний в канале {channel_id}: {e}")
+        finally:
+            self._active.discard(channel_id)
+            self._pending.pop(channel_id, None)
+
+    async def dispatch(self, items: List[MentionBatch]):
+        first = items[0].message
+        server_id = first.guild.id if first.guild else None
+        # Каждый спросивший проходит свои лимиты; превысившие их получают отказ, остальные - общий ответ
+        admitted = []
+        for item in items:
+            try:
+                await scheduler.admit(item.message.author.id, server_id)
+            except SchedulerRejected as e:
+                metrics.inc("scheduler_rejected_total")
+                await item.message.reply(f"⏳ {e}")
+                continue
+            admitted.append(item)
+        if not admitted:
+            return
+        items, first = admitted, admitted[0].message
+        if len(items) == 1:
+            await send_gemini_response(
+                first.channel, first.author.id, items[0].content, first.channel.id, server_id,
+                record=items[0].record, admitted=True
+            )
+            return
+
+        metrics.inc("mention_batches_total")
+        metrics.inc("mention_batched_requests_total", len(items))
+        future, position = await scheduler.submit(
+            first.author.id, server_id, lambda: self.answer(items, server_id), admitted=True
+        )
+        if position > 0:
+            await first.channel.send(f"⏳ Запросы поставлены в очередь (позиция {position}).")
+        await future
+
+    async def answer(self, items: List[MentionBatch], server_id: Optional[int]):
+        """Один запрос к Gemini на всю пачку; ответы раздаются каждому спросившему"""
+        channel = items[0].message.channel
+        questions = "\n".join(
+            f"[[{i}]] {item.message.author.display_name}: {item.content}" for i, item in enumerate(items, 1)
+        )
+        prompt = (
+            "Несколько пользователей обратились к тебе одновременно. Ответь на каждый вопрос отдельно. "
+            "Перед каждым ответом напиши на отдельной строке его номер в формате [[N]].\n\n" + questions
+        )
+        with metrics.timer("generation", mode="batch"):
+            async with channel.typing():
+                try:
+                    await GeminiSDK.ready()
+                    model_name = ModelRouter.resolve(prompt, channel.id, server_id, items[0].message.author.id, 0)
+                    history = await GeminiClient.get_conversation_history(
+                        channel.id, model_name, {item.record for item in items if item.record is not None}
+                    )
+                    server_prompt = server_prompts.get(server_id, "") if server_id else ""
+                    model = ModelRegistry.get(model_name, server_prompt or None)
+                    response = await GeminiClient.call_model(model, history, prompt)
+                    text = response.text
+                except CircuitOpenError as e:
+                    metrics.inc("degraded_responses_total")
+                    await channel.send(f"⚠️ Gemini сейчас перегружен, попробуйте через {max(e.retry_after, 1):.0f} сек.")
+                    return
+                except Exception as e:
+                    metrics.record_error("generate", e)
+                    print(f"Ошибка генерации ответа: {e}")
+                    await channel.send("Не удалось получить ответ от Gemini, попробуйте еще раз.")
+                    return
+
+            GeminiClient.add_to_conversation(channel.id, HistoryRecord("model", text))
+            answers = self.split_answers(text, len(items))
+            if answers is None:
+                # Модель не соблюла формат: отправляем общий ответ с упоминанием всех
+                mentions = " ".join(item.message.author.mention for item in items)
+                await send_long_message(channel.send, f"{mentions}\n{text}")
+                return
+            for item, answer in zip(items, answers):
+                await send_long_message(item.message.reply, answer)
+
+    @staticmethod
+    def split_answers(text: str, count: int) -> Optional[List[str]]:
+        parts = MentionBatcher.MARKER.split(text)
+        answers: Dict[int, str] = {}
+        for number, answer in zip(parts[1::2], parts[2::2]):
+            answers[int(number)] = answers.get(int(number), "") + answer.strip()
+        if any(not answers.get(i) for i in range(1, count + 1)):
+            return None
+        return [answers[i] for i in range(1, count + 1)]
+
+batcher = MentionBatcher()
+
+# Фоновое сжатие длинной истории каналов
+class HistoryCompactor:
+    _task: Optional[asyncio.Task] = None
+
+    @staticmethod
+    def start():
+        """Запускает фоновую задачу сжатия, если она еще не запущена"""
+        if HistoryCompactor._task is None or HistoryCompactor._task.done():
+            HistoryCompactor._task = asyncio.create_task(HistoryCompactor.run())
+
+    @staticmethod
+    async def run():
+        while True:
+            await asyncio.sleep(Config.COMPACTION_INTERVAL)
+            try:
+                await HistoryCompactor.compact_idle_channels()
+            except Exception as e:
+                print(f"Ошибка при сжатии истории: {e}")
+
+    @staticmethod
+    async def compact_idle_channels():
+        """Сжимает историю нескольких неактивных каналов, превысивших порог"""
+        now = time.monotonic()
+        candidates = [
+            (channel_id, context) for channel_id, context in storage.items()
+            if context.token_count > Config.COMPACTION_THRESHOLD_TOKENS
+            and now - context.last_activity >= Config.COMPACTION_IDLE_SECONDS
+        ]
+        candidates.sort(key=lambda item: item[1].token_count, reverse=True)
+        batch = candidates[:Config.COMPACTION_BATCH]
+        await asyncio.gather(*(HistoryCompactor.compact(channel_id, context) for channel_id, context in batch))
+
+    @staticmethod
+    async def compact(channel_id: int, context: ConversationContext):
+        epoch, end, contents = context.pending_compaction(Config.COMPACTION_KEEP_RECENT)
+        if not contents:
+            return
+        transcript = "\n".join(
+            f"{record.author or 'Пользователь'}: {record.content}" if record.role == "user"
+            else f"Ассистент: {record.content}"
+            for record in contents
+        )
+        prompt = (
+            "Сожми переписку ниже в краткое содержание на языке переписки. "
+            "Сохрани факты, имена, договоренности и открытые вопросы, опусти приветствия и повторы.\n\n"
+        )
+        if context.summary:
+            prompt += f"Предыдущее краткое содержание:\n{context.summary}\n\n"
+        prompt += f"Новые сообщения:\n{transcript}"
+
+        try:
+            # Сжатие может начаться раньше, чем SDK импортирован и настроен в фоне
+            await GeminiSDK.ready()
+            model = ModelRegistry.get(Config.SUMMARY_MODEL)
+            response = await GeminiClient.call_model(model, [], prompt)
+            if context.apply_summary(response.text.strip(), end, epoch):
+                storage.save_summary(channel_id, context, epoch)
         except Exception as e:
-            return f"Произошла ошибка при генерации ответа: {str(e)}"
+            print(f"Не удалось сжать историю канала {channel_id}: {e}")
 
 # UI компоненты для выбора модели
 class ModelSelectUI:
     class GroupSelector(discord.ui.Select):
-        def __init__(self, user_id: int):
+        def __init__(self, user_id: int, target: tuple):
             self.user_id = user_id
+            self.target = target
             options = [
                 discord.SelectOption(label=group, description=f"Модели {group}") 
                 for group in AVAILABLE_MODELS.keys()
@@ -155,12 +2569,13 @@ class ModelSelectUI:
                 return
                 
             group = self.values[0]
-            view = ModelSelectUI.ModelView(interaction.user.id, group)
+            view = ModelSelectUI.ModelView(interaction.user.id, self.target, group)
             await interaction.response.edit_message(content=f"Выберите модель из группы {group}:", view=view)
 
     class ModelSelector(discord.ui.Select):
-        def __init__(self, user_id: int, group: str):
+        def __init__(self, user_id: int, target: tuple, group: str):
             self.user_id = user_id
+            self.target = target
             self.group = group
             options = []
             
@@ -189,71 +2604,127 @@ class ModelSelectUI:
                 return
                 
             model_id = self.values[0]
+            scope, scope_id = self.target
             await interaction.response.edit_message(
-                content=f"Выбрана модель: `{model_id}`\nВсе запросы к Gemini теперь будут использовать эту модель.", 
+                content=f"Выбрана модель: `{model_id}`\nЗапросы к Gemini {MODEL_SCOPES[scope]} теперь будут использовать эту модель.", 
                 view=None
             )
             
-            Config.DEFAULT_MODEL = model_id
+            ModelRouter.set_choice(scope, scope_id, model_id)
 
     class ModelView(discord.ui.View):
-        def __init__(self, user_id: int, group: Optional[str] = None):
+        def __init__(self, user_id: int, target: tuple, group: Optional[str] = None):
             super().__init__(timeout=120)
+            # target - (область, id), для которой выбирается модель
+            self.target = target
             
             if group:
-                self.add_item(ModelSelectUI.ModelSelector(user_id, group))
+                self.add_item(ModelSelectUI.ModelSelector(user_id, target, group))
                 self.add_item(discord.ui.Button(label="Назад", style=discord.ButtonStyle.secondary, custom_id="back"))
             else:
-                self.add_item(ModelSelectUI.GroupSelector(user_id))
+                self.add_item(ModelSelectUI.GroupSelector(user_id, target))
                 
         async def interaction_check(self, interaction: discord.Interaction) -> bool:
             if interaction.data.get("custom_id") == "back":
-                view = ModelSelectUI.ModelView(interaction.user.id)
+                view = ModelSelectUI.ModelView(interaction.user.id, self.target)
                 await interaction.response.edit_message(content="Выберите группу моделей:", view=view)
                 return False
             return True
 
+# Прогрев после запуска: модели и соединение с Gemini создаются до первого обращения к боту
+async def warm_up():
+    try:
+        await GeminiSDK.ready()
+    except Exception as e:
+        print(f"Не удалось загрузить Gemini SDK: {e}")
+        return
+    if not Config.WARMUP:
+        return
+    with startup.phase("warmup"):
+        AttachmentFetcher.get_session()
+        for model_id in {Config.DEFAULT_MODEL, Config.FAST_MODEL, Config.STRONG_MODEL, Config.SUMMARY_MODEL}:
+            ModelRegistry.get(model_id)
+        # Подсчет токенов бесплатен и открывает соединение, которое затем используют все модели
+        try:
+            await asyncio.wait_for(
+                ModelRegistry.get(Config.FAST_MODEL).count_tokens_async("ping"), timeout=Config.REQUEST_TIMEOUT
+            )
+        except Exception as e:
+            print(f"Не удалось прогреть соединение с Gemini: {e!r}")
+
+# Синхронизация слеш-команд ограничена Discord, поэтому она выполняется в фоне
+# и только если дерево команд изменилось с прошлой синхронизации
+class CommandSync:
+    _task: Optional[asyncio.Task] = None
+
+    @staticmethod
+    def tree_hash() -> str:
+        payload = [command.to_dict(bot.tree) for command in bot.tree.get_commands()]
+        data = json.dumps([bot.application_id, payload], sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(data.encode()).hexdigest()
+
+    @staticmethod
+    def start():
+        # Команды глобальные, их синхронизирует только процесс с шардом 0, один раз за запуск
+        if CommandSync._task is None and (not bot.shard_ids or 0 in bot.shard_ids):
+            CommandSync._task = asyncio.create_task(CommandSync.run())
+
+    @staticmethod
+    async def run():
+        with startup.phase("command_sync"):
+            digest = CommandSync.tree_hash()
+            path = Config.COMMAND_HASH_PATH
+            try:
+                with open(path, encoding="utf-8") as f:
+                    if f.read().strip() == digest:
+                        print("Команды не изменились, синхронизация пропущена")
+                        return
+            except OSError:
+                pass
+            try:
+                synced = await bot.tree.sync()
+            except Exception as e:
+                print(f"Ошибка синхронизации команд: {e}")
+                return
+            print(f"Синхронизировано {len(synced)} команд")
+            if path:
+                try:
+                    with open(path, "w", encoding="utf-8") as f:
+                        f.write(digest)
+                except OSError as e:
+                    print(f"Не удалось сохранить хэш команд: {e}")
+
 # События и команды бота
 @bot.event
 async def on_ready():
-    print(f'{bot.user.name} подключен к Discord!')
-    try:
-        synced = await bot.tree.sync()
-        print(f"Синхронизировано {len(synced)} команд")
-        
-        # Установка статуса бота
-        await bot.change_presence(
-            activity=discord.Activity(
-                type=discord.ActivityType.listening, 
-                name="ваши сообщения | !help"
-            )
-        )
-    except Exception as e:
-        print(f"Ошибка синхронизации команд: {e}")
+    print(f'{bot.user.name} подключен к Discord! Шарды: {bot.shard_ids or "все"} из {bot.shard_count}')
+    # on_ready приходит и после переподключений, этапы запуска записываются только в первый раз
+    if "connect" not in startup.phases:
+        startup.record("connect", time.monotonic() - bot.connect_started)
+        startup.record("ready", time.monotonic() - STARTED_AT)
+        print(f"Этапы запуска: {startup.summary()}")
+    HistoryCompactor.start()
+    CommandSync.start()
 
 @bot.command(name='gemini')
 async def gemini_command(ctx, *, prompt: str):
-    async with ctx.typing():
-        # Проверяем наличие вложений-изображений
-        image_urls = []
-        if ctx.message.attachments:
-            for attachment in ctx.message.attachments:
-                if attachment.content_type and attachment.content_type.startswith('image/'):
-                    image_urls.append(attachment.url)
-        
-        # Получаем ID сервера, если сообщение отправлено на сервере
-        server_id = ctx.guild.id if ctx.guild else None
-        
-        response = await GeminiClient.generate_response(prompt, ctx.channel.id, server_id, image_urls)
-        
-    # Разбиваем длинные сообщения на части
-    if len(response) > Config.MAX_MESSAGE_LENGTH:
-        chunks = [response[i:i+Config.MAX_MESSAGE_LENGTH] 
-                 for i in range(0, len(response), Config.MAX_MESSAGE_LENGTH)]
-        for chunk in chunks:
-            await ctx.send(chunk)
-    else:
-        await ctx.send(response)
+    # Проверяем наличие вложений-изображений
+    image_urls = []
+    if ctx.message.attachments:
+        for attachment in ctx.message.attachments:
+            if attachment.content_type and attachment.content_type.startswith('image/'):
+                image_urls.append(attachment.url)
+    
+    # Получаем ID сервера, если сообщение отправлено на сервере
+    server_id = ctx.guild.id if ctx.guild else None
+    
+    # Команда сама сохраняет свой запрос в историю (on_message команды не сохраняет)
+    record = HistoryRecord("user", prompt, ctx.author.display_name)
+    await capture.engage(ctx.channel, ctx.message, record)
+    
+    await send_gemini_response(
+        ctx.channel, ctx.author.id, prompt, ctx.channel.id, server_id, image_urls, record=record, priority=True
+    )
 
 @bot.event
 async def on_message(message: discord.Message):
@@ -261,14 +2732,20 @@ async def on_message(message: discord.Message):
     if message.author == bot.user:
         return
     
-    # Сохраняем каждое сообщение пользователя в контекст
-    if not message.author.bot:
-        # Добавляем сообщение в историю канала
-        GeminiClient.add_to_conversation(message.channel.id, {
-            "role": "user", 
-            "content": message.content, 
-            "time": datetime.datetime.now()
-        })
+    is_dm = isinstance(message.channel, discord.DMChannel)
+    is_command = message.content.startswith(bot.command_prefix)
+    
+    # Сохраняем сообщение пользователя в контекст - это единственная запись сообщения в историю.
+    # Команды не сохраняются: !gemini сам добавляет свой запрос
+    record = None
+    if not message.author.bot and not is_command:
+        record = HistoryRecord("user", message.clean_content, message.author.display_name)
+        if is_dm or bot.user.mentioned_in(message):
+            # Обращение к боту включает запись истории канала (и догружает ее при необходимости)
+            await capture.engage(message.channel, message, record)
+        else:
+            # Остальные сообщения - в историю канала или в короткий буфер, если бот в нем не участвует
+            capture.observe(message.channel.id, record)
     
     # Обрабатываем сообщения в ЛС
     if isinstance(message.channel, discord.DMChannel):
@@ -282,19 +2759,10 @@ async def on_message(message: discord.Message):
                     if attachment.content_type and attachment.content_type.startswith('image/'):
                         image_urls.append(attachment.url)
             
-            async with message.channel.typing():
-                response = await GeminiClient.generate_response(
-                    message.content, message.channel.id, None, image_urls
-                )
-                
-                # Разбиваем длинные сообщения на части
-                if len(response) > Config.MAX_MESSAGE_LENGTH:
-                    chunks = [response[i:i+Config.MAX_MESSAGE_LENGTH] 
-                            for i in range(0, len(response), Config.MAX_MESSAGE_LENGTH)]
-                    for chunk in chunks:
-                        await message.channel.send(chunk)
-                else:
-                    await message.channel.send(response)
+            await send_gemini_response(
+                message.channel, message.author.id, message.content, message.channel.id, None, image_urls,
+                record=record, priority=True
+            )
                     
             # Пропускаем обработку команд в ЛС, если это не команда
             if not message.content.startswith(bot.command_prefix):
@@ -319,32 +2787,22 @@ async def on_message(message: discord.Message):
         
         # Если есть только изображения без текста, используем режим анализа изображений
         if image_urls and not content:
-            async with message.channel.typing():
-                prompt = "Опиши подробно, что изображено на этом изображении"
-                response = await GeminiClient.generate_response(prompt, message.channel.id, server_id, image_urls)
-                
-                # Разбиваем длинные сообщения на части
-                if len(response) > Config.MAX_MESSAGE_LENGTH:
-                    chunks = [response[i:i+Config.MAX_MESSAGE_LENGTH] 
-                             for i in range(0, len(response), Config.MAX_MESSAGE_LENGTH)]
-                    for chunk in chunks:
-                        await message.channel.send(chunk)
-                else:
-                    await message.channel.send(response)
+            prompt = "Опиши подробно, что изображено на этом изображении"
+            # Описание изображения не зависит от беседы, поэтому может быть взято из кэша
+            await send_gemini_response(
+                message.channel, message.author.id, prompt, message.channel.id, server_id, image_urls,
+                stateless=True, record=record
+            )
+        
+        # Текстовые упоминания могут объединяться с одновременными упоминаниями в этом канале
+        elif content and not image_urls and Config.MENTION_BATCHING:
+            await batcher.add(message, content, record)
         
         # Если есть текст, с изображениями или без, используем стандартный режим
         elif content:
-            async with message.channel.typing():
-                response = await GeminiClient.generate_response(content, message.channel.id, server_id, image_urls)
-                
-                # Разбиваем длинные сообщения на части
-                if len(response) > Config.MAX_MESSAGE_LENGTH:
-                    chunks = [response[i:i+Config.MAX_MESSAGE_LENGTH] 
-                             for i in range(0, len(response), Config.MAX_MESSAGE_LENGTH)]
-                    for chunk in chunks:
-                        await message.channel.send(chunk)
-                else:
-                    await message.channel.send(response)
+            await send_gemini_response(
+                message.channel, message.author.id, content, message.channel.id, server_id, image_urls, record=record
+            )
 
 @bot.command(name='help')
 async def text_help_command(ctx):
@@ -356,27 +2814,50 @@ async def text_help_command(ctx):
 `!help` - Показать эту справку
 
 *Slash-команды:*
-`/gemeni` - Выбрать модель Gemini для использования
+`/gemeni [область]` - Выбрать модель Gemini для себя, канала или сервера
 `/prompt` - Установить системный промпт для сервера (только админы)
 `/getprompt` - Показать текущий системный промпт сервера
 `/clearprompt` - Удалить системный промпт сервера (только админы)
 `/clear` - Очистить историю сообщений
 `/history` - Показать количество сохраненных сообщений
+`/cachestats` - Показать статистику кэша ответов
+`/stats` - Показать метрики производительности (только админы)
 `/help` - Показать список команд
 
 **Особенности:**
 - В ЛС бот отвечает на любое сообщение без префикса
 - На сервере бот отвечает при упоминании @БотИмя
 - Можно отправить фото с текстом или без для анализа
-- Бот запоминает до 1000 сообщений в каждом канале
+- Бот запоминает до 1000 сообщений в каналах, где с ним общаются
 - Админы могут установить системный промпт для каждого сервера
 """
     await ctx.send(help_text)
 
 @bot.tree.command(name="gemeni", description="Выбрать модель Gemini для использования")
-async def gemeni_command(interaction: discord.Interaction):
-    view = ModelSelectUI.ModelView(interaction.user.id)
-    await interaction.response.send_message("Выберите группу моделей:", view=view)
+@app_commands.describe(scope="Для кого выбирается модель (по умолчанию - для сервера, в ЛС - для вас)")
+@app_commands.choices(scope=[
+    app_commands.Choice(name="Для меня", value="user"),
+    app_commands.Choice(name="Для этого канала", value="channel"),
+    app_commands.Choice(name="Для этого сервера", value="guild")
+])
+async def gemeni_command(interaction: discord.Interaction, scope: Optional[app_commands.Choice[str]] = None):
+    scope_name = scope.value if scope else ("guild" if interaction.guild else "user")
+    if scope_name == "guild" and not interaction.guild:
+        await interaction.response.send_message("Эта область доступна только на серверах!", ephemeral=True)
+        return
+    if scope_name in ("guild", "channel") and interaction.guild and not interaction.user.guild_permissions.administrator:
+        await interaction.response.send_message(
+            "Только администраторы могут менять модель для канала или сервера. Используйте область «Для меня».",
+            ephemeral=True
+        )
+        return
+    
+    scope_id = {"user": interaction.user.id, "channel": interaction.channel_id, "guild": interaction.guild_id}[scope_name]
+    current = model_choices.get((scope_name, scope_id), Config.DEFAULT_MODEL)
+    view = ModelSelectUI.ModelView(interaction.user.id, (scope_name, scope_id))
+    await interaction.response.send_message(
+        f"Текущая модель {MODEL_SCOPES[scope_name]}: `{current}`\nВыберите группу моделей:", view=view
+    )
 
 @bot.tree.command(name="prompt", description="Установить пользовательский промпт для сервера")
 @app_commands.describe(prompt="Системный промпт для Gemini на этом сервере")
@@ -391,7 +2872,10 @@ async def set_prompt_command(interaction: discord.Interaction, prompt: str):
         return
     
     server_id = interaction.guild.id
+    previous = server_prompts.get(server_id, "")
     server_prompts[server_id] = prompt
+    storage.set_server_prompt(server_id, prompt)
+    ModelRegistry.release(prompts=[previous])
     
     await interaction.response.send_message(
         f"Системный промпт для этого сервера установлен!\n\n**Текущий промпт:**\n```{prompt}```", 
@@ -432,20 +2916,78 @@ async def clear_prompt_command(interaction: discord.Interaction):
     
     server_id = interaction.guild.id
     if server_id in server_prompts:
-        del server_prompts[server_id]
+        previous = server_prompts.pop(server_id)
+        storage.set_server_prompt(server_id, None)
+        ModelRegistry.release(prompts=[previous])
         await interaction.response.send_message("Системный промпт для этого сервера удален!", ephemeral=True)
     else:
         await interaction.response.send_message("Для этого сервера не был установлен системный промпт.", ephemeral=True)
 
 @bot.tree.command(name="clear", description="Очистить историю сообщений в текущем канале")
 async def clear_history(interaction: discord.Interaction):
-    channel_conversations[interaction.channel_id].clear()
+    storage.clear(interaction.channel_id)
     await interaction.response.send_message("История сообщений в этом канале очищена.")
 
 @bot.tree.command(name="history", description="Показать количество сохраненных сообщений в текущем канале")
 async def show_history(interaction: discord.Interaction):
-    count = len(channel_conversations[interaction.channel_id])
-    await interaction.response.send_message(f"Количество сохраненных сообщений в этом канале: {count}/{Config.CONTEXT_LIMIT}")
+    context = await storage.get(interaction.channel_id)
+    await interaction.response.send_message(
+        f"Количество сохраненных сообщений в этом канале: {len(context)}/{Config.CONTEXT_LIMIT} "
+        f"(~{context.token_count} токенов)"
+    )
+
+@bot.tree.command(name="cachestats", description="Показать статистику кэша ответов")
+async def cache_stats_command(interaction: discord.Interaction):
+    if not Config.RESPONSE_CACHE:
+        await interaction.response.send_message("Кэш ответов выключен.", ephemeral=True)
+        return
+    stats = response_cache.stats()
+    await interaction.response.send_message(
+        f"Записей в кэше: {stats['size']}/{response_cache.max_size}\n"
+        f"Попаданий: {stats['hits']}, промахов: {stats['misses']} ({stats['hit_rate']:.0%})",
+        ephemeral=True
+    )
+
+@bot.tree.command(name="stats", description="Показать метрики производительности бота (только админы)")
+async def stats_command(interaction: discord.Interaction):
+    if not interaction.guild or not interaction.user.guild_permissions.administrator:
+        await interaction.response.send_message("Только администраторы сервера могут смотреть статистику!", ephemeral=True)
+        return
+
+    def latency(name: str) -> str:
+        p50, p95 = metrics.quantile(name, 0.5), metrics.quantile(name, 0.95)
+        if p50 is None:
+            return "нет данных"
+        return f"p50 ≤ {p50}с, p95 ≤ {p95}с"
+
+    def total(name: str) -> float:
+        return sum(value for (metric, _), value in metrics.counters.items() if metric == name)
+
+    def in_flight(name: str) -> float:
+        return sum(value for (metric, _), value in metrics.gauges.items() if metric == name)
+
+    errors = [
+        f"{dict(labels).get('stage')}/{dict(labels).get('error')}: {value:.0f}"
+        for (metric, labels), value in metrics.counters.items() if metric == "errors_total"
+    ]
+    cache = response_cache.stats()
+    lines = [
+        f"**Генерация:** {latency('generation_seconds')}, выполняется: {in_flight('generation_in_flight'):.0f}",
+        f"**Первый токен:** {latency('time_to_first_token_seconds')}",
+        f"**Gemini API:** {latency('gemini_request_seconds')}",
+        f"**Загрузка изображений:** {latency('attachment_fetch_seconds')}",
+        f"**Сборка истории:** {latency('history_build_seconds')}",
+        f"**Отправка в Discord:** {latency('discord_send_seconds')}",
+        f"**Очередь:** {scheduler.queue_depth}, отклонено: {total('scheduler_rejected_total'):.0f}",
+        f"**Токены:** вход {total('gemini_prompt_tokens_total'):.0f}, выход {total('gemini_output_tokens_total'):.0f}",
+        f"**Кэш:** {cache['hits']} попаданий / {cache['misses']} промахов",
+        f"**Предохранители:** {'; '.join(ModelRouter.status()) or 'нет данных'}, "
+        f"ответов в деградированном режиме: {total('degraded_responses_total'):.0f}",
+        f"**Запуск:** {startup.summary()}",
+        f"**Шарды процесса:** {', '.join(map(str, sorted(bot.shards))) or 'нет'} из {bot.shard_count}",
+        f"**Ошибки:** {', '.join(errors) if errors else 'нет'}"
+    ]
+    await interaction.response.send_message("\n".join(lines), ephemeral=True)
 
 @bot.tree.command(name="help", description="Показать доступные команды")
 async def help_command(interaction: discord.Interaction):
@@ -456,12 +2998,14 @@ async def help_command(interaction: discord.Interaction):
     )
     
     commands_list = [
-        {"name": "/gemeni", "description": "Выбрать модель Gemini для использования"},
+        {"name": "/gemeni [область]", "description": "Выбрать модель Gemini для себя, канала или сервера (есть автовыбор)"},
         {"name": "/prompt", "description": "Установить системный промпт для сервера (только админы)"},
         {"name": "/getprompt", "description": "Показать текущий системный промпт сервера"},
         {"name": "/clearprompt", "description": "Удалить системный промпт сервера (только админы)"},
         {"name": "/clear", "description": "Очистить историю сообщений в текущем канале"},
         {"name": "/history", "description": "Показать количество сохраненных сообщений"},
+        {"name": "/cachestats", "description": "Показать статистику кэша ответов"},
+        {"name": "/stats", "description": "Показать метрики производительности (только админы)"},
         {"name": "/help", "description": "Показать доступные команды"},
         {"name": "!gemini [запрос]", "description": "Задать вопрос модели Gemini, можно прикрепить изображение"},
         {"name": "!help", "description": "Показать текстовую справку по командам"},
@@ -477,6 +3021,35 @@ async def help_command(interaction: discord.Interaction):
     
     await interaction.response.send_message(embed=embed)
 
+def run_shard_processes():
+    """Запускает SHARD_PROCESSES процессов бота, поровну распределяя между ними шарды"""
+    if Config.SHARD_COUNT <= 0:
+        raise ValueError("Для SHARD_PROCESSES > 1 нужно указать SHARD_COUNT")
+    if Config.STORAGE_BACKEND == "memory":
+        print("Внимание: с STORAGE_BACKEND=memory процессы не видят историю и настройки друг друга")
+    shard_ids = Config.SHARD_IDS or list(range(Config.SHARD_COUNT))
+    groups = [group for group in (shard_ids[i::Config.SHARD_PROCESSES] for i in range(Config.SHARD_PROCESSES)) if group]
+    processes = []
+    for index, group in enumerate(groups):
+        env = dict(os.environ, SHARD_COUNT=str(Config.SHARD_COUNT), SHARD_IDS=",".join(map(str, group)), SHARD_PROCESSES="1")
+        if Config.METRICS_PORT:
+            # У каждого процесса свой эндпоинт метрик
+            env["METRICS_PORT"] = str(Config.METRICS_PORT + index)
+        processes.append(subprocess.Popen([sys.executable, os.path.abspath(__file__)], env=env))
+    try:
+        for process in processes:
+            process.wait()
+    except KeyboardInterrupt:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait()
+
+startup.record("import", time.monotonic() - STARTED_AT)
+
 # Запуск бота
 if __name__ == "__main__":
-    bot.run(Config.DISCORD_TOKEN)
\ No newline at end of file
+    if Config.SHARD_PROCESSES > 1:
+        run_shard_processes()
+    else:
+        bot.run(Config.DISCORD_TOKEN)
\ No newline at end of file
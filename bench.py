@@ -0,0 +1,514 @@
+"""Офлайн-бенчмарк бота: воспроизводит поток сообщений через on_message и !gemini
+на поддельных Discord и Gemini, без токенов и сети.
+
+    python bench.py                                # синтетический поток
+    python bench.py --record trace.jsonl           # сохранить синтетический поток
+    python bench.py --trace trace.jsonl --json     # воспроизвести записанный поток
+
+Строка трассы: {"t": секунды от начала, "guild": id или null (ЛС), "channel": id, "user": id,
+"content": текст, "mention": true/false}. Настройки бота берутся из переменных окружения, как обычно.
+"""
+import os
+import sys
+import argparse
+import asyncio
+import datetime
+import importlib.util
+import json
+import random
+import re
+import resource
+import time
+import tracemalloc
+from collections import defaultdict
+from typing import Dict, List, Optional
+
+# Бенчмарк не должен упираться в лимиты и писать на диск, если не попросили иначе
+BENCH_DEFAULTS = {
+    "STORAGE_BACKEND": "memory",
+    "SHARED_STATE": "local",
+    "METRICS_PORT": "0",
+    "USER_RATE_PER_MINUTE": "1000000",
+    "USER_BURST": "1000000",
+    "GUILD_RATE_PER_MINUTE": "1000000",
+    "GUILD_BURST": "1000000",
+    "GLOBAL_RATE_PER_MINUTE": "1000000",
+    "GLOBAL_BURST": "1000000",
+    "QUEUE_LIMIT": "100000",
+    "QUEUE_LIMIT_PER_GUILD": "100000"
+}
+
+BOT_ID = 1
+# Метка вопроса в тексте сообщения, поддельный Gemini повторяет ее в ответе
+TAG = re.compile(r"\[q(\d+)\]")
+WORDS = ("бот", "вопрос", "код", "python", "ошибка", "модель", "сервер", "почему", "как", "пример", "данные", "список")
+
+
+def load_bot_module():
+    for key, value in BENCH_DEFAULTS.items():
+        os.environ.setdefault(key, value)
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "1.py")
+    spec = importlib.util.spec_from_file_location("gemini_bot", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+# Поддельный Gemini с настраиваемой задержкой и скоростью генерации
+class FakeUsage:
+    def __init__(self, prompt_tokens: int, output_tokens: int):
+        self.prompt_token_count = prompt_tokens
+        self.candidates_token_count = output_tokens
+
+
+class FakeChunk:
+    def __init__(self, text: str, usage: Optional[FakeUsage] = None):
+        self.text = text
+        self.usage_metadata = usage
+
+
+class FakeStream:
+    def __init__(self, gemini: "FakeGemini", text: str, usage: FakeUsage):
+        self.gemini = gemini
+        self.text = text
+        self.usage = usage
+
+    async def __aiter__(self):
+        step = self.gemini.chunk_tokens * 4
+        for start in range(0, len(self.text), step):
+            await asyncio.sleep(self.gemini.chunk_tokens / self.gemini.tokens_per_second)
+            last = start + step >= len(self.text)
+            yield FakeChunk(self.text[start:start + step], self.usage if last else None)
+
+
+class FakeChat:
+    def __init__(self, model: "FakeModel", history):
+        self.model = model
+        self.history = history
+
+    async def send_message_async(self, contents, stream: bool = False):
+        self.model.gemini.calls["chat"] += 1
+        return await self.model.respond(contents, self.history, stream)
+
+
+class FakeModel:
+    def __init__(self, gemini: "FakeGemini", model_name: str, system_instruction: Optional[str]):
+        self.gemini = gemini
+        self.model_name = model_name
+        self.registry_key = (model_name, system_instruction)
+
+    def start_chat(self, history=None):
+        return FakeChat(self, history or [])
+
+    async def generate_content_async(self, contents, stream: bool = False):
+        self.gemini.calls["generate"] += 1
+        return await self.respond(contents, [], stream)
+
+    async def respond(self, contents, history, stream: bool):
+        gemini = self.gemini
+        gemini.calls["stream" if stream else "full"] += 1
+        gemini.models[self.model_name] += 1
+        gemini.in_flight += 1
+        gemini.peak_in_flight = max(gemini.peak_in_flight, gemini.in_flight)
+        try:
+            await asyncio.sleep(gemini.latency)
+            if gemini.error_rate and gemini.random.random() < gemini.error_rate:
+                gemini.calls["errors"] += 1
+                raise gemini.quota_error("Квота исчерпана (поддельный Gemini)")
+            prompt = contents if isinstance(contents, str) else " ".join(
+                part.get("text", "") for part in contents if isinstance(part, dict)
+            )
+            text = gemini.answer(prompt)
+            usage = FakeUsage(
+                (len(prompt) + sum(len(content.parts[0].text) for content in history)) // 4, len(text) // 4
+            )
+            gemini.tokens_in += usage.prompt_token_count
+            gemini.tokens_out += usage.candidates_token_count
+            if stream:
+                return FakeStream(gemini, text, usage)
+            # Без потока ответ приходит целиком после генерации всех токенов
+            await asyncio.sleep(usage.candidates_token_count / gemini.tokens_per_second)
+            return FakeChunk(text, usage)
+        finally:
+            gemini.in_flight -= 1
+
+
+class FakeGemini:
+    def __init__(self, latency: float, tokens_per_second: float, answer_tokens: int,
+                 chunk_tokens: int, error_rate: float, quota_error, seed: int):
+        self.latency = latency
+        self.tokens_per_second = tokens_per_second
+        self.answer_tokens = answer_tokens
+        self.chunk_tokens = chunk_tokens
+        self.error_rate = error_rate
+        self.quota_error = quota_error
+        self.random = random.Random(seed)
+        self.calls: Dict[str, int] = defaultdict(int)
+        self.models: Dict[str, int] = defaultdict(int)
+        self.tokens_in = 0
+        self.tokens_out = 0
+        self.in_flight = 0
+        self.peak_in_flight = 0
+
+    def get_model(self, model_name: str, system_instruction: Optional[str] = None) -> FakeModel:
+        return FakeModel(self, model_name, system_instruction)
+
+    def answer(self, prompt: str) -> str:
+        words = []
+        while len(words) * 6 < self.answer_tokens * 4:
+            words.append(self.random.choice(WORDS))
+        body = " ".join(words)
+        tags = [f"[q{message_id}]" for message_id in TAG.findall(prompt)]
+        # Пачка упоминаний: отвечаем в формате [[N]], как просит бот
+        numbers = re.findall(r"^\[\[(\d+)\]\]", prompt, re.MULTILINE)
+        if numbers:
+            return "\n".join(
+                f"[[{number}]]\n{tag} {body[:len(body) // len(numbers)]}" for number, tag in zip(numbers, tags)
+            )
+        return " ".join(tags + [body])
+
+
+# Поддельный Discord: только то, чем пользуются on_message и команды
+class FakeUser:
+    def __init__(self, user_id: int, name: str, bot: bool = False):
+        self.id = user_id
+        self.name = name
+        self.display_name = name
+        self.bot = bot
+        self.mention = f"<@{user_id}>"
+
+    def __eq__(self, other):
+        return isinstance(other, FakeUser) and other.id == self.id
+
+    def __hash__(self):
+        return hash(self.id)
+
+    def mentioned_in(self, message: "FakeMessage") -> bool:
+        return self.mention in message.content
+
+
+class FakeGuild:
+    def __init__(self, guild_id: int):
+        self.id = guild_id
+
+
+class FakeTyping:
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+
+class FakeSentMessage:
+    def __init__(self, channel: "FakeChannel", content: str):
+        self.channel = channel
+        self.content = content
+
+    async def edit(self, content: str = None, **kwargs):
+        await self.channel.gateway.api_call("edit")
+        self.content = content
+        self.channel.gateway.on_output(self.channel, None, content, edit=True)
+        return self
+
+
+class FakeChannel:
+    def __init__(self, gateway: "FakeGateway", channel_id: int, guild: Optional[FakeGuild]):
+        self.gateway = gateway
+        self.id = channel_id
+        self.guild = guild
+
+    async def send(self, content: str = None, reference=None, **kwargs):
+        await self.gateway.api_call("send")
+        self.gateway.on_output(self, reference, content or "")
+        return FakeSentMessage(self, content or "")
+
+    def typing(self):
+        return FakeTyping()
+
+    async def history(self, limit: int = 100, before=None, after=None, oldest_first: bool = False):
+        self.gateway.calls["history"] += 1
+        await asyncio.sleep(self.gateway.api_latency)
+        for message in ():
+            yield message
+
+
+def make_dm_channel_class(discord):
+    # on_message распознает ЛС через isinstance, поэтому поддельный канал наследует DMChannel
+    class FakeDMChannel(FakeChannel, discord.DMChannel):
+        guild = None
+
+        def __init__(self, gateway: "FakeGateway", channel_id: int, guild: None = None):
+            self.gateway = gateway
+            self.id = channel_id
+    return FakeDMChannel
+
+
+class FakeMessage:
+    def __init__(self, gateway: "FakeGateway", message_id: int, author: FakeUser, channel: FakeChannel, content: str):
+        self._state = gateway.bot._connection
+        self.id = message_id
+        self.author = author
+        self.channel = channel
+        self.guild = channel.guild
+        self.content = content
+        self.clean_content = content.replace(f"<@{BOT_ID}>", "@GeminiBot")
+        self.attachments = []
+        self.created_at = datetime.datetime.now(datetime.timezone.utc)
+        self.arrived = 0.0
+        self.first_output: Optional[float] = None
+        self.replied: Optional[float] = None
+        self.handled: Optional[float] = None
+        self.rejected = False
+
+    async def reply(self, content: str = None, **kwargs):
+        return await self.channel.send(content, reference=self, **kwargs)
+
+
+class FakeGateway:
+    def __init__(self, module, api_latency: float):
+        self.module = module
+        self.bot = module.bot
+        self.api_latency = api_latency
+        self.calls: Dict[str, int] = defaultdict(int)
+        self.users: Dict[int, FakeUser] = {}
+        self.guilds: Dict[int, FakeGuild] = {}
+        self.channels: Dict[int, FakeChannel] = {}
+        self.dm_channel_class = make_dm_channel_class(module.discord)
+        # Сообщения, ожидающие ответа, по каналам
+        self.pending: Dict[int, List[FakeMessage]] = defaultdict(list)
+        self.answered: List[FakeMessage] = []
+        self.rejected: List[FakeMessage] = []
+        # Ответы без модели: сохраненный ответ или просьба подождать, пока модели недоступны
+        self.degraded: List[FakeMessage] = []
+        self.failed: List[FakeMessage] = []
+        self.messages: Dict[int, FakeMessage] = {}
+        self.next_message_id = 1000
+        self.bot._connection.user = FakeUser(BOT_ID, "GeminiBot", bot=True)
+
+    async def api_call(self, name: str):
+        self.calls[name] += 1
+        if self.api_latency:
+            await asyncio.sleep(self.api_latency)
+
+    def channel(self, channel_id: int, guild_id: Optional[int]) -> FakeChannel:
+        channel = self.channels.get(channel_id)
+        if channel is None:
+            if guild_id is None:
+                channel = self.dm_channel_class(self, channel_id, None)
+            else:
+                guild = self.guilds.setdefault(guild_id, FakeGuild(guild_id))
+                channel = FakeChannel(self, channel_id, guild)
+            self.channels[channel_id] = channel
+        return channel
+
+    def on_output(self, channel: FakeChannel, reference: Optional[FakeMessage], content: str, edit: bool = False):
+        now = time.perf_counter()
+        if reference is not None:
+            reference.replied = now
+        # Ответ поддельного Gemini начинается с метки вопроса, так ответ связывается с сообщением
+        for message_id in TAG.findall(content):
+            message = self.messages.get(int(message_id))
+            if message is not None and message.first_output is None:
+                message.first_output = now
+                self.pending[message.channel.id].remove(message)
+                self.answered.append(message)
+        pending = self.pending[channel.id]
+        if content.startswith("⏳") and "очередь" not in content and pending and not edit:
+            # Отказ планировщика отправляется сразу, до ответов на более ранние сообщения
+            message = pending.pop()
+            message.rejected = True
+            self.rejected.append(message)
+        elif pending and ("⚠️ Gemini сейчас" in content or "Не удалось получить ответ" in content):
+            # В таких ответах нет метки вопроса, они относятся к самому старому ожидающему сообщению
+            message = pending.pop(0)
+            (self.degraded if "⚠️" in content else self.failed).append(message)
+
+    def make_message(self, event: dict) -> FakeMessage:
+        user = self.users.setdefault(event["user"], FakeUser(event["user"], f"user{event['user']}"))
+        channel = self.channel(event["channel"], event.get("guild"))
+        self.next_message_id += 1
+        content = f"{event['content']} [q{self.next_message_id}]"
+        if event.get("mention"):
+            content = f"<@{BOT_ID}> {content}"
+        message = FakeMessage(self, self.next_message_id, user, channel, content)
+        if event.get("guild") is None or event.get("mention") or content.startswith("!gemini"):
+            self.pending[channel.id].append(message)
+            self.messages[message.id] = message
+        return message
+
+
+def synthetic_trace(args) -> List[dict]:
+    rng = random.Random(args.seed)
+    events = []
+    t = 0.0
+    for _ in range(args.messages):
+        t += rng.expovariate(args.rate)
+        user = rng.randrange(args.users) + 100
+        if rng.random() < args.dm_ratio:
+            guild, channel, mention = None, 10_000_000 + user, False
+        else:
+            guild = rng.randrange(args.guilds) + 10
+            channel = guild * 100 + rng.randrange(args.channels)
+            mention = rng.random() < args.mention_ratio
+        content = " ".join(rng.choice(WORDS) for _ in range(rng.randint(3, 60)))
+        if guild is not None and not mention and rng.random() < args.command_ratio:
+            content = f"!gemini {content}"
+        events.append({"t": round(t, 4), "guild": guild, "channel": channel, "user": user,
+                       "content": content, "mention": mention})
+    return events
+
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+async def replay(module, gateway: FakeGateway, trace: List[dict], speed: float) -> float:
+    module.storage.start()
+    # Как и при настоящем запуске, SDK загружается до первого сообщения (во время подключения к Discord)
+    await module.GeminiSDK.ready()
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+
+    async def handle(message: FakeMessage):
+        message.arrived = time.perf_counter()
+        try:
+            await module.on_message(message)
+        except Exception as e:
+            print(f"Ошибка обработки сообщения {message.id}: {e!r}", file=sys.stderr)
+        message.handled = time.perf_counter()
+
+    tasks = []
+    for event in trace:
+        delay = event["t"] / speed - (loop.time() - started)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        tasks.append(asyncio.create_task(handle(gateway.make_message(event))))
+    await asyncio.gather(*tasks)
+    elapsed = loop.time() - started
+    await module.storage.close()
+    return elapsed
+
+
+def report(args, module, gateway: FakeGateway, gemini: FakeGemini, trace: List[dict],
+           elapsed: float, rss_before: int, traced_peak: Optional[int]) -> dict:
+    answered = gateway.answered
+    first = [m.first_output - m.arrived for m in answered]
+    complete = [max(m.handled or 0, m.replied or 0) - m.arrived for m in answered]
+    unanswered = sum(len(messages) for messages in gateway.pending.values())
+    rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return {
+        "messages": len(trace),
+        "answered": len(answered),
+        "rejected": len(gateway.rejected),
+        "unanswered": unanswered,
+        "degraded": len(gateway.degraded),
+        "failed": len(gateway.failed),
+        "elapsed_seconds": round(elapsed, 3),
+        "throughput_answers_per_second": round(len(answered) / elapsed, 2) if elapsed else None,
+        "first_response_p50": percentile(first, 0.5),
+        "first_response_p99": percentile(first, 0.99),
+        "completion_p50": percentile(complete, 0.5),
+        "completion_p99": percentile(complete, 0.99),
+        "gemini_calls": dict(gemini.calls),
+        "gemini_models": dict(gemini.models),
+        "gemini_tokens_in": gemini.tokens_in,
+        "gemini_tokens_out": gemini.tokens_out,
+        "gemini_peak_in_flight": gemini.peak_in_flight,
+        "discord_calls": dict(gateway.calls),
+        "hot_channels": len(module.storage.items()),
+        "peak_rss_mb": round(rss_after / 1024, 1),
+        "rss_growth_mb": round((rss_after - rss_before) / 1024, 1),
+        "traced_peak_mb": round(traced_peak / 2**20, 1) if traced_peak is not None else None
+    }
+
+
+def print_report(result: dict):
+    def ms(value):
+        return "нет данных" if value is None else f"{value * 1000:.1f} мс"
+
+    print(f"Сообщений: {result['messages']}, ответов: {result['answered']}, "
+          f"отказов: {result['rejected']}, деградированных: {result['degraded']}, "
+          f"ошибок: {result['failed']}, без ответа: {result['unanswered']}")
+    print(f"Время: {result['elapsed_seconds']} с, пропускная способность: "
+          f"{result['throughput_answers_per_second']} ответов/с")
+    print(f"Первый ответ: p50 {ms(result['first_response_p50'])}, p99 {ms(result['first_response_p99'])}")
+    print(f"Полный ответ: p50 {ms(result['completion_p50'])}, p99 {ms(result['completion_p99'])}")
+    print(f"Gemini: вызовы {result['gemini_calls']}, модели {result['gemini_models']}, "
+          f"токены {result['gemini_tokens_in']}/{result['gemini_tokens_out']}, "
+          f"одновременно до {result['gemini_peak_in_flight']}")
+    print(f"Discord: {result['discord_calls']}, каналов в памяти: {result['hot_channels']}")
+    memory = f"Память: пик RSS {result['peak_rss_mb']} МБ (+{result['rss_growth_mb']} МБ за прогон)"
+    if result["traced_peak_mb"] is not None:
+        memory += f", пик Python-объектов {result['traced_peak_mb']} МБ"
+    print(memory)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--trace", help="файл трассы (JSONL) вместо синтетического потока")
+    parser.add_argument("--record", help="сохранить синтетический поток в файл и выйти")
+    parser.add_argument("--messages", type=int, default=500)
+    parser.add_argument("--rate", type=float, default=10, help="сообщений в секунду")
+    parser.add_argument("--guilds", type=int, default=20)
+    parser.add_argument("--channels", type=int, default=3, help="каналов на сервер")
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--mention-ratio", type=float, default=0.3)
+    parser.add_argument("--command-ratio", type=float, default=0.05)
+    parser.add_argument("--dm-ratio", type=float, default=0.05)
+    parser.add_argument("--speed", type=float, default=1.0, help="ускорение воспроизведения трассы")
+    parser.add_argument("--latency", type=float, default=0.3, help="задержка Gemini до первого токена, с")
+    parser.add_argument("--tokens-per-second", type=float, default=200)
+    parser.add_argument("--answer-tokens", type=int, default=150)
+    parser.add_argument("--chunk-tokens", type=int, default=20, help="токенов в одном фрагменте потока")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="доля ответов 429")
+    parser.add_argument("--discord-latency", type=float, default=0.02, help="задержка вызовов Discord API, с")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--tracemalloc", action="store_true", help="считать пик памяти Python-объектов (медленнее)")
+    parser.add_argument("--json", action="store_true", help="вывести результат в JSON")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if args.trace:
+        with open(args.trace, "r", encoding="utf-8") as f:
+            trace = [json.loads(line) for line in f if line.strip()]
+    else:
+        trace = synthetic_trace(args)
+    if args.record:
+        with open(args.record, "w", encoding="utf-8") as f:
+            for event in trace:
+                f.write(json.dumps(event, ensure_ascii=False) + "\n")
+        print(f"Записано {len(trace)} сообщений в {args.record}")
+        return
+
+    module = load_bot_module()
+    gemini = FakeGemini(
+        args.latency, args.tokens_per_second, args.answer_tokens, args.chunk_tokens,
+        args.error_rate, module.google_exceptions.ResourceExhausted, args.seed
+    )
+    module.ModelRegistry.get = gemini.get_model
+    gateway = FakeGateway(module, args.discord_latency)
+
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if args.tracemalloc:
+        tracemalloc.start()
+    elapsed = asyncio.run(replay(module, gateway, trace, args.speed))
+    traced_peak = None
+    if args.tracemalloc:
+        traced_peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    result = report(args, module, gateway, gemini, trace, elapsed, rss_before, traced_peak)
+    if args.json:
+        print(json.dumps(result, ensure_ascii=False, indent=2))
+    else:
+        print_report(result)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+"""Бенчмарк памяти истории: байт на сохраненное сообщение при N каналов по M сообщений.
+
+Варианты (каждый в отдельном процессе, по приросту пикового RSS):
+  baseline - исходный формат: словари в deque(maxlen=1000) на канал
+  stored   - ConversationContext с компактными HistoryRecord, до отправки в модель
+  sent     - то же после history() в каждом канале: собранные protos.Content остаются
+             только у HISTORY_WINDOW_CACHE последних запрошенных каналов
+
+    python bench_memory.py                          # 10k каналов x 1000 сообщений
+    python bench_memory.py --channels 1000 --json
+"""
+import argparse
+import datetime
+import json
+import multiprocessing
+import random
+import resource
+from collections import deque
+
+from bench import WORDS, load_bot_module
+
+
+def peak_rss() -> int:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def messages(rng: random.Random, count: int):
+    """Сообщения со средней длиной ~80 символов от пула из 200 авторов"""
+    authors = [f"user{i}" for i in range(200)]
+    for i in range(count):
+        yield ("user" if i % 2 == 0 else "model"), " ".join(rng.choices(WORDS, k=rng.randint(4, 20))), rng.choice(authors)
+
+
+def measure(variant: str, channels: int, per_channel: int, seed: int, results):
+    module = load_bot_module()
+    module.genai.load()
+    rng = random.Random(seed)
+    # Прогрев: первые объекты protos и типов создаются до замера
+    module.ConversationContext().append(module.HistoryRecord("user", "x", "user"))
+    before = peak_rss()
+    store = []
+    for _ in range(channels):
+        if variant == "baseline":
+            conversation = deque(maxlen=1000)
+            for role, text, author in messages(rng, per_channel):
+                conversation.append({"role": role, "content": text, "time": datetime.datetime.now()})
+        else:
+            conversation = module.ConversationContext(max_messages=per_channel, max_tokens=10 ** 9)
+            for role, text, author in messages(rng, per_channel):
+                conversation.append(module.HistoryRecord(role, text, author))
+            if variant == "sent":
+                conversation.history()
+        store.append(conversation)
+    results.put((variant, (peak_rss() - before) / (channels * per_channel)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--channels", type=int, default=10000)
+    parser.add_argument("--messages", type=int, default=1000, help="сообщений на канал")
+    parser.add_argument("--variants", nargs="+", default=["baseline", "stored", "sent"],
+                        choices=["baseline", "stored", "sent"])
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", action="store_true", help="вывести результат в JSON")
+    args = parser.parse_args()
+
+    results = multiprocessing.Queue()
+    bytes_per_message = {}
+    for variant in args.variants:
+        process = multiprocessing.Process(target=measure, args=(variant, args.channels, args.messages, args.seed, results))
+        process.start()
+        process.join()
+        if process.exitcode != 0:
+            raise SystemExit(f"Вариант {variant} завершился с кодом {process.exitcode} (не хватило памяти?)")
+        name, value = results.get()
+        bytes_per_message[name] = round(value)
+
+    if args.json:
+        print(json.dumps({"channels": args.channels, "messages": args.messages,
+                          "bytes_per_message": bytes_per_message}, ensure_ascii=False, indent=2))
+        return
+    print(f"Каналов: {args.channels}, сообщений на канал: {args.messages}")
+    for variant, value in bytes_per_message.items():
+        print(f"{variant:>8}: {value} байт на сообщение, "
+              f"{value * args.channels * args.messages / 2**30:.2f} ГБ всего")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+"""Микробенчмарк подготовки запроса к Gemini (без сети): сколько стоит получить модель
+и историю канала перед отправкой.
+
+До: новый GenerativeModel на каждый запрос и история из словарей, которую SDK заново
+преобразует в protos.Content. После: модель из ModelRegistry и история из окна protos.Content,
+которое ConversationContext хранит между запросами (достраиваются только новые сообщения).
+Холодный запрос (after_cold) собирает окно заново: так отвечает канал, выпавший из HISTORY_WINDOW_CACHE.
+
+    python bench_models.py
+    python bench_models.py --history 0 100 1000 --requests 2000 --json
+"""
+import argparse
+import json
+import time
+
+from bench import load_bot_module
+
+
+def per_request(function, requests: int) -> float:
+    function()
+    started = time.perf_counter()
+    for _ in range(requests):
+        function()
+    return (time.perf_counter() - started) / requests
+
+
+def measure(module, history_size: int, requests: int) -> dict:
+    genai = module.genai
+    model_name = module.Config.DEFAULT_MODEL
+    messages = [
+        {"role": "user" if i % 2 == 0 else "assistant", "content": f"сообщение {i} " + "текст " * 20}
+        for i in range(history_size)
+    ]
+
+    def before():
+        # Как в исходной версии бота
+        model = genai.GenerativeModel(model_name, safety_settings=module.SAFETY_SETTINGS)
+        history = [
+            {"role": "user" if message["role"] == "user" else "model", "parts": [message["content"]]}
+            for message in messages
+        ]
+        if history:
+            model.start_chat(history=history)
+
+    context = module.ConversationContext()
+    for message in messages:
+        role = "user" if message["role"] == "user" else "model"
+        context.append(module.HistoryRecord(role, message["content"], "user"))
+
+    def after():
+        model = module.ModelRegistry.get(model_name)
+        history = context.history(module.Config.get_token_budget(model_name))
+        if history:
+            model.start_chat(history=history)
+
+    def after_cold():
+        context.drop_window()
+        after()
+
+    before_seconds = per_request(before, requests)
+    after_seconds = per_request(after, requests)
+    cold_seconds = per_request(after_cold, requests)
+    return {
+        "history": history_size,
+        "before_us": round(before_seconds * 1e6, 1),
+        "after_us": round(after_seconds * 1e6, 1),
+        "after_cold_us": round(cold_seconds * 1e6, 1),
+        "speedup": round(before_seconds / after_seconds, 1)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--history", type=int, nargs="+", default=[0, 20, 200, 1000], help="сообщений в истории")
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--json", action="store_true", help="вывести результат в JSON")
+    args = parser.parse_args()
+
+    module = load_bot_module()
+    module.genai.load()
+    results = [measure(module, size, args.requests) for size in args.history]
+    if args.json:
+        print(json.dumps(results, ensure_ascii=False, indent=2))
+        return
+    for result in results:
+        print(f"История {result['history']:>5}: до {result['before_us']} мкс, после {result['after_us']} мкс "
+              f"(в {result['speedup']} раз быстрее), без сохраненного окна {result['after_cold_us']} мкс")
+
+
+if __name__ == "__main__":
+    main()
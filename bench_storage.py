@@ -0,0 +1,99 @@
+"""Бенчмарк хранилища истории: скорость добавления сообщений (запись на диск идет в фоне)
+и задержка загрузки холодного канала при большом числе каналов.
+
+    python bench_storage.py                                  # SQLite, 100k каналов
+    python bench_storage.py --backend memory --channels 10000
+    python bench_storage.py --json
+"""
+import os
+import argparse
+import asyncio
+import json
+import random
+import tempfile
+import time
+from typing import List
+
+from bench import load_bot_module, percentile
+
+
+async def run(module, args, path: str) -> dict:
+    if args.backend == "sqlite":
+        factory = lambda: module.SQLiteStorage(path)
+    else:
+        factory = module.MemoryStorage
+    store = module.ConversationStore(factory, hot_limit=args.hot)
+    store.start()
+    rng = random.Random(args.seed)
+
+    # Добавление: так on_message записывает сообщения, не дожидаясь диска
+    total = args.channels * args.messages
+    channels = [rng.randrange(args.channels) for _ in range(total)]
+    append_time = 0.0
+    started = time.perf_counter()
+    for i, channel_id in enumerate(channels):
+        record = module.HistoryRecord("user", f"сообщение {i} в канале {channel_id}", f"user{i % 500}")
+        t = time.perf_counter()
+        store.append(channel_id, record)
+        append_time += time.perf_counter() - t
+        if i % 1000 == 999:
+            # Отдаем управление циклу, как между событиями Discord, чтобы фоновая запись шла параллельно
+            await asyncio.sleep(0)
+    await store.flush()
+    written = time.perf_counter() - started
+
+    # Холодные каналы: их нет в памяти, история читается из хранилища при обращении
+    cold: List[float] = []
+    for channel_id in rng.sample(range(args.channels), args.samples):
+        t = time.perf_counter()
+        await store.get(channel_id)
+        cold.append(time.perf_counter() - t)
+    hot: List[float] = []
+    for channel_id in list(store._hot)[-args.samples:]:
+        t = time.perf_counter()
+        await store.get(channel_id)
+        hot.append(time.perf_counter() - t)
+    await store.close()
+
+    return {
+        "backend": args.backend,
+        "channels": args.channels,
+        "messages": total,
+        "append_us": round(append_time / total * 1e6, 2),
+        "append_per_second": round(total / append_time),
+        "written_per_second": round(total / written),
+        "cold_load_p50_ms": round(percentile(cold, 0.5) * 1000, 3),
+        "cold_load_p99_ms": round(percentile(cold, 0.99) * 1000, 3),
+        "hot_get_p50_us": round(percentile(hot, 0.5) * 1e6, 2),
+        "database_mb": round(os.path.getsize(path) / 2**20, 1) if os.path.exists(path) else None
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--backend", choices=("sqlite", "memory"), default="sqlite")
+    parser.add_argument("--channels", type=int, default=100000)
+    parser.add_argument("--messages", type=int, default=10, help="сообщений на канал")
+    parser.add_argument("--hot", type=int, default=1000, help="каналов в памяти (HOT_CHANNEL_LIMIT)")
+    parser.add_argument("--samples", type=int, default=1000, help="сколько каналов загрузить для замера")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", action="store_true", help="вывести результат в JSON")
+    args = parser.parse_args()
+
+    module = load_bot_module()
+    with tempfile.TemporaryDirectory() as directory:
+        result = asyncio.run(run(module, args, os.path.join(directory, "bench.db")))
+    if args.json:
+        print(json.dumps(result, ensure_ascii=False, indent=2))
+        return
+    print(f"Хранилище: {result['backend']}, каналов: {result['channels']}, сообщений: {result['messages']}")
+    print(f"Добавление: {result['append_us']} мкс на сообщение ({result['append_per_second']}/с), "
+          f"запись на диск: {result['written_per_second']} сообщений/с")
+    print(f"Холодный канал: p50 {result['cold_load_p50_ms']} мс, p99 {result['cold_load_p99_ms']} мс; "
+          f"горячий: p50 {result['hot_get_p50_us']} мкс")
+    if result["database_mb"] is not None:
+        print(f"Размер базы: {result['database_mb']} МБ")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,52 @@
+"""Общие фикстуры тестов: бот загружается из 1.py заново для каждого теста,
+Gemini и Discord поддельные (из bench.py), сеть и токены не нужны"""
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bench  # noqa: E402
+
+
+def make_gemini(module, latency: float = 0.05, error_rate: float = 0.0, answer_tokens: int = 20):
+    """Подменяет модели бота поддельным Gemini с заданной задержкой и долей ошибок 429"""
+    gemini = bench.FakeGemini(
+        latency, tokens_per_second=100000, answer_tokens=answer_tokens, chunk_tokens=20,
+        error_rate=error_rate, quota_error=module.google_exceptions.ResourceExhausted, seed=1
+    )
+    module.ModelRegistry.get = gemini.get_model
+    return gemini
+
+
+def configure(bot, workers: int = 1, **limits):
+    """Снимает лимиты планировщика (кроме переданных в limits) и создает новый планировщик"""
+    settings = dict(
+        USER_RATE_PER_MINUTE=600000, USER_BURST=1000, GUILD_RATE_PER_MINUTE=600000, GUILD_BURST=1000,
+        GLOBAL_RATE_PER_MINUTE=600000, GLOBAL_BURST=1000, QUEUE_LIMIT=1000, QUEUE_LIMIT_PER_GUILD=1000,
+        MAX_CONCURRENT_REQUESTS=workers, PRIORITY_WORKERS=0, RETRY_BASE_DELAY=0.01, RETRY_MAX_DELAY=0.05
+    )
+    settings.update(limits)
+    for name, value in settings.items():
+        setattr(bot.Config, name, value)
+    bot.scheduler = bot.RequestScheduler()
+    return bot.scheduler
+
+
+def ask(bot, gemini, prompt: str):
+    """Задача планировщика: запрос к поддельному Gemini через GeminiClient"""
+    async def job():
+        response = await bot.GeminiClient.call_model(gemini.get_model("models/gemini-2.0-flash"), [], prompt)
+        return prompt, response.text
+    return job
+
+
+@pytest.fixture
+def bot():
+    return bench.load_bot_module()
+
+
+@pytest.fixture
+def gemini(bot):
+    return make_gemini(bot)
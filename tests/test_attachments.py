@@ -0,0 +1,55 @@
+"""Вложения-изображения: непринятые вложения объясняются пользователю, без изображений модель не вызывается"""
+import asyncio
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+PNG = b"\x89PNG\r\n\x1a\n" + b"\0" * 100
+
+
+async def serve(bot):
+    async def image(request):
+        name = request.match_info["name"]
+        if name == "big.png":
+            return web.Response(body=b"\0" * (bot.Config.MAX_IMAGE_BYTES + 1))
+        if name == "notes.txt":
+            return web.Response(body=b"just text", content_type="text/plain")
+        if name == "cat.png":
+            return web.Response(body=PNG)
+        return web.Response(status=404)
+
+    app = web.Application()
+    app.router.add_get("/{name}", image)
+    server = TestServer(app)
+    await server.start_server()
+    return server
+
+
+def ask(bot, names):
+    async def run():
+        server = await serve(bot)
+        try:
+            urls = [str(server.make_url(f"/{name}")) + "?ex=1" for name in names]
+            return await bot.GeminiClient.generate_response("Что на картинке?", 1, 10, urls, stateless=True)
+        finally:
+            await bot.AttachmentFetcher.close()
+            await server.close()
+    return asyncio.run(run())
+
+
+def test_rejected_images_are_reported_without_generation(bot, gemini):
+    bot.Config.MAX_IMAGE_BYTES = 2 ** 20
+    text = ask(bot, ["big.png", "notes.txt", "gone.png"])
+    assert text.splitlines() == [
+        "⚠️ Вложение big.png не принято: размер больше 1 МБ.",
+        "⚠️ Вложение notes.txt не принято: формат не поддерживается (нужен PNG, JPEG, GIF, WEBP или HEIC).",
+        "⚠️ Вложение gone.png не принято: не удалось загрузить (HTTP 404).",
+    ]
+    assert sum(gemini.calls.values()) == 0
+
+
+def test_partly_rejected_images_still_answered(bot, gemini):
+    text = ask(bot, ["cat.png", "notes.txt"])
+    notice, answer = text.split("\n\n", 1)
+    assert notice.startswith("⚠️ Вложение notes.txt не принято")
+    assert answer and gemini.calls["generate"] == 1
@@ -0,0 +1,70 @@
+"""Пачки упоминаний: лимиты каждого спросившего и устойчивость к ошибкам одной пачки"""
+import asyncio
+
+import bench
+from conftest import configure
+
+
+class RecordingChannel(bench.FakeChannel):
+    """Канал, запоминающий отправленные сообщения вместе с сообщением, на которое дан ответ"""
+    def __init__(self, gateway, channel_id):
+        super().__init__(gateway, channel_id, bench.FakeGuild(1))
+        self.sent = []
+
+    async def send(self, content: str = None, reference=None, **kwargs):
+        self.sent.append((reference, content))
+        return bench.FakeSentMessage(self, content or "")
+
+
+def mentions(bot, channel, authors):
+    gateway = channel.gateway
+    return [
+        bot.MentionBatch(bench.FakeMessage(gateway, 100 + i, author, channel, f"вопрос {i}"), f"вопрос {i}", None)
+        for i, author in enumerate(authors)
+    ]
+
+
+def test_every_asker_pays_for_batch(bot, gemini, monkeypatch):
+    configure(bot, USER_BURST=1, USER_RATE_PER_MINUTE=1)
+    channel = RecordingChannel(bench.FakeGateway(bot, 0), 5)
+    anna, boris = bench.FakeUser(1, "anna"), bench.FakeUser(2, "boris")
+    items = mentions(bot, channel, [anna, boris, anna, anna])
+    answered = []
+
+    async def answer(batch, server_id):
+        answered.append([item.message.id for item in batch])
+
+    monkeypatch.setattr(bot.batcher, "answer", answer)
+    asyncio.run(bot.batcher.dispatch(items))
+    # Первое упоминание anna и упоминание boris отвечены одной пачкой, лишние упоминания anna отклонены
+    assert answered == [[100, 101]]
+    rejected = [reference.id for reference, content in channel.sent if content.startswith("⏳ Слишком много")]
+    assert rejected == [102, 103]
+
+
+def test_failed_batch_keeps_pending_mentions(bot, gemini, monkeypatch):
+    configure(bot)
+    bot.Config.BATCH_MAX = 2
+    channel = RecordingChannel(bench.FakeGateway(bot, 0), 5)
+    items = mentions(bot, channel, [bench.FakeUser(i, f"user{i}") for i in range(5)])
+    dispatched = []
+
+    async def dispatch(batch):
+        dispatched.append([item.message.id for item in batch])
+        await asyncio.sleep(0.01)
+        if len(dispatched) == 1:
+            raise RuntimeError("сбой Discord")
+
+    monkeypatch.setattr(bot.batcher, "dispatch", dispatch)
+
+    async def run():
+        first = asyncio.create_task(bot.batcher.add(items[0].message, items[0].content, None))
+        await asyncio.sleep(0)
+        # Пока первая пачка обрабатывается, приходят остальные упоминания
+        for item in items[1:]:
+            await bot.batcher.add(item.message, item.content, None)
+        await first
+
+    asyncio.run(run())
+    # Ошибка первой пачки не теряет упоминания, пришедшие за ней
+    assert dispatched == [[100], [101, 102], [103, 104]]
@@ -0,0 +1,98 @@
+"""Предохранители моделей: ошибки квоты идут в отступ планировщика, сбои модели открывают предохранитель"""
+import asyncio
+
+import pytest
+
+import bench
+from conftest import ask, configure
+
+
+def failing(bot, monkeypatch, error, count: int):
+    """Первые count ответов поддельной модели - ошибка error"""
+    failures = {"left": count}
+    respond = bench.FakeModel.respond
+
+    async def flaky(model, contents, history, stream):
+        if failures["left"]:
+            failures["left"] -= 1
+            raise error("ошибка")
+        return await respond(model, contents, history, stream)
+
+    monkeypatch.setattr(bench.FakeModel, "respond", flaky)
+    bot.Config.MODEL_FALLBACKS = {}
+
+
+def test_quota_errors_do_not_open_breaker(bot, gemini, monkeypatch):
+    scheduler = configure(bot, MAX_RETRIES=10)
+    failing(bot, monkeypatch, bot.google_exceptions.ResourceExhausted, 2 * bot.Config.BREAKER_FAILURES)
+    prompt, text = asyncio.run(scheduler.run(1, 1, ask(bot, gemini, "q")))
+    # Запрос дожидается квоты с отступом, а не получает отказ предохранителя
+    assert text
+    breaker = bot.ModelRouter.breaker("models/gemini-2.0-flash")
+    assert breaker.state == bot.CircuitBreaker.CLOSED and breaker.failures == 0
+
+
+def test_server_errors_open_breaker(bot, gemini, monkeypatch):
+    scheduler = configure(bot, MAX_RETRIES=0)
+    failing(bot, monkeypatch, bot.google_exceptions.ServiceUnavailable, bot.Config.BREAKER_FAILURES)
+
+    async def run():
+        for _ in range(bot.Config.BREAKER_FAILURES):
+            with pytest.raises(bot.google_exceptions.ServiceUnavailable):
+                await scheduler.run(1, 1, ask(bot, gemini, "q"))
+        with pytest.raises(bot.CircuitOpenError):
+            await scheduler.run(1, 1, ask(bot, gemini, "q"))
+
+    asyncio.run(run())
+    assert bot.ModelRouter.breaker("models/gemini-2.0-flash").state == bot.CircuitBreaker.OPEN
+
+
+class FallbackModel:
+    """Модель, которая отвечает ошибкой error или потоком, зависающим после первого фрагмента"""
+    def __init__(self, name: str, error=None):
+        self.model_name = name
+        self.registry_key = (name, None)
+        self.error = error
+
+    async def generate_content_async(self, contents, stream: bool = False):
+        if self.error:
+            raise self.error("перегружена")
+
+        async def chunks():
+            yield bench.FakeChunk("начало", bench.FakeUsage(1, 1))
+            await asyncio.sleep(10)
+        return chunks() if stream else bench.FakeChunk("ответ", bench.FakeUsage(5, 5))
+
+
+def with_fallback(bot, monkeypatch):
+    primary = FallbackModel("models/primary", bot.google_exceptions.ServiceUnavailable)
+    models = {"models/primary": primary, "models/fallback": FallbackModel("models/fallback")}
+    monkeypatch.setattr(bot.ModelRegistry, "get", lambda name, instruction=None: models[name])
+    bot.Config.MODEL_FALLBACKS = {"models/primary": "models/fallback"}
+    bot.Config.REQUEST_TIMEOUT = 0.05
+    return primary
+
+
+def test_stream_stall_counts_against_fallback(bot, monkeypatch):
+    primary = with_fallback(bot, monkeypatch)
+
+    async def run():
+        texts = []
+        with pytest.raises(asyncio.TimeoutError):
+            async for text in bot.GeminiClient.stream_model(primary, [], "q"):
+                texts.append(text)
+        return texts
+
+    assert asyncio.run(run()) == ["начало"]
+    # Зависла замена: сбой записан ей, а не основной модели, уже получившей свою ошибку 503
+    assert bot.ModelRouter.breaker("models/fallback").failures == 1
+    assert bot.ModelRouter.breaker("models/primary").failures == 1
+
+
+def test_usage_recorded_for_fallback(bot, monkeypatch):
+    primary = with_fallback(bot, monkeypatch)
+    usage = []
+    monkeypatch.setattr(bot.metrics, "record_usage", lambda metadata, model_name: usage.append(model_name))
+    response = asyncio.run(bot.GeminiClient.call_model(primary, [], "q"))
+    assert response.text == "ответ"
+    assert usage == ["models/fallback"]
@@ -0,0 +1,68 @@
+"""Запись истории каналов: догрузка пропущенных сообщений при обращении к боту"""
+import asyncio
+import datetime
+
+import bench
+
+
+class SlowHistoryChannel(bench.FakeChannel):
+    """Канал, история которого приходит из Discord с задержкой"""
+    def __init__(self, gateway, channel_id, old_messages, delay: float):
+        super().__init__(gateway, channel_id, bench.FakeGuild(1))
+        self.old_messages = old_messages
+        self.delay = delay
+
+    async def history(self, limit: int = 100, before=None, after=None, oldest_first: bool = False):
+        self.gateway.calls["history"] += 1
+        await asyncio.sleep(self.delay)
+        for message in reversed(self.old_messages):
+            yield message
+
+
+def test_messages_during_backfill_keep_order(bot):
+    gateway = bench.FakeGateway(bot, 0)
+    author = bench.FakeUser(10, "anna")
+    start = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(minutes=5)
+    channel = SlowHistoryChannel(gateway, 5, [], delay=0.05)
+    old = []
+    for i in range(3):
+        message = bench.FakeMessage(gateway, 100 + i, author, channel, f"старое {i}")
+        message.created_at = start + datetime.timedelta(seconds=i)
+        old.append(message)
+    channel.old_messages = old
+
+    def record(text):
+        return bot.HistoryRecord("user", text, "anna")
+
+    async def run():
+        first = asyncio.create_task(bot.capture.engage(channel, None, record("обращение 1")))
+        await asyncio.sleep(0.01)
+        # Пока история догружается: обычное сообщение и второе обращение
+        bot.capture.observe(channel.id, record("обычное"))
+        second = asyncio.create_task(bot.capture.engage(channel, None, record("обращение 2")))
+        await asyncio.sleep(0.01)
+        assert not second.done()
+        await asyncio.gather(first, second)
+        bot.capture.observe(channel.id, record("после"))
+        context = await bot.storage.get(channel.id)
+        return [r.content for r in context._records[context._start:]], gateway.calls["history"]
+
+    contents, history_calls = asyncio.run(run())
+    assert contents == ["старое 0", "старое 1", "старое 2", "обращение 1", "обычное", "обращение 2", "после"]
+    assert history_calls == 1
+
+
+def test_idle_ring_used_without_backfill(bot):
+    bot.Config.BACKFILL_LIMIT = 0
+    gateway = bench.FakeGateway(bot, 0)
+    channel = bench.FakeChannel(gateway, 7, bench.FakeGuild(1))
+
+    async def run():
+        for i in range(3):
+            bot.capture.observe(channel.id, bot.HistoryRecord("user", f"фон {i}", "bob"))
+        assert bot.storage.peek(channel.id) is None
+        await bot.capture.engage(channel, None, bot.HistoryRecord("user", "обращение", "anna"))
+        context = await bot.storage.get(channel.id)
+        return [r.content for r in context._records[context._start:]]
+
+    assert asyncio.run(run()) == ["фон 0", "фон 1", "фон 2", "обращение"]
@@ -0,0 +1,52 @@
+"""Нагрузочный тест: запросы к поддельному Gemini с задержкой выполняются параллельно,
+и пропускная способность растет вместе с GEMINI_MAX_CONCURRENCY"""
+import asyncio
+import time
+
+import bench
+from conftest import make_gemini
+
+LATENCY = 0.05
+REQUESTS = 32
+
+
+def measure(concurrency: int) -> tuple:
+    module = bench.load_bot_module()
+    module.Config.MAX_CONCURRENT_REQUESTS = concurrency
+    gemini = make_gemini(module, latency=LATENCY)
+
+    async def run():
+        started = time.perf_counter()
+        answers = await asyncio.gather(*(
+            module.GeminiClient.generate_response(f"вопрос {i}", channel_id=i, stateless=True)
+            for i in range(REQUESTS)
+        ))
+        return answers, time.perf_counter() - started
+
+    answers, elapsed = asyncio.run(run())
+    assert all(answer and "Не удалось" not in answer for answer in answers)
+    return REQUESTS / elapsed, gemini.peak_in_flight
+
+
+def test_throughput_scales_with_concurrency():
+    results = {concurrency: measure(concurrency) for concurrency in (1, 2, 4, 8)}
+    for concurrency, (_, peak) in results.items():
+        assert peak == concurrency
+    throughput = [results[concurrency][0] for concurrency in (1, 2, 4, 8)]
+    assert throughput == sorted(throughput)
+    # Последовательное выполнение дало бы ~1/LATENCY ответов в секунду при любом ограничении
+    assert throughput[-1] > 5 * throughput[0]
+
+
+def test_timeout_cancels_slow_request(bot):
+    bot.Config.REQUEST_TIMEOUT = 0.05
+    make_gemini(bot, latency=1.0)
+
+    async def run():
+        started = time.perf_counter()
+        answer = await bot.GeminiClient.generate_response("вопрос", channel_id=1, stateless=True)
+        return answer, time.perf_counter() - started
+
+    answer, elapsed = asyncio.run(run())
+    assert elapsed < 0.5
+    assert answer.startswith("Gemini не ответил")
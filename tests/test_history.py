@@ -0,0 +1,165 @@
+"""История каналов: сжатие в краткое содержание и его гонки с /clear"""
+import asyncio
+import time
+
+import bench
+
+
+class SummaryModel:
+    """Модель для сжатия, которая отвечает с задержкой, чтобы успеть очистить канал"""
+    def __init__(self, delay: float, text: str = "SECRET SUMMARY"):
+        self.model_name = "models/summary"
+        self.registry_key = (self.model_name, None)
+        self.delay = delay
+        self.text = text
+
+    async def generate_content_async(self, contents, stream: bool = False):
+        await asyncio.sleep(self.delay)
+        return bench.FakeChunk(self.text, bench.FakeUsage(10, 10))
+
+
+def fill(bot, channel_id: int, count: int):
+    for i in range(count):
+        bot.storage.append(channel_id, bot.HistoryRecord("user", f"сообщение {i}", "user"))
+
+
+async def compacted_context(bot, clear_during: bool):
+    bot.Config.COMPACTION_KEEP_RECENT = 5
+    bot.ModelRegistry.get = lambda *args: SummaryModel(0.05)
+    await bot.storage.get(1)
+    fill(bot, 1, 30)
+    context = await bot.storage.get(1)
+    task = asyncio.create_task(bot.HistoryCompactor.compact(1, context))
+    await asyncio.sleep(0.01)
+    if clear_during:
+        bot.storage.clear(1)
+        fill(bot, 1, 2)
+    await task
+    await bot.storage.flush()
+    return context
+
+
+def test_summary_replaces_old_messages(bot):
+    context = asyncio.run(compacted_context(bot, clear_during=False))
+    assert context.summary == "SECRET SUMMARY"
+    assert len(context) == 5
+    assert bot.storage.backend.summaries[1] == "SECRET SUMMARY"
+    assert len(bot.storage.backend.messages[1]) == 5
+
+
+def test_clear_during_compaction_drops_summary(bot):
+    context = asyncio.run(compacted_context(bot, clear_during=True))
+    assert context.summary == ""
+    # Сообщения, написанные после очистки, не должны быть отброшены устаревшим сжатием
+    assert [record.content for record in context._records[context._start:]] == ["сообщение 0", "сообщение 1"]
+    assert 1 not in bot.storage.backend.summaries
+    assert len(bot.storage.backend.messages[1]) == 2
+
+
+def test_compaction_waits_for_sdk(bot):
+    calls = []
+
+    async def ready():
+        await asyncio.sleep(0.01)
+        calls.append("ready")
+
+    def get(*args):
+        calls.append("model")
+        return SummaryModel(0)
+
+    bot.GeminiSDK.ready = ready
+
+    async def run():
+        bot.Config.COMPACTION_KEEP_RECENT = 5
+        fill(bot, 1, 30)
+        context = await bot.storage.get(1)
+        bot.ModelRegistry.get = get
+        await bot.HistoryCompactor.compact(1, context)
+        return context
+
+    assert asyncio.run(run()).summary == "SECRET SUMMARY"
+    assert calls == ["ready", "model"]
+
+
+def test_history_does_not_keep_api_contents(bot):
+    bot.genai.load()
+    context = bot.ConversationContext()
+    context.append(bot.HistoryRecord("user", "привет", "anna"))
+    context.append(bot.HistoryRecord("model", "здравствуйте"))
+    history = context.history()
+    assert [(content.role, content.parts[0].text) for content in history] == [
+        ("user", "anna: привет"), ("model", "здравствуйте")
+    ]
+    # Записи остаются компактными и после отправки в модель
+    assert all(not hasattr(record, "__dict__") and len(record.__slots__) == 4 for record in context._records)
+
+
+def test_current_message_not_repeated_after_reload(bot, gemini, tmp_path):
+    # Канал не в памяти: запись обращения уходит в очередь записи и возвращается из SQLite новым объектом
+    bot.Config.CAPTURE_POLICY = "all"
+    bot.storage.backend = bot.SQLiteStorage(str(tmp_path / "history.db"))
+    bot.storage.backend.apply([("append", 1, bot.HistoryRecord("user", "старое", "anna"))])
+
+    async def run():
+        record = bot.HistoryRecord("user", "новый вопрос", "anna")
+        bot.capture.observe(1, record)
+        _, history, contents, _, _, _ = await bot.GeminiClient.prepare_request(
+            "новый вопрос", 1, 10, None, record=record
+        )
+        await bot.storage.close()
+        return [content.parts[0].text for content in history], contents
+
+    history, contents = asyncio.run(run())
+    assert history == ["anna: старое"]
+    assert contents == "anna: новый вопрос"
+
+
+def test_message_written_during_load_is_not_duplicated(bot):
+    class SlowStorage(bot.MemoryStorage):
+        def load_channel(self, channel_id, limit):
+            # Чтение идет в потоке; пока оно длится, успевает прийти новое сообщение
+            time.sleep(0.1)
+            return super().load_channel(channel_id, limit)
+
+    bot.storage.backend = SlowStorage()
+    bot.storage.backend.apply([("append", 1, bot.HistoryRecord("user", "old", "anna"))])
+
+    async def run():
+        loading = asyncio.create_task(bot.storage.get(1))
+        await asyncio.sleep(0.02)
+        bot.storage.append(1, bot.HistoryRecord("user", "new", "anna"))
+        # Фоновая запись во время загрузки
+        await asyncio.gather(loading, bot.storage.flush())
+        context = await bot.storage.get(1)
+        return [record.content for record in context._records[context._start:]]
+
+    assert asyncio.run(run()) == ["old", "new"]
+
+
+def test_history_window_built_once_per_message(bot, monkeypatch):
+    bot.genai.load()
+    bot.Config.HISTORY_WINDOW_CACHE = 2
+    built = []
+    to_content = bot.HistoryRecord.to_content
+    monkeypatch.setattr(bot.HistoryRecord, "to_content", lambda record: built.append(record) or to_content(record))
+    contexts = [bot.ConversationContext() for _ in range(3)]
+    for context in contexts:
+        for i in range(10):
+            context.append(bot.HistoryRecord("user", f"сообщение {i}", "anna"))
+
+    first = contexts[0]
+    first.history()
+    current = bot.HistoryRecord("user", "вопрос", "anna")
+    first.append(current)
+    built.clear()
+    history = first.history(exclude=(current,))
+    # Повторный запрос собирает только новое сообщение, а исключенное в ответ не попадает
+    assert built == [current]
+    assert [content.parts[0].text for content in history] == [f"anna: сообщение {i}" for i in range(10)]
+
+    # Окна хранятся только у HISTORY_WINDOW_CACHE последних запрошенных каналов
+    contexts[1].history()
+    contexts[2].history()
+    assert first._window is None and contexts[2]._window is not None
+    contexts[2].clear()
+    assert contexts[2]._window is None and id(contexts[2]) not in bot.ConversationContext._windows
@@ -0,0 +1,55 @@
+"""Реестр моделей: модели переиспользуются и сбрасываются при смене промпта и выбора модели"""
+import asyncio
+from types import SimpleNamespace
+
+
+def interaction(guild_id: int):
+    async def send_message(*args, **kwargs):
+        pass
+    return SimpleNamespace(
+        guild=SimpleNamespace(id=guild_id),
+        user=SimpleNamespace(guild_permissions=SimpleNamespace(administrator=True)),
+        response=SimpleNamespace(send_message=send_message)
+    )
+
+
+def cached(bot):
+    return set(bot.ModelRegistry._models)
+
+
+def test_registry_reuses_models(bot):
+    first = bot.ModelRegistry.get("models/gemini-2.0-flash", "промпт")
+    assert bot.ModelRegistry.get("models/gemini-2.0-flash", "промпт") is first
+    assert bot.ModelRegistry.get("models/gemini-2.0-flash") is not first
+
+
+def test_prompt_change_releases_old_prompt(bot):
+    model = "models/gemini-2.0-flash"
+
+    async def run():
+        await bot.set_prompt_command.callback(interaction(1), "старый")
+        await bot.set_prompt_command.callback(interaction(2), "общий")
+        await bot.set_prompt_command.callback(interaction(3), "общий")
+        for prompt in ("старый", "общий"):
+            bot.ModelRegistry.get(model, prompt)
+        await bot.set_prompt_command.callback(interaction(1), "новый")
+        assert cached(bot) == {(model, "общий")}
+        # Промпт еще используется сервером 3, его модель остается
+        await bot.clear_prompt_command.callback(interaction(2))
+        assert cached(bot) == {(model, "общий")}
+        await bot.clear_prompt_command.callback(interaction(3))
+        assert cached(bot) == set()
+
+    asyncio.run(run())
+
+
+def test_model_switch_releases_unused_model(bot):
+    bot.ModelRegistry.get("models/gemini-1.5-flash")
+    bot.ModelRegistry.get(bot.Config.DEFAULT_MODEL)
+    bot.ModelRouter.set_choice("guild", 1, "models/gemini-1.5-flash")
+    bot.ModelRouter.set_choice("channel", 5, "models/gemini-1.5-flash")
+    bot.ModelRouter.set_choice("guild", 1, bot.Config.DEFAULT_MODEL)
+    assert ("models/gemini-1.5-flash", None) in cached(bot)
+    bot.ModelRouter.set_choice("channel", 5, None)
+    # Модель больше никто не выбрал; модели по умолчанию остаются
+    assert cached(bot) == {(bot.Config.DEFAULT_MODEL, None)}
@@ -0,0 +1,97 @@
+"""Redis-хранилище и общее состояние на fakeredis: атомарное списание корзин и сохранение истории"""
+import asyncio
+
+import fakeredis
+import pytest
+import redis
+import redis.asyncio
+
+
+@pytest.fixture
+def server(monkeypatch):
+    """Один поддельный сервер Redis для синхронного и асинхронного клиентов бота"""
+    server = fakeredis.FakeServer()
+    monkeypatch.setattr(redis.Redis, "from_url", lambda url, **kwargs: fakeredis.FakeRedis(server=server, **kwargs))
+    monkeypatch.setattr(
+        redis.asyncio, "from_url", lambda url, **kwargs: fakeredis.FakeAsyncRedis(server=server, **kwargs)
+    )
+    return server
+
+
+def test_take_tokens_debits_all_buckets_or_none(bot, server):
+    async def run():
+        state = bot.RedisState("redis://fake")
+        # 60 запросов в минуту - токен в секунду; у пользователя два токена, у сервера один
+        user, guild = ("user:1", 60, 2), ("guild:1", 60, 1)
+        first = await state.take_tokens([user, guild])
+        second = await state.take_tokens([user, guild])
+        # Корзина сервера пуста: токен пользователя не списан
+        user_tokens = float(await state._db.hget("gemini:bucket:user:1", "tokens"))
+        third = await state.take_tokens([user])
+        fourth = await state.take_tokens([user])
+        await state.close()
+        return first, second, user_tokens, third, fourth
+
+    first, second, user_tokens, third, fourth = asyncio.run(run())
+    assert first is None
+    assert second[0] == "guild:1" and 0.9 < second[1] <= 1
+    assert user_tokens == pytest.approx(1, abs=0.05)
+    assert third is None
+    assert fourth[0] == "user:1"
+
+
+def test_shared_state_skips_limits_when_redis_is_down(bot, server):
+    server.connected = False
+
+    async def run():
+        state = bot.RedisState("redis://fake")
+        result = await state.take_tokens([("user:1", 60, 1)])
+        cached = await state.cache_get("key")
+        await state.cache_set("key", "ответ", 60)
+        return result, cached
+
+    # Без Redis бот продолжает отвечать: лимиты не применяются, кэш пропускается
+    assert asyncio.run(run()) == (None, None)
+
+
+def test_response_cache_round_trip(bot, server):
+    async def run():
+        state = bot.RedisState("redis://fake")
+        await state.cache_set("key", "ответ", 60)
+        return await state.cache_get("key"), await state._db.ttl("gemini:cache:key")
+
+    text, ttl = asyncio.run(run())
+    assert text == "ответ" and 0 < ttl <= 60
+
+
+def test_storage_round_trip(bot, server):
+    bot.Config.CONTEXT_LIMIT = 3
+    storage = bot.RedisStorage("redis://fake")
+    records = [bot.HistoryRecord("user" if i % 2 == 0 else "model", f"сообщение {i}", f"user{i}") for i in range(5)]
+    storage.apply([("append", 1, record) for record in records] + [
+        ("append", 2, records[0]),
+        ("prompt", 10, "Отвечай кратко"),
+        ("prompt", 11, "Удаляемый промпт"),
+        ("model", "guild", 10, "models/gemini-1.5-pro"),
+        ("model", "user", 5, "models/gemini-2.0-flash"),
+    ])
+    storage.apply([("prompt", 11, ""), ("model", "user", 5, None)])
+
+    summary, loaded = storage.load_channel(1, 100)
+    # На канал хранится не больше CONTEXT_LIMIT сообщений
+    assert summary == ""
+    assert [(r.role, r.content, r.author, r.timestamp) for r in loaded] == [
+        (r.role, r.content, r.author, r.timestamp) for r in records[2:]
+    ]
+    assert [r.content for r in storage.load_channel(1, 2)[1]] == ["сообщение 3", "сообщение 4"]
+    assert storage.load_server_prompts() == {10: "Отвечай кратко"}
+    assert storage.load_model_choices() == {("guild", 10): "models/gemini-1.5-pro"}
+
+    storage.apply([("summary", 1, "краткое содержание", 1)])
+    summary, loaded = storage.load_channel(1, 100)
+    assert summary == "краткое содержание" and [r.content for r in loaded] == ["сообщение 4"]
+
+    storage.apply([("clear", 1)])
+    assert storage.load_channel(1, 100) == ("", [])
+    assert [r.content for r in storage.load_channel(2, 100)[1]] == ["сообщение 0"]
+    storage.close()
@@ -0,0 +1,149 @@
+"""Симуляция планировщика на поддельном Gemini: лимиты, очередь, честная очередность серверов и отступ при 429"""
+import asyncio
+
+import pytest
+
+import bench
+from conftest import ask, configure, make_gemini
+
+
+def test_user_and_guild_buckets(bot, gemini):
+    scheduler = configure(bot, USER_BURST=2, GUILD_BURST=3, USER_RATE_PER_MINUTE=1, GUILD_RATE_PER_MINUTE=1)
+
+    async def run():
+        results = []
+        for user_id in (1, 1, 1, 2, 3):
+            try:
+                future, _ = await scheduler.submit(user_id, 10, ask(bot, gemini, f"u{user_id}"))
+                results.append(await future)
+            except bot.SchedulerRejected as e:
+                results.append(str(e))
+        return results
+
+    results = asyncio.run(run())
+    assert [r[0] for r in results[:2]] == ["u1", "u1"]
+    # Третий запрос пользователя упирается в его корзину, пятый - в корзину сервера
+    assert results[2].startswith("Слишком много запросов")
+    assert results[3][0] == "u2"
+    assert results[4].startswith("Лимит запросов для этого сервера")
+
+
+def test_global_bucket_paces_workers(bot, gemini):
+    scheduler = configure(bot, workers=4, GLOBAL_RATE_PER_MINUTE=600, GLOBAL_BURST=1)
+
+    async def run():
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        futures = [(await scheduler.submit(i, i, ask(bot, gemini, f"q{i}")))[0] for i in range(5)]
+        await asyncio.gather(*futures)
+        return loop.time() - started
+
+    # 10 запросов в секунду: после первого каждый следующий ждет ~0.1 с
+    assert asyncio.run(run()) >= 0.35
+
+
+def test_round_robin_between_guilds(bot, gemini):
+    scheduler = configure(bot, workers=1)
+    order = []
+
+    def job(name):
+        async def run():
+            order.append(name)
+            await asyncio.sleep(0.001)
+        return run
+
+    async def run():
+        futures = [(await scheduler.submit(1, 1, job(f"A{i}")))[0] for i in range(10)]
+        futures += [(await scheduler.submit(2, 2, job(f"B{i}")))[0] for i in range(2)]
+        futures += [(await scheduler.submit(3, 3, job(f"C{i}")))[0] for i in range(2)]
+        await asyncio.gather(*futures)
+
+    asyncio.run(run())
+    # Серверы B и C не ждут, пока обработается вся очередь сервера A
+    assert order[:6] == ["A0", "B0", "C0", "A1", "B1", "C1"]
+    assert order[6:] == [f"A{i}" for i in range(2, 10)]
+
+
+def test_queue_limits(bot, gemini):
+    scheduler = configure(bot, workers=1, QUEUE_LIMIT=5, QUEUE_LIMIT_PER_GUILD=3)
+    gemini.latency = 0.2
+
+    async def run():
+        accepted, rejected = [], []
+        for user_id, guild_id in [(1, 1)] * 5 + [(2, 2)] * 4:
+            try:
+                accepted.append((await scheduler.submit(user_id, guild_id, ask(bot, gemini, "q")))[0])
+            except bot.SchedulerRejected as e:
+                rejected.append((guild_id, str(e)))
+            # Даем обработчику забрать первую задачу, чтобы в очереди осталось ровно то, что ждет
+            await asyncio.sleep(0)
+        for future in accepted:
+            future.cancel()
+        return len(accepted), rejected
+
+    accepted, rejected = asyncio.run(run())
+    # Сервер 1: одна задача выполняется, три в очереди, пятая отклонена по лимиту сервера;
+    # сервер 2: две задачи, затем общая очередь (5) заполнена
+    assert accepted == 6
+    assert [guild for guild, _ in rejected] == [1, 2, 2]
+    assert all(text == "Бот сейчас перегружен, попробуйте позже." for _, text in rejected)
+
+
+def test_backoff_and_retry_after_quota_errors(bot, monkeypatch):
+    scheduler = configure(bot, workers=2, GLOBAL_RATE_PER_MINUTE=600)
+    gemini = make_gemini(bot, latency=0.001)
+    failures = {"left": 2}
+    respond = bench.FakeModel.respond
+
+    async def flaky(model, contents, history, stream):
+        # Первые два ответа - 429, затем модель отвечает
+        if failures["left"]:
+            failures["left"] -= 1
+            raise bot.google_exceptions.ResourceExhausted("квота")
+        return await respond(model, contents, history, stream)
+
+    monkeypatch.setattr(bench.FakeModel, "respond", flaky)
+    bot.Config.MODEL_FALLBACKS = {}
+    rates = []
+    report_overload = scheduler.report_overload
+
+    def record_overload():
+        delay = report_overload()
+        rates.append(scheduler.global_rate)
+        return delay
+
+    scheduler.report_overload = record_overload
+
+    async def run():
+        future, _ = await scheduler.submit(1, 1, ask(bot, gemini, "q"))
+        return await future
+
+    prompt, text = asyncio.run(run())
+    assert prompt == "q" and text
+    # Каждая ошибка квоты вдвое снижает общий темп, успех снова его поднимает
+    assert rates == [300, 150]
+    assert scheduler.global_rate == pytest.approx(150 + 600 / 20)
+    assert scheduler.backoff == 0
+
+
+def test_cancelled_job_keeps_worker(bot, gemini):
+    scheduler = configure(bot, workers=1)
+
+    async def cancelled_inside():
+        # Например, отмененный вложенный запрос
+        raise asyncio.CancelledError()
+
+    async def run():
+        first, _ = await scheduler.submit(1, 1, cancelled_inside)
+        second, _ = await scheduler.submit(2, 2, ask(bot, gemini, "q"))
+        result = await asyncio.wait_for(second, 5)
+        worker = scheduler._workers[0]
+        worker.cancel()
+        await asyncio.sleep(0)
+        return first.cancelled(), result, worker.done()
+
+    first_cancelled, result, worker_done = asyncio.run(run())
+    assert first_cancelled
+    # Тот же обработчик выполняет следующую задачу и останавливается только при отмене его самого
+    assert result[0] == "q"
+    assert worker_done
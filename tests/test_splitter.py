@@ -0,0 +1,89 @@
+"""Разбиение длинных ответов на сообщения Discord: блоки кода, лимит длины и скорость"""
+import random
+import time
+
+import pytest
+
+LIMITS = [20, 50, 100, 500, 2000]
+PIECES = [
+    "слово", "word", "длинноесловобезпробелов" * 5, " ", " ", " ", "\n", "\n", "\n\n",
+    "```python\n", "```\n", "~~~~\n", "~~~~\n", "`````\n", "```" + "x" * 300 + "\n", "```x = 1```\n",
+    "`код`", "``", "`" * 7, "   ```\n", "\t", "# Заголовок\n", "- пункт\n",
+]
+
+
+def random_text(rng: random.Random, size: int) -> str:
+    parts, length = [], 0
+    while length < size:
+        piece = rng.choice(PIECES)
+        if piece == "`" * 7:
+            piece = "`" * rng.randint(1, 3000)
+        parts.append(piece)
+        length += len(piece)
+    return "".join(parts)
+
+
+def is_subsequence(needle: str, haystack: str) -> bool:
+    chars = iter(haystack)
+    return all(char in chars for char in needle)
+
+
+def test_inline_code_is_not_a_fence(bot):
+    chunks = list(bot.MessageSplitter.split("```x = 1```\n" + "word " * 900, 2000))
+    assert len(chunks) == 3
+    assert chunks[0].startswith("```x = 1```\n") and not chunks[0].endswith("```")
+    assert not any(chunk.startswith("```") for chunk in chunks[1:])
+
+
+def test_code_block_is_reopened_in_next_message(bot):
+    text = "Пример:\n```python\n" + "print('строка кода')\n" * 200 + "```\nГотово."
+    chunks = list(bot.MessageSplitter.split(text, 500))
+    assert all(len(chunk) <= 500 for chunk in chunks)
+    assert chunks[0].endswith("\n```")
+    assert all(chunk.startswith("```python\n") for chunk in chunks[1:-1])
+    assert chunks[-1].endswith("```\nГотово.")
+
+
+def test_long_info_string_is_dropped_when_reopening(bot):
+    text = "```" + "язык" * 300 + "\n" + "код\n" * 2000 + "```"
+    chunks = list(bot.MessageSplitter.split(text, 2000))
+    assert all(len(chunk) <= 2000 for chunk in chunks)
+    # Язык не помещается в заголовок продолжения, блок кода все равно продолжается
+    assert all(chunk.startswith("```\nкод") for chunk in chunks[1:])
+
+
+def test_backtick_run_is_not_split_per_character(bot):
+    chunks = list(bot.MessageSplitter.split("`" * 2500, 2000))
+    assert len(chunks) <= 3
+    assert all(len(chunk) <= 2000 for chunk in chunks)
+
+
+@pytest.mark.parametrize("limit", LIMITS)
+def test_fuzz_chunks_fit_and_keep_text(bot, limit):
+    rng = random.Random(limit)
+    for _ in range(200):
+        text = random_text(rng, rng.randint(1, 20 * limit))
+        chunks = list(bot.MessageSplitter.split(text, limit))
+        assert all(0 < len(chunk) <= limit for chunk in chunks)
+        assert all(chunk.strip() for chunk in chunks)
+        # Текст не теряется: разделители на местах разрезов могут пропасть, остальные символы - нет
+        assert is_subsequence("".join(text.split()), "".join("".join(chunks).split()))
+        # Число сообщений растет линейно с длиной текста
+        assert len(chunks) <= 4 * len(text) / limit + 2
+        if limit >= 100:
+            # Каждое сообщение, кроме последнего, закрывает открытые в нем блоки кода,
+            # если закрывающая строка помещается (серия ``` длиной в сообщение закрыта быть не может)
+            for chunk in chunks[:-1]:
+                fence = bot.MessageSplitter.fence_after(chunk, 0, len(chunk), None)
+                assert fence is None or not bot.MessageSplitter.markers(fence, limit)[1], chunk
+
+
+def test_split_throughput(bot):
+    rng = random.Random(1)
+    text = random_text(rng, 10 * 2 ** 20)
+    started = time.perf_counter()
+    chunks = sum(1 for _ in bot.MessageSplitter.split(text, 2000))
+    elapsed = time.perf_counter() - started
+    assert chunks >= len(text) // 2000
+    # 10 МБ разбиваются за секунды, а не минуты (на обычной машине ~0.5 с)
+    assert elapsed < 5, f"{elapsed:.2f} с"